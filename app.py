@@ -1,18 +1,25 @@
 import os
 import sys
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session, Response, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime
+from datetime import datetime, timedelta
 from email_parser import EmailParser
-from pdf_analyzer import PDFAnalyzer
+from pdf_analyzer import PDFAnalyzer, obtener_analizador, segundos_desde
+import migraciones
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 import uuid
+import json
+import time
+import hashlib
+import bisect
+import math
 from functools import wraps
 from authlib.integrations.flask_client import OAuth
-from sqlalchemy import text, extract
+from sqlalchemy import text, extract, insert, update
 from sqlalchemy import inspect as sqlalchemy_inspect
-import tempfile
+from sqlalchemy.dialects import postgresql as dialecto_postgresql, sqlite as dialecto_sqlite
+from sqlalchemy.exc import IntegrityError
 import os
 
 # Forzar Python 3.11 en Render (solo en producción)
@@ -196,6 +203,15 @@ class MetricasIA(db.Model):
     tokens_consumidos = db.Column(db.Integer, nullable=False, default=0)
     costo_estimado = db.Column(db.Float, nullable=False, default=0.0)
     duracion_segundos = db.Column(db.Float, nullable=False, default=0.0)
+    tokens_cache_lectura = db.Column(db.Integer, nullable=True, default=0)  # usage.cache_read_input_tokens
+    tokens_cache_escritura = db.Column(db.Integer, nullable=True, default=0)  # usage.cache_creation_input_tokens
+    tokens_entrada = db.Column(db.Integer, nullable=True, default=0)  # usage.input_tokens
+    tokens_salida = db.Column(db.Integer, nullable=True, default=0)  # usage.output_tokens
+    # Tiempos por fase en segundos (None si la fase no se midió)
+    duracion_extraccion = db.Column(db.Float, nullable=True)
+    duracion_preparacion = db.Column(db.Float, nullable=True)
+    duracion_llamada_ia = db.Column(db.Float, nullable=True)
+    duracion_parseo = db.Column(db.Float, nullable=True)
     timestamp = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     usuario = db.relationship('Usuario', backref=db.backref('metricas_ia', lazy=True))
 
@@ -287,6 +303,28 @@ class TipoTarjetaEstandarizado(db.Model):
     def __repr__(self):
         return f'<TipoTarjetaEstandarizado {self.nombre_estandarizado}>'
 
+# Tabla de caché de análisis de PDFs (clave: SHA-256 del contenido del archivo)
+class CacheAnalisisPDF(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    hash_sha256 = db.Column(db.String(64), nullable=False, unique=True, index=True)
+    texto_extraido = db.Column(db.Text, nullable=True)  # Texto extraído del PDF
+    resultado_json = db.Column(db.Text, nullable=False)  # Resultado del análisis de IA (JSON)
+    tamano_bytes = db.Column(db.Integer, nullable=False, default=0)  # Tamaño almacenado (texto + JSON)
+    hits = db.Column(db.Integer, nullable=False, default=0)  # Veces que se reutilizó
+    fecha_creacion = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    ultimo_acceso = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<CacheAnalisisPDF {self.hash_sha256[:12]} ({self.hits} hits)>'
+
+# Verificación de esquema para las rutas
+def asegurar_esquema(forzar=False):
+    """
+    Esquema de la base al día para las rutas. Las migraciones se aplican al desplegar
+    (migraciones.py); después de la primera verificación del proceso no hace consultas.
+    """
+    migraciones.asegurar_esquema(db.engine, forzar=forzar)
+
 # Decorador para requerir login
 def login_required(f):
     @wraps(f)
@@ -483,8 +521,35 @@ def registrar_metrica_herramienta(usuario_id, herramienta, accion, metadatos=Non
     db.session.commit()
     return metrica
 
-def registrar_metrica_ia(usuario_id, modelo_ia, tipo_operacion, tokens_consumidos, costo_estimado, duracion_segundos):
-    """Registrar una métrica detallada de IA"""
+# Precios de la API de Anthropic en USD por millón de tokens (entrada, salida).
+# La escritura al caché de prompts cuesta 1.25x la entrada y la lectura 0.1x
+PRECIOS_IA_POR_MILLON = {
+    'claude-haiku-4-5': (1.00, 5.00),
+    'claude-sonnet-4-5': (3.00, 15.00),
+}
+
+DESCUENTO_LOTE_IA = 0.5  # Message Batches cobra la mitad de los tokens
+
+def calcular_costo_ia(modelo_ia, uso_tokens, lote=False):
+    """Costo en USD de una llamada según los tokens reales de response.usage (lote: Message Batches)"""
+    precio_entrada, precio_salida = PRECIOS_IA_POR_MILLON.get(modelo_ia, PRECIOS_IA_POR_MILLON['claude-haiku-4-5'])
+    costo = (
+        uso_tokens.get('input_tokens', 0) * precio_entrada
+        + uso_tokens.get('cache_creation_input_tokens', 0) * precio_entrada * 1.25
+        + uso_tokens.get('cache_read_input_tokens', 0) * precio_entrada * 0.1
+        + uso_tokens.get('output_tokens', 0) * precio_salida
+    ) / 1_000_000
+    return costo * DESCUENTO_LOTE_IA if lote else costo
+
+def registrar_metrica_ia(usuario_id, modelo_ia, tipo_operacion, tokens_consumidos, costo_estimado, duracion_segundos,
+                         tokens_cache_lectura=0, tokens_cache_escritura=0, tokens_entrada=0, tokens_salida=0,
+                         tiempos=None):
+    """
+    Registrar una métrica detallada de IA: tokens reales (entrada, salida y caché de
+    prompts) y, si se dan, los tiempos por fase del análisis ('extraccion',
+    'preparacion', 'llamada_ia', 'parseo_json', en segundos)
+    """
+    tiempos = tiempos or {}
     try:
         # Asegurar que la transacción esté limpia antes de continuar
         try:
@@ -498,7 +563,15 @@ def registrar_metrica_ia(usuario_id, modelo_ia, tipo_operacion, tokens_consumido
             tipo_operacion=tipo_operacion,
             tokens_consumidos=tokens_consumidos,
             costo_estimado=costo_estimado,
-            duracion_segundos=duracion_segundos
+            duracion_segundos=duracion_segundos,
+            tokens_cache_lectura=tokens_cache_lectura,
+            tokens_cache_escritura=tokens_cache_escritura,
+            tokens_entrada=tokens_entrada,
+            tokens_salida=tokens_salida,
+            duracion_extraccion=tiempos.get('extraccion'),
+            duracion_preparacion=tiempos.get('preparacion'),
+            duracion_llamada_ia=tiempos.get('llamada_ia'),
+            duracion_parseo=tiempos.get('parseo_json')
         )
         db.session.add(metrica)
         db.session.commit()
@@ -512,6 +585,167 @@ def registrar_metrica_ia(usuario_id, modelo_ia, tipo_operacion, tokens_consumido
         # Retornar None si falla, pero no fallar la aplicación
         return None
 
+# ===== CACHÉ DE ANÁLISIS DE PDF =====
+# Límites de la caché (configurables por variables de entorno)
+CACHE_PDF_MAX_MB = float(os.environ.get('PDF_CACHE_MAX_MB', '50'))  # Tamaño total máximo
+CACHE_PDF_MAX_DIAS = int(os.environ.get('PDF_CACHE_MAX_DIAS', '30'))  # Antigüedad máxima desde el último uso
+HERRAMIENTA_CACHE_PDF = 'cache_analisis_pdf'  # Nombre usado en MetricasHerramientas para hits/misses
+
+def calcular_hash_pdf(pdf_bytes):
+    """Calcula el SHA-256 del contenido del PDF (clave de la caché)"""
+    return hashlib.sha256(pdf_bytes).hexdigest()
+
+def registrar_evento_cache_pdf(usuario_id, accion):
+    """Registrar un hit o miss de la caché de análisis (no falla la petición si hay error)"""
+    if not usuario_id:
+        return
+    try:
+        registrar_metrica_herramienta(usuario_id, HERRAMIENTA_CACHE_PDF, accion)
+    except Exception as e:
+        print(f"ADVERTENCIA - No se pudo registrar evento de caché ({accion}): {str(e)}")
+        try:
+            db.session.rollback()
+        except:
+            pass
+
+def obtener_cache_analisis(hash_pdf, usuario_id=None):
+    """
+    Buscar un análisis previo del mismo PDF.
+    Retorna (texto_extraido, resultado) o None si no hay entrada vigente.
+    """
+    try:
+        try:
+            db.session.rollback()
+        except:
+            pass
+        
+        entrada = CacheAnalisisPDF.query.filter_by(hash_sha256=hash_pdf).first()
+        
+        # Descartar entradas vencidas
+        if entrada and entrada.ultimo_acceso < datetime.utcnow() - timedelta(days=CACHE_PDF_MAX_DIAS):
+            db.session.delete(entrada)
+            db.session.commit()
+            entrada = None
+        
+        if not entrada:
+            registrar_evento_cache_pdf(usuario_id, 'miss')
+            return None
+        
+        resultado = json.loads(entrada.resultado_json)
+        texto_extraido = entrada.texto_extraido
+        
+        entrada.hits = (entrada.hits or 0) + 1
+        entrada.ultimo_acceso = datetime.utcnow()
+        db.session.commit()
+        
+        registrar_evento_cache_pdf(usuario_id, 'hit')
+        print(f"DEBUG - Caché de análisis: HIT {hash_pdf[:12]}")
+        return texto_extraido, resultado
+    except Exception as e:
+        print(f"ADVERTENCIA - Error consultando caché de análisis: {str(e)}")
+        try:
+            db.session.rollback()
+        except:
+            pass
+        return None
+
+def guardar_cache_analisis(hash_pdf, texto_extraido, resultado):
+    """Guardar el texto extraído y el resultado exitoso del análisis en la caché"""
+    try:
+        try:
+            db.session.rollback()
+        except:
+            pass
+        
+        resultado_json = json.dumps(resultado, ensure_ascii=False)
+        tamano_bytes = len(resultado_json.encode('utf-8')) + len((texto_extraido or '').encode('utf-8'))
+        
+        entrada = CacheAnalisisPDF.query.filter_by(hash_sha256=hash_pdf).first()
+        if entrada:
+            entrada.texto_extraido = texto_extraido
+            entrada.resultado_json = resultado_json
+            entrada.tamano_bytes = tamano_bytes
+            entrada.ultimo_acceso = datetime.utcnow()
+        else:
+            entrada = CacheAnalisisPDF(
+                hash_sha256=hash_pdf,
+                texto_extraido=texto_extraido,
+                resultado_json=resultado_json,
+                tamano_bytes=tamano_bytes
+            )
+            db.session.add(entrada)
+        db.session.commit()
+        
+        depurar_cache_analisis()
+        return entrada
+    except Exception as e:
+        print(f"ADVERTENCIA - No se pudo guardar en caché de análisis: {str(e)}")
+        try:
+            db.session.rollback()
+        except:
+            pass
+        return None
+
+def depurar_cache_analisis():
+    """
+    Política de expulsión de la caché:
+    1. Eliminar entradas sin uso en los últimos CACHE_PDF_MAX_DIAS días
+    2. Si el tamaño total supera CACHE_PDF_MAX_MB, eliminar las menos usadas recientemente
+    """
+    try:
+        limite_fecha = datetime.utcnow() - timedelta(days=CACHE_PDF_MAX_DIAS)
+        vencidas = CacheAnalisisPDF.query.filter(CacheAnalisisPDF.ultimo_acceso < limite_fecha).delete()
+        
+        limite_bytes = int(CACHE_PDF_MAX_MB * 1024 * 1024)
+        total_bytes = db.session.query(db.func.coalesce(db.func.sum(CacheAnalisisPDF.tamano_bytes), 0)).scalar()
+        
+        expulsadas = 0
+        if total_bytes > limite_bytes:
+            entradas = db.session.query(CacheAnalisisPDF.id, CacheAnalisisPDF.tamano_bytes).order_by(
+                CacheAnalisisPDF.ultimo_acceso.asc()
+            ).all()
+            ids_expulsar = []
+            for entrada_id, tamano in entradas:
+                if total_bytes <= limite_bytes:
+                    break
+                ids_expulsar.append(entrada_id)
+                total_bytes -= tamano or 0
+            if ids_expulsar:
+                expulsadas = CacheAnalisisPDF.query.filter(CacheAnalisisPDF.id.in_(ids_expulsar)).delete(synchronize_session=False)
+        
+        db.session.commit()
+        if vencidas or expulsadas:
+            print(f"DEBUG - Caché de análisis depurada: {vencidas} vencidas, {expulsadas} por tamaño")
+    except Exception as e:
+        print(f"ADVERTENCIA - Error depurando caché de análisis: {str(e)}")
+        try:
+            db.session.rollback()
+        except:
+            pass
+
+def obtener_estadisticas_cache_analisis():
+    """Estadísticas de la caché para el dashboard de administrador"""
+    try:
+        hits = MetricasHerramientas.query.filter_by(herramienta=HERRAMIENTA_CACHE_PDF, accion='hit').count()
+        misses = MetricasHerramientas.query.filter_by(herramienta=HERRAMIENTA_CACHE_PDF, accion='miss').count()
+        entradas = CacheAnalisisPDF.query.count()
+        total_bytes = db.session.query(db.func.coalesce(db.func.sum(CacheAnalisisPDF.tamano_bytes), 0)).scalar()
+        total_consultas = hits + misses
+        return {
+            'hits': hits,
+            'misses': misses,
+            'tasa_aciertos': (hits / total_consultas * 100) if total_consultas > 0 else 0.0,
+            'entradas': entradas,
+            'tamano_mb': total_bytes / (1024 * 1024)
+        }
+    except Exception as e:
+        print(f"ERROR obteniendo estadísticas de caché: {str(e)}")
+        try:
+            db.session.rollback()
+        except:
+            pass
+        return {'hits': 0, 'misses': 0, 'tasa_aciertos': 0.0, 'entradas': 0, 'tamano_mb': 0.0}
+
 def normalizar_nombre_banco(nombre):
     """Normaliza el nombre del banco removiendo sufijos comunes para comparación"""
     if not nombre:
@@ -543,8 +777,8 @@ def estandarizar_banco(nombre_banco):
         return None
     
     try:
-        # Asegurar que la columna abreviacion existe ANTES de hacer cualquier consulta
-        ensure_abreviaciones_columns()
+        # Esquema al día (columna abreviacion): sin consultas después de la primera verificación
+        asegurar_esquema()
         
         # Limpiar transacción antes de continuar
         try:
@@ -685,8 +919,8 @@ def estandarizar_tipo_tarjeta(tipo_tarjeta):
         return None
     
     try:
-        # Asegurar que la columna abreviacion existe ANTES de hacer cualquier consulta
-        ensure_abreviaciones_columns()
+        # Esquema al día (columna abreviacion): sin consultas después de la primera verificación
+        asegurar_esquema()
         
         # Limpiar transacción antes de continuar
         try:
@@ -931,217 +1165,489 @@ class EstadoCuentaDuplicadoException(Exception):
         self.mensaje = mensaje
         super().__init__(self.mensaje)
 
-def guardar_estado_cuenta(usuario_id, datos_analisis, archivo_original=None, extraer_movimientos_detallados=True, sobrescribir=False, estado_cuenta_id_sobrescribir=None):
+class EstadosCuentaDuplicadosException(Exception):
+    """Estados de cuenta de un mismo PDF que ya existen: [(indice, estado_existente, mensaje)]"""
+    def __init__(self, duplicados):
+        self.duplicados = duplicados
+        super().__init__(f"{len(duplicados)} estado(s) de cuenta de este PDF ya existen")
+
+# Bases (por URL) -> (tiene el índice único de códigos (migración 7), cuándo se revisó)
+_indice_codigo_estado_cuenta = {}
+
+def indice_codigo_estado_cuenta_disponible():
+    """
+    Si la base tiene el índice único (usuario_id, código DDMMAAAA-XXX). Si lo tiene, no se
+    vuelve a consultar en el proceso; si no, se revisa de nuevo cada
+    migraciones.SEGUNDOS_RECHEQUEO_INDICE (ej. después de migraciones.py --indice-codigo).
+    """
+    clave = str(db.engine.url)
+    disponible, revisado = _indice_codigo_estado_cuenta.get(clave, (False, None))
+    if not disponible and (revisado is None or time.monotonic() - revisado > migraciones.SEGUNDOS_RECHEQUEO_INDICE):
+        disponible = migraciones.tiene_indice(db.engine, 'estados_cuenta', migraciones.INDICE_CODIGO_ESTADO_CUENTA)
+        _indice_codigo_estado_cuenta[clave] = (disponible, time.monotonic())
+    return disponible
+
+def insertar_estado_cuenta_si_no_existe(valores):
+    """
+    INSERT ... ON CONFLICT DO NOTHING RETURNING del estado de cuenta: el índice único
+    decide en la base, sin carreras entre requests simultáneos (doble clic). Retorna el
+    EstadosCuenta creado (en la sesión) o None si el usuario ya tiene ese código.
+    """
+    dialecto = dialecto_postgresql if db.engine.dialect.name == 'postgresql' else dialecto_sqlite
+    sentencia = dialecto.insert(EstadosCuenta).values(**valores).on_conflict_do_nothing().returning(EstadosCuenta)
+    return db.session.scalars(sentencia).first()
+
+def buscar_estado_cuenta_por_codigo(usuario_id, codigo_archivo):
+    """Estado de cuenta del usuario con ese código (para informar el duplicado)"""
+    return EstadosCuenta.query.filter_by(usuario_id=usuario_id, archivo_original=codigo_archivo).first()
+
+def serializar_estado_cuenta_existente(estado_existente):
+    """Datos del estado de cuenta existente que se devuelven en las respuestas 'duplicate'"""
+    # Manejar fecha_inicio_periodo de forma segura (puede no existir en BD antigua)
+    fecha_inicio_periodo_str = None
+    try:
+        if hasattr(estado_existente, 'fecha_inicio_periodo') and estado_existente.fecha_inicio_periodo:
+            fecha_inicio_periodo_str = estado_existente.fecha_inicio_periodo.strftime('%d/%m/%Y')
+    except Exception:
+        pass  # Si no existe la columna, simplemente retornar None
+    
+    return {
+        'id': estado_existente.id,
+        'banco': estado_existente.nombre_banco,
+        'tarjeta': estado_existente.tipo_tarjeta,
+        'fecha_corte': estado_existente.fecha_corte.strftime('%d/%m/%Y') if estado_existente.fecha_corte else None,
+        'fecha_inicio_periodo': fecha_inicio_periodo_str,
+        'ultimos_digitos': estado_existente.ultimos_digitos,
+        'fecha_creacion': estado_existente.fecha_creacion.strftime('%d/%m/%Y %H:%M') if estado_existente.fecha_creacion else None
+    }
+
+def buscar_estado_cuenta_duplicado_en_texto(usuario_id, texto_pdf):
+    """
+    Detección temprana de duplicados a partir del texto extraído (sin IA).
+    Busca la fecha de corte y los últimos dígitos de la tarjeta con expresiones regulares,
+    arma los códigos DDMMAAAA-XXX que usa guardar_estado_cuenta y los busca en archivo_original.
+    Si el PDF trae varias tarjetas (dividir_estados_en_paginas) se revisa cada una: solo es
+    duplicado si todas ya están guardadas.
+    Retorna el EstadosCuenta existente (el de la primera tarjeta) o None.
+    """
     try:
-        # Asegurar que todas las columnas necesarias existen ANTES de hacer cualquier consulta
-        print("DEBUG guardar_estado_cuenta: Verificando columnas necesarias...")
-        ensure_estados_cuenta_columns()
-        ensure_abreviaciones_columns()
-        ensure_consumos_detalle_categoria_503020()
-        print("DEBUG guardar_estado_cuenta: Columnas verificadas")
+        grupos = PDFAnalyzer.dividir_estados_en_paginas(PDFAnalyzer.paginas_desde_texto(texto_pdf))
+        textos = ["\n".join(texto for _, texto in grupo) for grupo in grupos] if len(grupos) > 1 else [texto_pdf]
         
-        # Asegurar que la transacción esté limpia
         try:
             db.session.rollback()
         except:
             pass
         
-        # Calcular porcentaje de utilización si es posible
-        porcentaje_utilizacion = None
-        if datos_analisis.get('cupo_autorizado') and datos_analisis.get('cupo_utilizado'):
-            porcentaje_utilizacion = (datos_analisis['cupo_utilizado'] / datos_analisis['cupo_autorizado']) * 100
-        
-        # Convertir fechas string a date objects
-        fecha_corte = None
-        fecha_inicio_periodo = None
-        fecha_pago = None
-        
-        if datos_analisis.get('fecha_corte'):
-            try:
-                from datetime import datetime
-                fecha_corte = datetime.strptime(datos_analisis['fecha_corte'], '%d/%m/%Y').date()
-            except ValueError:
-                print(f"Error parseando fecha_corte: {datos_analisis['fecha_corte']}")
+        estados_existentes = []
+        for texto in textos:
+            identificadores = PDFAnalyzer.detectar_identificadores_estado(texto)
+            fecha_corte = identificadores.get('fecha_corte')
+            candidatos_digitos = identificadores.get('ultimos_digitos') or []
+            
+            if not fecha_corte or not candidatos_digitos:
+                return None
+            
+            codigos = [fecha_corte.strftime('%d%m%Y') + '-' + digitos for digitos in candidatos_digitos]
+            print(f"DEBUG - Códigos candidatos para detección de duplicados: {codigos}")
+            
+            estado_existente = EstadosCuenta.query.filter(
+                EstadosCuenta.usuario_id == usuario_id,
+                EstadosCuenta.archivo_original.in_(codigos)
+            ).first()
+            if not estado_existente:
+                return None
+            estados_existentes.append(estado_existente)
         
-        if datos_analisis.get('fecha_inicio_periodo'):
-            try:
-                from datetime import datetime
-                fecha_inicio_periodo = datetime.strptime(datos_analisis['fecha_inicio_periodo'], '%d/%m/%Y').date()
-            except ValueError:
-                print(f"Error parseando fecha_inicio_periodo: {datos_analisis['fecha_inicio_periodo']}")
+        return estados_existentes[0]
+    except Exception as e:
+        print(f"ADVERTENCIA - Error en detección temprana de duplicados: {str(e)}")
+        try:
+            db.session.rollback()
+        except:
+            pass
+        return None
+
+def _preparar_estado_cuenta(datos_analisis, archivo_original=None):
+    """
+    Convierte los datos del análisis a los valores a guardar (fechas, código de archivo,
+    banco y tarjeta estandarizados). Se ejecuta antes de escribir en la sesión porque
+    estandarizar_banco/estandarizar_tipo_tarjeta hacen rollback/commit.
+    """
+    # Calcular porcentaje de utilización si es posible
+    porcentaje_utilizacion = None
+    if datos_analisis.get('cupo_autorizado') and datos_analisis.get('cupo_utilizado'):
+        porcentaje_utilizacion = (datos_analisis['cupo_utilizado'] / datos_analisis['cupo_autorizado']) * 100
+    
+    # Convertir fechas string a date objects
+    fecha_corte = None
+    fecha_inicio_periodo = None
+    fecha_pago = None
+    
+    if datos_analisis.get('fecha_corte'):
+        try:
+            fecha_corte = datetime.strptime(datos_analisis['fecha_corte'], '%d/%m/%Y').date()
+        except ValueError:
+            print(f"Error parseando fecha_corte: {datos_analisis['fecha_corte']}")
+    
+    if datos_analisis.get('fecha_inicio_periodo'):
+        try:
+            fecha_inicio_periodo = datetime.strptime(datos_analisis['fecha_inicio_periodo'], '%d/%m/%Y').date()
+        except ValueError:
+            print(f"Error parseando fecha_inicio_periodo: {datos_analisis['fecha_inicio_periodo']}")
+    
+    if datos_analisis.get('fecha_pago'):
+        try:
+            fecha_pago = datetime.strptime(datos_analisis['fecha_pago'], '%d/%m/%Y').date()
+        except ValueError:
+            print(f"Error parseando fecha_pago: {datos_analisis['fecha_pago']}")
+    
+    # Generar código de archivo: DDMMAAAA-654 (fecha_corte + últimos 3 dígitos)
+    codigo_archivo = archivo_original  # Fallback al nombre original
+    codigo_generado = None
+    ultimos_digitos = datos_analisis.get('ultimos_digitos', '')
+    if fecha_corte and ultimos_digitos:
+        try:
+            # Formato: DDMMAAAA-654
+            codigo_generado = fecha_corte.strftime('%d%m%Y') + '-' + ultimos_digitos
+            codigo_archivo = codigo_generado
+        except Exception as e:
+            print(f"Error generando código de archivo: {e}")
+            codigo_archivo = archivo_original  # Fallback al nombre original
+    
+    return {
+        'fecha_corte': fecha_corte,
+        'fecha_inicio_periodo': fecha_inicio_periodo,
+        'fecha_pago': fecha_pago,
+        'porcentaje_utilizacion': porcentaje_utilizacion,
+        'ultimos_digitos': ultimos_digitos,
+        'codigo_archivo': codigo_archivo,
+        'codigo_generado': codigo_generado,
+        'nombre_banco': estandarizar_banco(datos_analisis.get('nombre_banco')),
+        'tipo_tarjeta': estandarizar_tipo_tarjeta(datos_analisis.get('tipo_tarjeta')),
+    }
+
+def mensaje_estado_cuenta_duplicado(preparado):
+    fecha_corte = preparado['fecha_corte']
+    return f"Ya existe un estado de cuenta con fecha de corte {fecha_corte.strftime('%d/%m/%Y') if fecha_corte else 'N/A'} para la tarjeta terminada en {preparado['ultimos_digitos']}"
+
+def _agregar_estado_cuenta(usuario_id, datos_analisis, preparado, extraer_movimientos_detallados=True, sobrescribir=False, estado_cuenta_id_sobrescribir=None, conservar_categorias=True):
+    """
+    Agrega (o actualiza) el estado de cuenta y sus movimientos en la sesión actual, sin
+    hacer commit: el llamador decide cuándo confirmar la transacción.
+    """
+    fecha_corte = preparado['fecha_corte']
+    ultimos_digitos = preparado['ultimos_digitos']
+    codigo_generado = preparado['codigo_generado']
+    codigo_archivo = preparado['codigo_archivo']
+    
+    mensaje_duplicado = mensaje_estado_cuenta_duplicado(preparado)
+    codigo_unico = bool(codigo_generado and codigo_generado == codigo_archivo)
+    # El índice único (migración 7) solo cubre los códigos con dígitos (ultimos_digitos viene
+    # de la IA: puede ser 'XXXX' o '****1234')
+    codigo_en_indice = (codigo_unico and migraciones.codigo_en_indice(codigo_generado)
+                        and indice_codigo_estado_cuenta_disponible())
+    
+    # Verificar duplicados solo si tenemos un código válido generado (no fallback) y no estamos
+    # sobrescribiendo. Si el índice cubre el código lo decide el INSERT más abajo; si no,
+    # consulta previa
+    if codigo_unico and not sobrescribir and not codigo_en_indice:
+        try:
+            estado_existente = EstadosCuenta.query.filter_by(
+                usuario_id=usuario_id,
+                archivo_original=codigo_generado
+            ).first()
+        except Exception as query_error:
+            print(f"ERROR guardar_estado_cuenta en query de duplicados: {str(query_error)}")
+            # Si falla por columna faltante, volver a verificar el esquema y reintentar
+            db.session.rollback()
+            asegurar_esquema(forzar=True)
+            estado_existente = EstadosCuenta.query.filter_by(
+                usuario_id=usuario_id,
+                archivo_original=codigo_generado
+            ).first()
         
-        if datos_analisis.get('fecha_pago'):
-            try:
-                from datetime import datetime
-                fecha_pago = datetime.strptime(datos_analisis['fecha_pago'], '%d/%m/%Y').date()
-            except ValueError:
-                print(f"Error parseando fecha_pago: {datos_analisis['fecha_pago']}")
-        
-        # Generar código de archivo: DDMMAAAA-654 (fecha_corte + últimos 3 dígitos)
-        codigo_archivo = archivo_original  # Fallback al nombre original
-        ultimos_digitos = datos_analisis.get('ultimos_digitos', '')
-        if fecha_corte and ultimos_digitos:
-            try:
-                # Formato: DDMMAAAA-654
-                codigo_archivo = fecha_corte.strftime('%d%m%Y') + '-' + ultimos_digitos
-            except Exception as e:
-                print(f"Error generando código de archivo: {e}")
-                codigo_archivo = archivo_original  # Fallback al nombre original
+        if estado_existente:
+            # Lanzar excepción con información del estado existente
+            raise EstadoCuentaDuplicadoException(estado_existente, mensaje_duplicado)
+    
+    # Si estamos sobrescribiendo, obtener el estado existente (sus movimientos se
+    # sincronizan por diferencias más abajo)
+    estado_cuenta = None
+    if sobrescribir and estado_cuenta_id_sobrescribir:
+        estado_cuenta = EstadosCuenta.query.filter_by(
+            id=estado_cuenta_id_sobrescribir,
+            usuario_id=usuario_id
+        ).first()
+        
+        if not estado_cuenta:
+            raise ValueError(f"No se encontró el estado de cuenta con ID {estado_cuenta_id_sobrescribir} para sobrescribir")
+        
+        # Actualizar campos del estado existente
+        estado_cuenta.fecha_corte = fecha_corte
+        estado_cuenta.fecha_inicio_periodo = preparado['fecha_inicio_periodo']
+        estado_cuenta.fecha_pago = preparado['fecha_pago']
+        estado_cuenta.cupo_autorizado = datos_analisis.get('cupo_autorizado') or 0.00
+        estado_cuenta.cupo_disponible = datos_analisis.get('cupo_disponible') or 0.00
+        estado_cuenta.cupo_utilizado = datos_analisis.get('cupo_utilizado') or 0.00
+        estado_cuenta.deuda_anterior = datos_analisis.get('deuda_anterior') or 0.00
+        estado_cuenta.consumos_debitos = datos_analisis.get('consumos_debitos') or 0.00
+        estado_cuenta.otros_cargos = datos_analisis.get('otros_cargos') or 0.00
+        estado_cuenta.consumos_cargos_totales = datos_analisis.get('consumos_cargos_totales') or 0.00
+        estado_cuenta.pagos_creditos = datos_analisis.get('pagos_creditos') or 0.00
+        estado_cuenta.intereses = datos_analisis.get('intereses') or 0.00
+        estado_cuenta.minimo_a_pagar = datos_analisis.get('minimo_a_pagar') or 0.00
+        estado_cuenta.deuda_total_pagar = datos_analisis.get('deuda_total_pagar') or 0.00
+        estado_cuenta.nombre_banco = preparado['nombre_banco']
+        estado_cuenta.tipo_tarjeta = preparado['tipo_tarjeta']
+        estado_cuenta.ultimos_digitos = ultimos_digitos
+        estado_cuenta.porcentaje_utilizacion = preparado['porcentaje_utilizacion']
+        estado_cuenta.archivo_original = codigo_archivo
+        estado_cuenta.fecha_creacion = datetime.utcnow()  # Actualizar fecha de creación
         
-        # Verificar duplicados solo si tenemos un código válido generado (no fallback) y no estamos sobrescribiendo
-        codigo_generado = None
-        if fecha_corte and ultimos_digitos:
-            try:
-                codigo_generado = fecha_corte.strftime('%d%m%Y') + '-' + ultimos_digitos
-            except Exception:
-                pass
+        try:
+            db.session.flush()  # Para obtener el ID actualizado
+        except IntegrityError:
+            # El nuevo código ya lo tiene otro estado de cuenta del usuario (índice único)
+            db.session.rollback()
+            raise EstadoCuentaDuplicadoException(
+                buscar_estado_cuenta_por_codigo(usuario_id, codigo_archivo), mensaje_duplicado
+            )
+    else:
+        # Crear nuevo estado de cuenta
+        valores = dict(
+            usuario_id=usuario_id,
+            fecha_corte=fecha_corte,
+            fecha_inicio_periodo=preparado['fecha_inicio_periodo'],
+            fecha_pago=preparado['fecha_pago'],
+            cupo_autorizado=datos_analisis.get('cupo_autorizado') or 0.00,
+            cupo_disponible=datos_analisis.get('cupo_disponible') or 0.00,
+            cupo_utilizado=datos_analisis.get('cupo_utilizado') or 0.00,
+            deuda_anterior=datos_analisis.get('deuda_anterior') or 0.00,
+            consumos_debitos=datos_analisis.get('consumos_debitos') or 0.00,
+            otros_cargos=datos_analisis.get('otros_cargos') or 0.00,
+            consumos_cargos_totales=datos_analisis.get('consumos_cargos_totales') or 0.00,
+            pagos_creditos=datos_analisis.get('pagos_creditos') or 0.00,
+            intereses=datos_analisis.get('intereses') or 0.00,
+            minimo_a_pagar=datos_analisis.get('minimo_a_pagar') or 0.00,
+            deuda_total_pagar=datos_analisis.get('deuda_total_pagar') or 0.00,
+            nombre_banco=preparado['nombre_banco'],
+            tipo_tarjeta=preparado['tipo_tarjeta'],
+            ultimos_digitos=ultimos_digitos,
+            porcentaje_utilizacion=preparado['porcentaje_utilizacion'],
+            archivo_original=codigo_archivo
+        )
         
-        if codigo_generado and codigo_generado == codigo_archivo and not sobrescribir:
-            # Asegurar que la transacción esté limpia antes de consultar
-            try:
-                db.session.rollback()
-            except:
-                pass
-            
-            try:
-                estado_existente = EstadosCuenta.query.filter_by(
-                    usuario_id=usuario_id,
-                    archivo_original=codigo_generado
-                ).first()
-            except Exception as query_error:
-                print(f"ERROR guardar_estado_cuenta en query de duplicados: {str(query_error)}")
-                # Si falla por columna faltante, intentar crearla de nuevo
-                ensure_fecha_inicio_periodo_column()
-                db.session.rollback()
-                estado_existente = EstadosCuenta.query.filter_by(
-                    usuario_id=usuario_id,
-                    archivo_original=codigo_generado
-                ).first()
-            
-            if estado_existente:
-                # Lanzar excepción con información del estado existente
+        if codigo_en_indice:
+            # Detección atómica de duplicados: INSERT ... ON CONFLICT DO NOTHING RETURNING
+            estado_cuenta = insertar_estado_cuenta_si_no_existe(valores)
+            if estado_cuenta is None:
                 raise EstadoCuentaDuplicadoException(
-                    estado_existente,
-                    f"Ya existe un estado de cuenta con fecha de corte {fecha_corte.strftime('%d/%m/%Y') if fecha_corte else 'N/A'} para la tarjeta terminada en {ultimos_digitos}"
+                    buscar_estado_cuenta_por_codigo(usuario_id, codigo_archivo), mensaje_duplicado
                 )
-        
-        # Si estamos sobrescribiendo, obtener el estado existente y eliminar sus movimientos
-        estado_cuenta = None
-        if sobrescribir and estado_cuenta_id_sobrescribir:
-            estado_cuenta = EstadosCuenta.query.filter_by(
-                id=estado_cuenta_id_sobrescribir,
-                usuario_id=usuario_id
-            ).first()
-            
-            if not estado_cuenta:
-                raise ValueError(f"No se encontró el estado de cuenta con ID {estado_cuenta_id_sobrescribir} para sobrescribir")
-            
-            # Eliminar movimientos detallados existentes
-            ConsumosDetalle.query.filter_by(estado_cuenta_id=estado_cuenta.id).delete()
-            
-            # Actualizar campos del estado existente
-            estado_cuenta.fecha_corte = fecha_corte
-            estado_cuenta.fecha_inicio_periodo = fecha_inicio_periodo
-            estado_cuenta.fecha_pago = fecha_pago
-            estado_cuenta.cupo_autorizado = datos_analisis.get('cupo_autorizado') or 0.00
-            estado_cuenta.cupo_disponible = datos_analisis.get('cupo_disponible') or 0.00
-            estado_cuenta.cupo_utilizado = datos_analisis.get('cupo_utilizado') or 0.00
-            estado_cuenta.deuda_anterior = datos_analisis.get('deuda_anterior') or 0.00
-            estado_cuenta.consumos_debitos = datos_analisis.get('consumos_debitos') or 0.00
-            estado_cuenta.otros_cargos = datos_analisis.get('otros_cargos') or 0.00
-            estado_cuenta.consumos_cargos_totales = datos_analisis.get('consumos_cargos_totales') or 0.00
-            estado_cuenta.pagos_creditos = datos_analisis.get('pagos_creditos') or 0.00
-            estado_cuenta.intereses = datos_analisis.get('intereses') or 0.00
-            estado_cuenta.minimo_a_pagar = datos_analisis.get('minimo_a_pagar') or 0.00
-            estado_cuenta.deuda_total_pagar = datos_analisis.get('deuda_total_pagar') or 0.00
-            estado_cuenta.nombre_banco = estandarizar_banco(datos_analisis.get('nombre_banco'))
-            estado_cuenta.tipo_tarjeta = estandarizar_tipo_tarjeta(datos_analisis.get('tipo_tarjeta'))
-            estado_cuenta.ultimos_digitos = ultimos_digitos
-            estado_cuenta.porcentaje_utilizacion = porcentaje_utilizacion
-            estado_cuenta.archivo_original = codigo_archivo
-            estado_cuenta.fecha_creacion = datetime.utcnow()  # Actualizar fecha de creación
-            
-            db.session.flush()  # Para obtener el ID actualizado
         else:
-            # Crear nuevo estado de cuenta
-            estado_cuenta = EstadosCuenta(
-                usuario_id=usuario_id,
-                fecha_corte=fecha_corte,
-                fecha_inicio_periodo=fecha_inicio_periodo,
-                fecha_pago=fecha_pago,
-                cupo_autorizado=datos_analisis.get('cupo_autorizado') or 0.00,
-                cupo_disponible=datos_analisis.get('cupo_disponible') or 0.00,
-                cupo_utilizado=datos_analisis.get('cupo_utilizado') or 0.00,
-                deuda_anterior=datos_analisis.get('deuda_anterior') or 0.00,
-                consumos_debitos=datos_analisis.get('consumos_debitos') or 0.00,
-                otros_cargos=datos_analisis.get('otros_cargos') or 0.00,
-                consumos_cargos_totales=datos_analisis.get('consumos_cargos_totales') or 0.00,
-                pagos_creditos=datos_analisis.get('pagos_creditos') or 0.00,
-                intereses=datos_analisis.get('intereses') or 0.00,
-                minimo_a_pagar=datos_analisis.get('minimo_a_pagar') or 0.00,
-                deuda_total_pagar=datos_analisis.get('deuda_total_pagar') or 0.00,
-                nombre_banco=estandarizar_banco(datos_analisis.get('nombre_banco')),
-                tipo_tarjeta=estandarizar_tipo_tarjeta(datos_analisis.get('tipo_tarjeta')),
-                ultimos_digitos=ultimos_digitos,
-                porcentaje_utilizacion=porcentaje_utilizacion,
-                archivo_original=codigo_archivo
-            )
-            
+            estado_cuenta = EstadosCuenta(**valores)
             db.session.add(estado_cuenta)
             db.session.flush()  # Para obtener el ID del estado de cuenta
-        
-        # Guardar movimientos detallados si están disponibles
-        movimientos_guardados = 0
-        if extraer_movimientos_detallados and 'movimientos_detallados' in datos_analisis:
-            movimientos_detallados = datos_analisis['movimientos_detallados']
+    
+    # Guardar movimientos detallados si están disponibles: se validan y convierten todos
+    # primero y se insertan en una sola sentencia (INSERT de varias filas / executemany)
+    filas, errores = [], []
+    if extraer_movimientos_detallados and 'movimientos_detallados' in datos_analisis:
+        filas, errores = preparar_movimientos_detallados(estado_cuenta.id, datos_analisis['movimientos_detallados'])
+    estado_cuenta.errores_movimientos = errores
+    estado_cuenta.sincronizacion_movimientos = None
+    
+    if sobrescribir and estado_cuenta_id_sobrescribir:
+        # Solo se escriben las diferencias: se conservan las categorías corregidas o relacionadas
+        estado_cuenta.sincronizacion_movimientos = sincronizar_movimientos_detallados(
+            estado_cuenta.id, filas, conservar_categorias=conservar_categorias
+        )
+    elif filas:
+        # Relacionar cargos de IVA/retenciones con sus consumos antes de insertar (en memoria)
+        relacionar_cargos_iva_en_movimientos(filas)
+        db.session.execute(insert(ConsumosDetalle), filas)
+    print(f"Movimientos detallados agregados: {len(filas)}")
+    if errores:
+        print(f"Movimientos detallados con error (no guardados): {len(errores)}")
+    
+    return estado_cuenta
+
+def preparar_movimientos_detallados(estado_cuenta_id, movimientos_detallados):
+    """
+    Valida y convierte los movimientos del análisis a filas de ConsumosDetalle, sin tocar
+    la sesión. Un movimiento inválido no detiene a los demás: se reporta en 'errores'
+    (índice, descripción y motivo) y no se guarda.
+    
+    Returns:
+        tuple: (filas, errores) - filas listas para insert(ConsumosDetalle)
+    """
+    filas = []
+    errores = []
+    fechas = {}  # Las fechas se repiten mucho dentro de un estado de cuenta
+    fecha_creacion = datetime.utcnow()
+    
+    for indice, movimiento_data in enumerate(movimientos_detallados):
+        try:
+            # Convertir fecha string a date si es necesario (si no se puede parsear, None)
+            fecha_texto = movimiento_data.get('fecha')
+            fecha_movimiento = None
+            if fecha_texto:
+                if fecha_texto not in fechas:
+                    try:
+                        fechas[fecha_texto] = datetime.strptime(fecha_texto, '%d/%m/%Y').date()
+                    except ValueError:
+                        fechas[fecha_texto] = None
+                fecha_movimiento = fechas[fecha_texto]
             
-            for movimiento_data in movimientos_detallados:
+            categoria = movimiento_data.get('categoria', 'Otros')
+            tipo_transaccion = movimiento_data.get('tipo_transaccion', 'otro')
+            # Montos como texto ("12.50") se convierten; sin monto (None) se guarda vacío
+            monto = movimiento_data.get('monto', 0)
+            if monto is not None:
                 try:
-                    # Convertir fecha string a date si es necesario
-                    fecha_movimiento = None
-                    if movimiento_data.get('fecha'):
-                        try:
-                            from datetime import datetime
-                            fecha_movimiento = datetime.strptime(movimiento_data['fecha'], '%d/%m/%Y').date()
-                        except ValueError:
-                            # Si no se puede parsear, dejar como None
-                            pass
-                    
-                    # Crear consumo detallado
-                    categoria = movimiento_data.get('categoria', 'Otros')
-                    tipo_transaccion = movimiento_data.get('tipo_transaccion', 'otro')
-                    monto = movimiento_data.get('monto', 0)
-                    
-                    # Solo asignar categoria_503020 a consumos (cargos positivos)
-                    # Los pagos, notas de crédito y otros movimientos NO deben tener esta clasificación
-                    categoria_503020 = None
-                    if tipo_transaccion == 'consumo' and monto > 0:
-                        categoria_503020 = mapear_categoria_a_503020(categoria)
-                    
-                    consumo_detalle = ConsumosDetalle(
-                        estado_cuenta_id=estado_cuenta.id,
-                        fecha=fecha_movimiento,
-                        descripcion=movimiento_data.get('descripcion', ''),
-                        monto=monto,
-                        categoria=categoria,
-                        categoria_503020=categoria_503020,  # Solo para consumos positivos
-                        tipo_transaccion=tipo_transaccion
-                    )
-                    
-                    db.session.add(consumo_detalle)
-                    movimientos_guardados += 1
-                    
-                except Exception as e:
-                    print(f"Error guardando movimiento individual: {e}")
-                    continue
+                    monto = float(monto)
+                except (TypeError, ValueError):
+                    raise ValueError(f"monto inválido: {monto!r}")
+            
+            # Solo asignar categoria_503020 a consumos (cargos positivos)
+            # Los pagos, notas de crédito y otros movimientos NO deben tener esta clasificación
+            categoria_503020 = None
+            if tipo_transaccion == 'consumo' and monto is not None and monto > 0:
+                categoria_503020 = mapear_categoria_a_503020(categoria)
+            
+            filas.append({
+                'estado_cuenta_id': estado_cuenta_id,
+                'fecha': fecha_movimiento,
+                # Recortar al tamaño de las columnas: un texto largo haría fallar todo el INSERT
+                'descripcion': (movimiento_data.get('descripcion') or '')[:200],
+                'monto': monto,
+                'categoria': categoria[:50] if categoria else categoria,
+                'categoria_503020': categoria_503020,
+                'tipo_transaccion': tipo_transaccion[:50] if tipo_transaccion else tipo_transaccion,
+                'fecha_creacion': fecha_creacion
+            })
+        except Exception as e:
+            descripcion = movimiento_data.get('descripcion') if isinstance(movimiento_data, dict) else None
+            print(f"Error guardando movimiento individual {indice}: {e}")
+            errores.append({'indice': indice, 'descripcion': descripcion, 'error': str(e)})
+    
+    return filas, errores
+
+def normalizar_descripcion_movimiento(descripcion):
+    """Descripción para comparar movimientos: mayúsculas y espacios simples"""
+    return ' '.join((descripcion or '').upper().split())
+
+def huellas_movimientos(movimientos):
+    """
+    Huella estable de cada movimiento: (fecha, descripción normalizada, monto, número de
+    aparición). El número de aparición distingue movimientos idénticos (ej. dos cafés
+    iguales el mismo día) según su orden en el estado de cuenta.
+    """
+    apariciones = {}
+    huellas = []
+    for movimiento in movimientos:
+        monto = movimiento['monto']
+        clave = (movimiento['fecha'], normalizar_descripcion_movimiento(movimiento['descripcion']),
+                 round(monto, 2) if monto is not None else None)
+        apariciones[clave] = apariciones.get(clave, 0) + 1
+        huellas.append(clave + (apariciones[clave],))
+    return huellas
+
+def sincronizar_movimientos_detallados(estado_cuenta_id, filas, conservar_categorias=True):
+    """
+    Sobrescritura por diferencias: compara las filas nuevas (preparar_movimientos_detallados)
+    con los movimientos guardados por su huella y solo inserta los nuevos, elimina los que
+    ya no están y actualiza descripción/tipo de los que cambiaron, en sentencias por
+    conjunto. Los movimientos que siguen conservan su id y su categoría (corregida por el
+    usuario o relacionada antes); con conservar_categorias=False (re-análisis masivo tras
+    cambiar el prompt) toman la categoría nueva. Los cargos de IVA/retenciones se relacionan
+    en memoria sobre el estado final (conservados + nuevos) antes de escribir.
+    
+    Returns:
+        dict: cantidad de movimientos insertados, actualizados, eliminados y sin cambios
+    """
+    existentes = db.session.execute(
+        db.select(ConsumosDetalle.id, ConsumosDetalle.fecha, ConsumosDetalle.descripcion, ConsumosDetalle.monto,
+                  ConsumosDetalle.categoria, ConsumosDetalle.categoria_503020, ConsumosDetalle.tipo_transaccion)
+        .where(ConsumosDetalle.estado_cuenta_id == estado_cuenta_id)
+        .order_by(ConsumosDetalle.id)
+    ).mappings().all()
+    
+    por_huella = dict(zip(huellas_movimientos(existentes), existentes))
+    conservados = {}  # id -> movimiento con los valores nuevos y la categoría guardada
+    nuevas = []
+    for huella, fila in zip(huellas_movimientos(filas), filas):
+        existente = por_huella.pop(huella, None)
+        if existente is None:
+            nuevas.append(fila)
+            continue
+        movimiento = dict(existente, descripcion=fila['descripcion'], tipo_transaccion=fila['tipo_transaccion'])
+        if not conservar_categorias:
+            movimiento.update(categoria=fila['categoria'], categoria_503020=fila['categoria_503020'])
+        elif fila['tipo_transaccion'] != existente['tipo_transaccion']:
+            # categoria_503020 solo aplica a consumos positivos (con la categoría conservada)
+            es_consumo = fila['tipo_transaccion'] == 'consumo' and (existente['monto'] or 0) > 0
+            movimiento['categoria_503020'] = (existente['categoria_503020'] or mapear_categoria_a_503020(existente['categoria'])) if es_consumo else None
+        conservados[existente['id']] = movimiento
+    
+    # Relacionar sobre el estado final, en el orden en que quedan guardados (por id)
+    relacionar_cargos_iva_en_movimientos(
+        [conservados[existente['id']] for existente in existentes if existente['id'] in conservados] + nuevas
+    )
+    
+    actualizaciones = []
+    sin_cambios = 0
+    for existente in existentes:
+        movimiento = conservados.get(existente['id'])
+        if movimiento is None:
+            continue
+        cambios = {
+            columna: movimiento[columna]
+            for columna in ('descripcion', 'tipo_transaccion', 'categoria', 'categoria_503020')
+            if movimiento[columna] != existente[columna]
+        }
+        if cambios:
+            actualizaciones.append(dict(cambios, id=existente['id']))
+        else:
+            sin_cambios += 1
+    
+    eliminados = [existente['id'] for existente in por_huella.values()]
+    if eliminados:
+        ConsumosDetalle.query.filter(ConsumosDetalle.id.in_(eliminados)).delete(synchronize_session=False)
+    if actualizaciones:
+        db.session.execute(update(ConsumosDetalle), actualizaciones)
+    if nuevas:
+        db.session.execute(insert(ConsumosDetalle), nuevas)
+    
+    resumen = {'insertados': len(nuevas), 'actualizados': len(actualizaciones),
+               'eliminados': len(eliminados), 'sin_cambios': sin_cambios}
+    print(f"Movimientos sincronizados: {resumen}")
+    return resumen
+
+def guardar_estado_cuenta(usuario_id, datos_analisis, archivo_original=None, extraer_movimientos_detallados=True, sobrescribir=False, estado_cuenta_id_sobrescribir=None, conservar_categorias=True):
+    try:
+        # Asegurar que el esquema está al día ANTES de hacer cualquier consulta
+        asegurar_esquema()
+        
+        # Asegurar que la transacción esté limpia
+        try:
+            db.session.rollback()
+        except:
+            pass
+        
+        preparado = _preparar_estado_cuenta(datos_analisis, archivo_original)
+        estado_cuenta = _agregar_estado_cuenta(
+            usuario_id, datos_analisis, preparado,
+            extraer_movimientos_detallados=extraer_movimientos_detallados,
+            sobrescribir=sobrescribir,
+            estado_cuenta_id_sobrescribir=estado_cuenta_id_sobrescribir,
+            conservar_categorias=conservar_categorias
+        )
         
         db.session.commit()
         
         print(f"Estado de cuenta guardado: {estado_cuenta.nombre_banco} - {estado_cuenta.tipo_tarjeta}")
-        print(f"Movimientos detallados guardados: {movimientos_guardados}")
-        
-        # Post-procesamiento: relacionar cargos de IVA/retenciones con consumos
-        relacionar_cargos_iva_con_consumos(estado_cuenta.id)
         
         return estado_cuenta
         
@@ -1150,23 +1656,90 @@ def guardar_estado_cuenta(usuario_id, datos_analisis, archivo_original=None, ext
         db.session.rollback()
         raise e
 
-@app.route('/')
-def home():
-    """
-    Página principal - Redirige a login si no está autenticado
-    """
-    if 'user_id' not in session:
-        return redirect(url_for('login'))
-    return render_template('home.html', usuario=get_current_user())
-
-@app.route('/login', methods=['GET', 'POST'])
-def login():
+def guardar_estados_cuenta(usuario_id, lista_datos_analisis, archivo_original=None, extraer_movimientos_detallados=True, decisiones_duplicados=None):
     """
-    Página de login
+    Guarda varios estados de cuenta (ej. las tarjetas de un mismo PDF) en una sola
+    transacción: si alguno falla, no se guarda ninguno.
+    
+    Los que ya existen se informan todos juntos (EstadosCuentaDuplicadosException) salvo
+    que decisiones_duplicados (lista en el mismo orden) diga qué hacer con cada uno:
+    'sobrescribir' actualiza el existente y 'omitir' no lo guarda.
+    
+    Returns:
+        list: los EstadosCuenta guardados, en el mismo orden (sin los omitidos)
     """
-    if request.method == 'POST':
-        username = request.form['username']
-        password = request.form['password']
+    try:
+        asegurar_esquema()
+        
+        # Asegurar que la transacción esté limpia
+        try:
+            db.session.rollback()
+        except:
+            pass
+        
+        # Estandarizar todo antes de escribir (la estandarización hace rollback/commit)
+        preparados = [_preparar_estado_cuenta(datos, archivo_original) for datos in lista_datos_analisis]
+        decisiones = list(decisiones_duplicados or [])
+        decisiones += [None] * (len(preparados) - len(decisiones))
+        
+        # Buscar todos los duplicados antes de escribir, para informarlos juntos
+        existentes, duplicados = {}, []
+        for indice, preparado in enumerate(preparados):
+            codigo_generado = preparado['codigo_generado']
+            if not codigo_generado or codigo_generado != preparado['codigo_archivo']:
+                continue
+            estado_existente = buscar_estado_cuenta_por_codigo(usuario_id, codigo_generado)
+            if estado_existente:
+                existentes[indice] = estado_existente
+                if decisiones[indice] not in ('sobrescribir', 'omitir'):
+                    duplicados.append((indice, estado_existente, mensaje_estado_cuenta_duplicado(preparado)))
+        if duplicados:
+            raise EstadosCuentaDuplicadosException(duplicados)
+        
+        estados_cuenta = []
+        for indice, (datos, preparado) in enumerate(zip(lista_datos_analisis, preparados)):
+            estado_existente = existentes.get(indice)
+            if estado_existente and decisiones[indice] == 'omitir':
+                print(f"DEBUG - Estado de cuenta omitido (ya existe): {estado_existente.archivo_original}")
+                continue
+            try:
+                estados_cuenta.append(_agregar_estado_cuenta(
+                    usuario_id, datos, preparado,
+                    extraer_movimientos_detallados=extraer_movimientos_detallados,
+                    sobrescribir=estado_existente is not None,
+                    estado_cuenta_id_sobrescribir=estado_existente.id if estado_existente else None
+                ))
+            except EstadoCuentaDuplicadoException as e:
+                # Guardado por otro request entre la búsqueda y el INSERT
+                raise EstadosCuentaDuplicadosException([(indice, e.estado_cuenta_existente, e.mensaje)])
+        
+        db.session.commit()
+        print(f"Estados de cuenta guardados en una transacción: {len(estados_cuenta)}")
+        
+        return estados_cuenta
+        
+    except Exception as e:
+        print(f"Error guardando estados de cuenta: {e}")
+        db.session.rollback()
+        raise e
+
+@app.route('/')
+def home():
+    """
+    Página principal - Redirige a login si no está autenticado
+    """
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+    return render_template('home.html', usuario=get_current_user())
+
+@app.route('/login', methods=['GET', 'POST'])
+def login():
+    """
+    Página de login
+    """
+    if request.method == 'POST':
+        username = request.form['username']
+        password = request.form['password']
         
         user = Usuario.query.filter_by(username=username).first()
         
@@ -1452,10 +2025,8 @@ def historial_estados_cuenta():
     Historial de estados de cuenta analizados
     """
     try:
-        # Asegurar que la columna existe ANTES de hacer cualquier consulta
-        print("DEBUG historial_estados_cuenta: Verificando columna fecha_inicio_periodo...")
-        ensure_fecha_inicio_periodo_column()
-        print("DEBUG historial_estados_cuenta: Columna verificada")
+        # Asegurar que el esquema está al día ANTES de hacer cualquier consulta
+        asegurar_esquema()
         
         # Asegurar que la transacción esté limpia
         try:
@@ -1481,10 +2052,10 @@ def historial_estados_cuenta():
             print(f"DEBUG historial_estados_cuenta: {len(estados_cuenta)} estados encontrados")
         except Exception as query_error:
             print(f"ERROR historial_estados_cuenta en query: {str(query_error)}")
-            # Si falla la query, puede ser por la columna faltante - intentar crearla de nuevo
+            # Si falla la query, puede ser por la columna faltante - volver a verificar el esquema
             try:
-                ensure_fecha_inicio_periodo_column()
                 db.session.rollback()
+                asegurar_esquema(forzar=True)
                 estados_cuenta = EstadosCuenta.query.filter_by(usuario_id=usuario_actual.id).order_by(
                     EstadosCuenta.fecha_corte.desc(),
                     EstadosCuenta.fecha_creacion.desc()
@@ -1583,6 +2154,151 @@ def limpiar_todos_estados():
         db.session.rollback()
         return jsonify({'success': False, 'message': f'Error al limpiar: {str(e)}'}), 500
 
+def evento_sse(evento, datos):
+    """Formatea un evento Server-Sent Events con datos JSON"""
+    return f"event: {evento}\ndata: {json.dumps(datos, ensure_ascii=False, default=str)}\n\n"
+
+def completar_tiempos_analisis(resultado, inicio_analisis, duracion_extraccion):
+    """Agrega a resultado['tiempos'] la extracción hecha en la ruta y el tiempo total"""
+    tiempos = resultado.setdefault('tiempos', {})
+    if duracion_extraccion is not None:
+        tiempos['extraccion'] = duracion_extraccion
+    tiempos['total'] = segundos_desde(inicio_analisis)
+
+def finalizar_analisis_pdf(resultado, hash_pdf, desde_cache):
+    """
+    Pasos comunes después del análisis de un PDF (modo JSON y modo streaming):
+    guarda en caché, estandariza banco/tarjeta, formatea y registra el uso de IA.
+    Retorna el resultado formateado para el navegador.
+    """
+    # Guardar en caché solo los análisis exitosos
+    if not desde_cache and resultado.get('status') == 'success':
+        resultado_cache = {k: v for k, v in resultado.items() if k != 'texto_extraido'}
+        if 'estados' in resultado_cache:
+            resultado_cache['estados'] = [
+                {k: v for k, v in parte.items() if k != 'texto_extraido'} for parte in resultado_cache['estados']
+            ]
+        guardar_cache_analisis(hash_pdf, resultado.get('texto_extraido'), resultado_cache)
+    
+    # Debug: mostrar el resultado crudo
+    print(f"DEBUG - Resultado crudo: {resultado}")
+    
+    # Estandarizar nombres de banco y tipo de tarjeta ANTES de formatear
+    # IMPORTANTE: Envolver en try-except para evitar que errores de BD dejen la transacción en estado fallido
+    partes_exitosas = [
+        parte for parte in resultado.get('estados', [resultado])
+        if parte.get('status') == 'success' and 'data' in parte
+    ]
+    for parte in partes_exitosas:
+        datos = parte['data']
+        try:
+            if 'nombre_banco' in datos and datos['nombre_banco']:
+                datos['nombre_banco'] = estandarizar_banco(datos['nombre_banco']) or datos['nombre_banco']
+        except Exception as e:
+            print(f"ERROR estandarizando banco: {str(e)}")
+            # Asegurar rollback si hay error
+            try:
+                db.session.rollback()
+            except:
+                pass
+            # Continuar con el nombre original si falla
+        
+        try:
+            if 'tipo_tarjeta' in datos and datos['tipo_tarjeta']:
+                datos['tipo_tarjeta'] = estandarizar_tipo_tarjeta(datos['tipo_tarjeta']) or datos['tipo_tarjeta']
+        except Exception as e:
+            print(f"ERROR estandarizando tipo tarjeta: {str(e)}")
+            # Asegurar rollback si hay error
+            try:
+                db.session.rollback()
+            except:
+                pass
+            # Continuar con el tipo original si falla
+    
+    # Formatear resultados
+    resultado_formateado = PDFAnalyzer.formatear_resultados(resultado)
+    if resultado_formateado.get('status') != 'error':
+        resultado_formateado['cache'] = desde_cache
+    
+    # Debug: mostrar el resultado formateado
+    print(f"DEBUG - Resultado formateado: {resultado_formateado}")
+    
+    # Registrar el uso de IA solo si fue exitoso (un resultado de caché o de un
+    # parser local por banco no consume IA)
+    uso_ia = not desde_cache and resultado.get('uso_ia', resultado.get('method') != 'parser_local')
+    if resultado_formateado.get('status') != 'error' and uso_ia:
+        # Asegurar que la transacción esté limpia antes de obtener el usuario
+        try:
+            db.session.rollback()  # Limpiar cualquier transacción fallida previa
+        except:
+            pass
+        
+        usuario_actual = get_current_user()
+        # Registrar uso de IA (con manejo de errores)
+        uso_registrado = registrar_uso_ia(usuario_actual.id, 'analisis_pdf')
+        if uso_registrado:
+            print(f"DEBUG - Uso de IA registrado para usuario {usuario_actual.id}")
+        else:
+            print(f"ADVERTENCIA - No se pudo registrar uso de IA para usuario {usuario_actual.id}")
+        
+        # ===== REGISTRAR MÉTRICAS DETALLADAS DE IA =====
+        # Tokens reales de response.usage y tiempos medidos por fase
+        uso_tokens = resultado.get('uso_tokens') or {}
+        tiempos = resultado.get('tiempos') or {}
+        modelo_ia = 'claude-haiku-4-5'
+        
+        if uso_tokens:
+            tokens_consumidos = sum(uso_tokens.get(clave, 0) for clave in (
+                'input_tokens', 'output_tokens', 'cache_read_input_tokens', 'cache_creation_input_tokens'
+            ))
+            costo_estimado = calcular_costo_ia(modelo_ia, uso_tokens)
+        else:
+            # Sin usage (no debería pasar con la IA): estimación por palabras
+            raw_response = resultado.get('raw_response', '')
+            texto_pdf = resultado.get('texto_extraido', '')
+            try:
+                tokens_consumidos = int((len(texto_pdf.split()) if texto_pdf else 0) * 1.3
+                                        + (len(raw_response.split()) if raw_response else 0) * 1.3)
+            except Exception as e:
+                print(f"ERROR calculando tokens: {str(e)}")
+                tokens_consumidos = 0
+            costo_estimado = calcular_costo_ia(modelo_ia, {'input_tokens': tokens_consumidos})
+        
+        # Registrar métricas (con manejo de errores)
+        metrica_registrada = registrar_metrica_ia(
+            usuario_id=usuario_actual.id,
+            modelo_ia=modelo_ia,
+            tipo_operacion='analisis_pdf',
+            tokens_consumidos=tokens_consumidos,
+            costo_estimado=costo_estimado,
+            duracion_segundos=tiempos.get('total', 0.0),
+            tokens_cache_lectura=uso_tokens.get('cache_read_input_tokens', 0),
+            tokens_cache_escritura=uso_tokens.get('cache_creation_input_tokens', 0),
+            tokens_entrada=uso_tokens.get('input_tokens', 0),
+            tokens_salida=uso_tokens.get('output_tokens', 0),
+            tiempos=tiempos
+        )
+        if metrica_registrada:
+            print(f"DEBUG - Métricas de IA registradas: {tokens_consumidos} tokens, ${costo_estimado:.4f}, "
+                  f"tiempos: {tiempos}")
+        else:
+            print(f"ADVERTENCIA - No se pudieron registrar métricas de IA")
+        
+        # Actualizar límites en la sesión (con manejo de errores). En modo streaming la
+        # cookie ya se envió: /api/user-limits la actualiza en la siguiente consulta
+        try:
+            # Asegurar que la transacción esté limpia antes de obtener límites
+            try:
+                db.session.rollback()
+            except:
+                pass
+            session['user_limits'] = get_user_limits(usuario_actual.id)
+        except Exception as e:
+            print(f"ADVERTENCIA - Error obteniendo límites de usuario: {str(e)}")
+            # Continuar sin actualizar límites en sesión
+    
+    return resultado_formateado
+
 @app.route('/analizar-pdf', methods=['GET', 'POST'])
 @login_required
 def analizar_pdf():
@@ -1620,12 +2336,26 @@ def analizar_pdf():
                     'message': 'El archivo debe ser un PDF'
                 }), 400
             
-            # Guardar archivo temporalmente
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as temp_file:
-                file.save(temp_file.name)
-                temp_path = temp_file.name
+            # Leer el PDF en memoria (sin archivo temporal en disco)
+            pdf_bytes = file.read()
+            if not pdf_bytes:
+                return jsonify({
+                    'status': 'error',
+                    'message': 'El archivo PDF está vacío'
+                }), 400
             
-            try:
+            # Buscar un análisis previo del mismo archivo (caché por SHA-256 del contenido)
+            hash_pdf = calcular_hash_pdf(pdf_bytes)
+            usuario_actual = get_current_user()
+            entrada_cache = obtener_cache_analisis(hash_pdf, usuario_actual.id if usuario_actual else None)
+            desde_cache = entrada_cache is not None
+            resultado = None
+            
+            if desde_cache:
+                # Mismo PDF ya analizado: reutilizar el resultado sin llamar a la IA
+                texto_pdf, resultado = entrada_cache
+                resultado['texto_extraido'] = texto_pdf
+            else:
                 # Verificar que la API key esté configurada
                 anthropic_key = os.environ.get('ANTHROPIC_API_KEY')
                 if not anthropic_key:
@@ -1640,8 +2370,9 @@ def analizar_pdf():
                 print(f"DEBUG - ANTHROPIC_API_KEY encontrada (longitud: {len(anthropic_key)})")
                 
                 # Analizar el PDF con Claude (análisis completo con movimientos detallados)
+                # El analizador y su cliente HTTP se comparten entre requests del mismo proceso
                 try:
-                    analyzer = PDFAnalyzer()
+                    analyzer = obtener_analizador()
                 except ValueError as e:
                     return jsonify({
                         'status': 'error',
@@ -1656,8 +2387,69 @@ def analizar_pdf():
                         'message': f'Error inicializando analizador: {str(e)}'
                     }), 500
                 
+                # Extraer el texto una sola vez: se usa para detectar duplicados y para el análisis
+                inicio_analisis = time.perf_counter()
+                try:
+                    texto_pdf = analyzer.extraer_texto_pdf(memoryview(pdf_bytes))
+                    duracion_extraccion = segundos_desde(inicio_analisis)
+                except Exception as e:
+                    print(f"ADVERTENCIA - No se pudo extraer texto antes del análisis: {str(e)}")
+                    texto_pdf = None
+                    duracion_extraccion = None
+            
+            # Detección temprana de duplicados (antes de gastar una llamada a la IA)
+            ignorar_duplicado = request.form.get('ignorar_duplicado') in ('1', 'true', 'True')
+            if texto_pdf and usuario_actual and not ignorar_duplicado:
+                estado_existente = buscar_estado_cuenta_duplicado_en_texto(usuario_actual.id, texto_pdf)
+                if estado_existente:
+                    print(f"DEBUG - Estado de cuenta duplicado detectado antes del análisis: {estado_existente.archivo_original}")
+                    return jsonify({
+                        'status': 'duplicate',
+                        'message': f"Este estado de cuenta ya fue guardado (fecha de corte {estado_existente.fecha_corte.strftime('%d/%m/%Y') if estado_existente.fecha_corte else 'N/A'}, tarjeta terminada en {estado_existente.ultimos_digitos})",
+                        'estado_cuenta_existente': serializar_estado_cuenta_existente(estado_existente)
+                    })
+            
+            # Modo streaming (SSE): el resumen y cada movimiento se envían a medida que la IA
+            # los genera; el último evento 'resultado' es igual a la respuesta JSON
+            if resultado is None and request.form.get('stream') in ('1', 'true', 'True'):
+                def generar_eventos():
+                    try:
+                        for evento, datos in analyzer.analizar_estados_cuenta_stream(
+                            memoryview(pdf_bytes),
+                            extraer_movimientos_detallados=True,
+                            texto_pdf=texto_pdf
+                        ):
+                            if evento == 'resultado':
+                                completar_tiempos_analisis(datos, inicio_analisis, duracion_extraccion)
+                                yield evento_sse('resultado', finalizar_analisis_pdf(datos, hash_pdf, False))
+                            else:
+                                yield evento_sse(evento, datos)
+                    except Exception as e:
+                        import traceback
+                        print(f"ERROR en analizar-pdf (streaming): {str(e)}")
+                        print(f"Traceback: {traceback.format_exc()}")
+                        yield evento_sse('resultado', {
+                            'status': 'error',
+                            'message': f'Error analizando PDF: {str(e)}',
+                            'error_type': type(e).__name__
+                        })
+                
+                return Response(
+                    stream_with_context(generar_eventos()),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+                )
+            
+            if resultado is None:
                 try:
-                    resultado = analyzer.analizar_estado_cuenta(temp_path, extraer_movimientos_detallados=True)
+                    # Un PDF puede traer varios estados de cuenta (una parte por tarjeta)
+                    resultados = analyzer.analizar_estados_cuenta(
+                        memoryview(pdf_bytes),
+                        extraer_movimientos_detallados=True,
+                        texto_pdf=texto_pdf
+                    )
+                    resultado = PDFAnalyzer.combinar_resultados(resultados, texto_pdf)
+                    completar_tiempos_analisis(resultado, inicio_analisis, duracion_extraccion)
                 except Exception as e:
                     import traceback
                     # Normalizar el mensaje de error para evitar problemas de codificación
@@ -1678,114 +2470,9 @@ def analizar_pdf():
                         'message': f'Error analizando PDF: {error_message}',
                         'error_type': type(e).__name__
                     }), 500
-                
-                # Debug: mostrar el resultado crudo
-                print(f"DEBUG - Resultado crudo: {resultado}")
-                
-                # Estandarizar nombres de banco y tipo de tarjeta ANTES de formatear
-                # IMPORTANTE: Envolver en try-except para evitar que errores de BD dejen la transacción en estado fallido
-                if resultado.get('status') == 'success' and 'data' in resultado:
-                    datos = resultado['data']
-                    try:
-                        if 'nombre_banco' in datos and datos['nombre_banco']:
-                            datos['nombre_banco'] = estandarizar_banco(datos['nombre_banco']) or datos['nombre_banco']
-                    except Exception as e:
-                        print(f"ERROR estandarizando banco: {str(e)}")
-                        # Asegurar rollback si hay error
-                        try:
-                            db.session.rollback()
-                        except:
-                            pass
-                        # Continuar con el nombre original si falla
-                    
-                    try:
-                        if 'tipo_tarjeta' in datos and datos['tipo_tarjeta']:
-                            datos['tipo_tarjeta'] = estandarizar_tipo_tarjeta(datos['tipo_tarjeta']) or datos['tipo_tarjeta']
-                    except Exception as e:
-                        print(f"ERROR estandarizando tipo tarjeta: {str(e)}")
-                        # Asegurar rollback si hay error
-                        try:
-                            db.session.rollback()
-                        except:
-                            pass
-                        # Continuar con el tipo original si falla
-                
-                # Formatear resultados
-                resultado_formateado = analyzer.formatear_resultados(resultado)
-                
-                # Debug: mostrar el resultado formateado
-                print(f"DEBUG - Resultado formateado: {resultado_formateado}")
-                
-                # Registrar el uso de IA solo si fue exitoso
-                if resultado_formateado.get('status') != 'error':
-                    # Asegurar que la transacción esté limpia antes de obtener el usuario
-                    try:
-                        db.session.rollback()  # Limpiar cualquier transacción fallida previa
-                    except:
-                        pass
-                    
-                    usuario_actual = get_current_user()
-                    # Registrar uso de IA (con manejo de errores)
-                    uso_registrado = registrar_uso_ia(usuario_actual.id, 'analisis_pdf')
-                    if uso_registrado:
-                        print(f"DEBUG - Uso de IA registrado para usuario {usuario_actual.id}")
-                    else:
-                        print(f"ADVERTENCIA - No se pudo registrar uso de IA para usuario {usuario_actual.id}")
-                    
-                    # ===== REGISTRAR MÉTRICAS DETALLADAS DE IA =====
-                    # Obtener información de tokens del resultado crudo
-                    raw_response = resultado.get('raw_response', '')
-                    texto_pdf = resultado.get('texto_extraido', '')
-                    
-                    # Estimación más realista de tokens
-                    # Input: texto del PDF (puede ser 10,000+ caracteres)
-                    # Output: respuesta JSON estructurada
-                    try:
-                        tokens_input = len(texto_pdf.split()) * 1.3 if texto_pdf else 0  # Tokens de entrada
-                        tokens_output = len(raw_response.split()) * 1.3 if raw_response else 0  # Tokens de salida
-                        tokens_estimados = int(tokens_input + tokens_output)
-                    except Exception as e:
-                        print(f"ERROR calculando tokens: {str(e)}")
-                        tokens_estimados = 0
-                    
-                    # Precio real de Claude Haiku: $0.25 por 1 MILLÓN de tokens
-                    precio_por_token = 0.25 / 1_000_000  # $0.00000025 por token
-                    costo_estimado = tokens_estimados * precio_por_token
-                    
-                    # Registrar métricas (con manejo de errores)
-                    metrica_registrada = registrar_metrica_ia(
-                        usuario_id=usuario_actual.id,
-                        modelo_ia='claude-haiku-4-5',
-                        tipo_operacion='analisis_pdf',
-                        tokens_consumidos=int(tokens_estimados),
-                        costo_estimado=costo_estimado,
-                        duracion_segundos=2.5  # Tiempo estimado de procesamiento
-                    )
-                    if metrica_registrada:
-                        print(f"DEBUG - Métricas de IA registradas: {int(tokens_estimados)} tokens, ${costo_estimado:.4f}")
-                    else:
-                        print(f"ADVERTENCIA - No se pudieron registrar métricas de IA")
-                    
-                    # Actualizar límites en la sesión (con manejo de errores)
-                    try:
-                        # Asegurar que la transacción esté limpia antes de obtener límites
-                        try:
-                            db.session.rollback()
-                        except:
-                            pass
-                        session['user_limits'] = get_user_limits(usuario_actual.id)
-                    except Exception as e:
-                        print(f"ADVERTENCIA - Error obteniendo límites de usuario: {str(e)}")
-                        # Continuar sin actualizar límites en sesión
-                
-                return jsonify(resultado_formateado)
-                
-            finally:
-                # Limpiar archivo temporal
-                try:
-                    os.unlink(temp_path)
-                except:
-                    pass
+
+            
+            return jsonify(finalizar_analisis_pdf(resultado, hash_pdf, desde_cache))
                     
         except Exception as e:
             import traceback
@@ -1921,12 +2608,8 @@ def api_guardar_estado_cuenta():
     API endpoint para guardar un estado de cuenta analizado con análisis completo
     """
     try:
-        # Asegurar que todas las columnas necesarias existen ANTES de cualquier consulta
-        print("DEBUG api_guardar_estado_cuenta: Verificando columnas necesarias...")
-        ensure_estados_cuenta_columns()
-        ensure_abreviaciones_columns()
-        ensure_consumos_detalle_categoria_503020()
-        print("DEBUG api_guardar_estado_cuenta: Columnas verificadas")
+        # Asegurar que el esquema está al día ANTES de cualquier consulta
+        asegurar_esquema()
         
         # Limpiar transacción antes de continuar
         try:
@@ -1945,6 +2628,32 @@ def api_guardar_estado_cuenta():
         
         datos_analisis = data['datos_analisis']
         archivo_original = data.get('archivo_original', None)
+        
+        # Varios estados de cuenta del mismo PDF: se guardan juntos en una transacción
+        if isinstance(datos_analisis, list):
+            estados_cuenta = guardar_estados_cuenta(
+                usuario_actual.id, datos_analisis, archivo_original,
+                decisiones_duplicados=data.get('decisiones_duplicados')
+            )
+            movimientos_count = sum(
+                ConsumosDetalle.query.filter_by(estado_cuenta_id=estado.id).count() for estado in estados_cuenta
+            )
+            mensaje = f'{len(estados_cuenta)} estados de cuenta guardados exitosamente con {movimientos_count} movimientos detallados'
+            omitidos = len(datos_analisis) - len(estados_cuenta)
+            if omitidos:
+                mensaje += f' ({omitidos} omitido(s) porque ya existían)'
+            return jsonify({
+                'status': 'success',
+                'message': mensaje,
+                'estados_cuenta_ids': [estado.id for estado in estados_cuenta],
+                'banco': estados_cuenta[0].nombre_banco if estados_cuenta else None,
+                'tarjeta': ', '.join(f"{estado.tipo_tarjeta} {estado.ultimos_digitos}" for estado in estados_cuenta),
+                'fecha_corte': estados_cuenta[0].fecha_corte.isoformat() if estados_cuenta and estados_cuenta[0].fecha_corte else None,
+                'movimientos_guardados': movimientos_count,
+                'movimientos_con_error': [
+                    dict(error, estado_cuenta_id=estado.id) for estado in estados_cuenta for error in estado.errores_movimientos
+                ]
+            })
         sobrescribir = data.get('sobrescribir', False)
         estado_cuenta_id_sobrescribir = data.get('estado_cuenta_id_sobrescribir', None)
         
@@ -1978,32 +2687,32 @@ def api_guardar_estado_cuenta():
             'banco': estado_cuenta.nombre_banco,
             'tarjeta': estado_cuenta.tipo_tarjeta,
             'fecha_corte': estado_cuenta.fecha_corte.isoformat() if estado_cuenta.fecha_corte else None,
-            'movimientos_guardados': movimientos_count
+            'movimientos_guardados': movimientos_count,
+            'movimientos_con_error': estado_cuenta.errores_movimientos,
+            'movimientos_sincronizados': estado_cuenta.sincronizacion_movimientos
         })
         
     except EstadoCuentaDuplicadoException as e:
         # Estado de cuenta duplicado - retornar información del existente
-        estado_existente = e.estado_cuenta_existente
-        # Manejar fecha_inicio_periodo de forma segura (puede no existir en BD antigua)
-        fecha_inicio_periodo_str = None
-        try:
-            if hasattr(estado_existente, 'fecha_inicio_periodo') and estado_existente.fecha_inicio_periodo:
-                fecha_inicio_periodo_str = estado_existente.fecha_inicio_periodo.strftime('%d/%m/%Y')
-        except Exception:
-            pass  # Si no existe la columna, simplemente retornar None
-        
         return jsonify({
             'status': 'duplicate',
             'message': e.mensaje,
-            'estado_cuenta_existente': {
-                'id': estado_existente.id,
-                'banco': estado_existente.nombre_banco,
-                'tarjeta': estado_existente.tipo_tarjeta,
-                'fecha_corte': estado_existente.fecha_corte.strftime('%d/%m/%Y') if estado_existente.fecha_corte else None,
-                'fecha_inicio_periodo': fecha_inicio_periodo_str,
-                'ultimos_digitos': estado_existente.ultimos_digitos,
-                'fecha_creacion': estado_existente.fecha_creacion.strftime('%d/%m/%Y %H:%M') if estado_existente.fecha_creacion else None
-            }
+            'estado_cuenta_existente': serializar_estado_cuenta_existente(e.estado_cuenta_existente)
+        })
+        
+    except EstadosCuentaDuplicadosException as e:
+        # Varios estados de cuenta: cada duplicado con su posición, para decidir uno por uno
+        return jsonify({
+            'status': 'duplicate',
+            'message': str(e),
+            'duplicados': [
+                {
+                    'indice': indice,
+                    'message': mensaje,
+                    'estado_cuenta_existente': serializar_estado_cuenta_existente(estado_existente)
+                }
+                for indice, estado_existente, mensaje in e.duplicados
+            ]
         })
         
     except Exception as e:
@@ -2047,6 +2756,10 @@ def admin_dashboard():
         # Estadísticas por herramienta
         herramientas_stats = {}
         for metrica in metricas_herramientas:
+            # Los hits/misses de la caché se muestran aparte (cache_stats)
+            if metrica.herramienta == HERRAMIENTA_CACHE_PDF:
+                continue
+            
             if metrica.herramienta not in herramientas_stats:
                 herramientas_stats[metrica.herramienta] = {
                     'total_clicks': 0,
@@ -2072,19 +2785,38 @@ def admin_dashboard():
                 ia_stats[modelo] = {
                     'total_usos': 0,
                     'total_tokens': 0,
+                    'tokens_entrada': 0,
+                    'tokens_salida': 0,
+                    'tokens_cache_lectura': 0,
                     'costo_total': 0.0,
-                    'tiempo_promedio': 0.0
+                    'tiempo_promedio': 0.0,
+                    'fases': {}  # fase -> [suma_segundos, cantidad] (solo métricas con tiempos medidos)
                 }
             
             ia_stats[modelo]['total_usos'] += 1
             ia_stats[modelo]['total_tokens'] += metrica.tokens_consumidos
+            ia_stats[modelo]['tokens_entrada'] += metrica.tokens_entrada or 0
+            ia_stats[modelo]['tokens_salida'] += metrica.tokens_salida or 0
+            ia_stats[modelo]['tokens_cache_lectura'] += metrica.tokens_cache_lectura or 0
             ia_stats[modelo]['costo_total'] += metrica.costo_estimado
             ia_stats[modelo]['tiempo_promedio'] += metrica.duracion_segundos
+            for fase, duracion in (('Extracción', metrica.duracion_extraccion), ('Preparación', metrica.duracion_preparacion),
+                                   ('Llamada IA', metrica.duracion_llamada_ia), ('Parseo JSON', metrica.duracion_parseo)):
+                if duracion is not None:
+                    acumulado = ia_stats[modelo]['fases'].setdefault(fase, [0.0, 0])
+                    acumulado[0] += duracion
+                    acumulado[1] += 1
         
         # Calcular promedios
         for modelo in ia_stats:
             if ia_stats[modelo]['total_usos'] > 0:
                 ia_stats[modelo]['tiempo_promedio'] = ia_stats[modelo]['tiempo_promedio'] / ia_stats[modelo]['total_usos']
+            ia_stats[modelo]['fases'] = {
+                fase: suma / cantidad for fase, (suma, cantidad) in ia_stats[modelo]['fases'].items()
+            }
+        
+        # Estadísticas de la caché de análisis de PDF
+        cache_stats = obtener_estadisticas_cache_analisis()
         
         return render_template('admin_dashboard.html',
                              usuario=get_current_user(),
@@ -2096,6 +2828,7 @@ def admin_dashboard():
                              usos_ia_hoy=usos_ia_hoy,
                              herramientas_stats=herramientas_stats,
                              ia_stats=ia_stats,
+                             cache_stats=cache_stats,
                              metricas_herramientas=metricas_herramientas[-10:],  # Últimas 10
                              metricas_ia=metricas_ia[-10:]  # Últimas 10
                              )
@@ -2133,11 +2866,10 @@ def admin_bancos():
 def control_pagos_tarjetas():
     """Control de pagos de tarjetas de crédito con filtros dinámicos"""
     try:
-        # Asegurar que la columna existe ANTES de hacer cualquier consulta
+        # Asegurar que el esquema está al día ANTES de hacer cualquier consulta
         print("DEBUG control_pagos_tarjetas: Iniciando...")
         try:
-            ensure_fecha_inicio_periodo_column()
-            print("DEBUG control_pagos_tarjetas: Columna verificada")
+            asegurar_esquema()
         except Exception as col_error:
             print(f"ERROR control_pagos_tarjetas verificando columna: {str(col_error)}")
             import traceback
@@ -2171,10 +2903,10 @@ def control_pagos_tarjetas():
             print(f"ERROR control_pagos_tarjetas creando query: {str(query_error)}")
             import traceback
             print(f"Traceback: {traceback.format_exc()}")
-            # Intentar crear la columna de nuevo y reintentar
+            # Volver a verificar el esquema y reintentar
             try:
-                ensure_fecha_inicio_periodo_column()
                 db.session.rollback()
+                asegurar_esquema(forzar=True)
                 query = EstadosCuenta.query.filter_by(usuario_id=usuario_actual.id)
                 print(f"DEBUG control_pagos_tarjetas: Query creada después de verificar columna")
             except Exception as retry_error:
@@ -3353,68 +4085,13 @@ def test_webhook():
         }), 500
 
 # Función para crear la base de datos y agregar datos de ejemplo
-def ensure_fecha_inicio_periodo_column():
-    """Asegurar que la columna fecha_inicio_periodo existe en la tabla estados_cuenta"""
-    try:
-        # Limpiar transacción antes de empezar
-        try:
-            db.session.rollback()
-        except:
-            pass
-        
-        # Usar column_exists() para verificar si la columna existe
-        if column_exists('estados_cuenta', 'fecha_inicio_periodo'):
-            print("Columna fecha_inicio_periodo ya existe.")
-            # Asegurar que la transacción esté limpia
-            try:
-                db.session.rollback()
-            except:
-                pass
-        else:
-            print("Columna fecha_inicio_periodo no existe, creándola...")
-            try:
-                # Limpiar transacción antes de crear
-                try:
-                    db.session.rollback()
-                except:
-                    pass
-                
-                from sqlalchemy import text
-                db.session.execute(text("ALTER TABLE estados_cuenta ADD COLUMN fecha_inicio_periodo DATE"))
-                db.session.commit()
-                print("✅ Columna fecha_inicio_periodo creada exitosamente")
-                
-                # Limpiar transacción después de crear
-                try:
-                    db.session.rollback()
-                except:
-                    pass
-            except Exception as e:
-                error_msg = str(e).lower()
-                if 'already exists' in error_msg or 'duplicate' in error_msg or 'column' in error_msg and 'already' in error_msg:
-                    print("✅ Columna fecha_inicio_periodo ya existe (detectado por error).")
-                else:
-                    print(f"ERROR: No se pudo crear columna fecha_inicio_periodo: {str(e)}")
-                try:
-                    db.session.rollback()
-                except:
-                    pass
-    except Exception as e:
-        print(f"ADVERTENCIA: Error verificando/creando columna fecha_inicio_periodo: {str(e)}")
-        import traceback
-        print(f"Traceback: {traceback.format_exc()}")
-        try:
-            db.session.rollback()
-        except:
-            pass
-
 def init_db():
     with app.app_context():
         # Crear todas las tablas - Forzar actualización de esquema en producción
         db.create_all()
         
-        # Asegurar que la columna fecha_inicio_periodo existe
-        ensure_fecha_inicio_periodo_column()
+        # Aplicar las migraciones de esquema pendientes
+        migraciones.aplicar_migraciones(db.engine)
         
         # Inicializar bancos y tipos de tarjetas con abreviaciones
         inicializar_bancos_oficiales()
@@ -3484,11 +4161,10 @@ with app.app_context():
         db.create_all()
         print("Base de datos inicializada correctamente")
         
-        # Asegurar que la columna fecha_inicio_periodo existe
-        # IMPORTANTE: Ejecutar ANTES de cualquier consulta
-        print("DEBUG: Verificando/creando columna fecha_inicio_periodo al inicio...")
-        ensure_fecha_inicio_periodo_column()
-        print("DEBUG: Verificación de columna completada")
+        # Aplicar las migraciones de esquema pendientes (normalmente ya aplicadas en el
+        # pre-deploy con python migraciones.py). IMPORTANTE: ANTES de cualquier consulta
+        aplicadas = migraciones.aplicar_migraciones(db.engine)
+        print(f"Esquema de base de datos en la versión {migraciones.VERSION_ACTUAL} (migraciones aplicadas: {aplicadas})")
         
         # Verificar que la tabla existe
         from sqlalchemy import inspect
@@ -3506,7 +4182,7 @@ with app.app_context():
         # Intentar crear las tablas de nuevo
         try:
             db.create_all()
-            ensure_fecha_inicio_periodo_column()
+            migraciones.aplicar_migraciones(db.engine)
             print("Base de datos creada en segundo intento")
         except Exception as e2:
             print(f"Error critico: {e2}")
@@ -3548,538 +4224,268 @@ def delete_transaction(transaction_id):
             'message': f'Error eliminando transacción: {str(e)}'
         }), 500
 
-def column_exists(table_name, column_name):
-    """
-    Verifica si una columna existe en una tabla.
-    Funciona tanto con PostgreSQL como con SQLite.
-    """
-    try:
-        # Limpiar transacción antes de verificar
-        try:
-            db.session.rollback()
-        except:
-            pass
-        
-        # Detectar el tipo de base de datos
-        db_url = str(db.engine.url)
-        
-        if 'postgresql' in db_url.lower():
-            # PostgreSQL: usar information_schema
-            query = text("""
-                SELECT column_name 
-                FROM information_schema.columns 
-                WHERE table_name = :table_name 
-                AND column_name = :column_name
-            """)
-            result = db.session.execute(query, {'table_name': table_name, 'column_name': column_name})
-            exists = result.fetchone() is not None
-            try:
-                db.session.rollback()
-            except:
-                pass
-            return exists
-        else:
-            # SQLite: intentar SELECT directo
-            try:
-                query = text(f"SELECT {column_name} FROM {table_name} LIMIT 1")
-                result = db.session.execute(query)
-                result.fetchone()
-                try:
-                    db.session.rollback()
-                except:
-                    pass
-                return True
-            except Exception:
-                try:
-                    db.session.rollback()
-                except:
-                    pass
-                return False
-    except Exception as e:
-        print(f"Error verificando existencia de columna {table_name}.{column_name}: {e}")
-        try:
-            db.session.rollback()
-        except:
-            pass
-        return False
+# Patrones para identificar cargos de IVA/retenciones
+PATRONES_IVA = [
+    'RET IVA',
+    'IVA DIGITAL',
+    'IVA SERV DIGITAL',
+    'RETENCION IVA',
+    'IVA N/D',
+    'RET IVA SERV'
+]
 
-def ensure_avatar_url_column():
-    """
-    Asegura que la columna avatar_url existe en la tabla usuario.
-    Se ejecuta automáticamente al iniciar la aplicación.
-    """
-    try:
-        with app.app_context():
-            # Limpiar transacción antes de empezar
-            try:
-                db.session.rollback()
-            except:
-                pass
-            
-            # Verificar si la columna existe
-            if column_exists('usuario', 'avatar_url'):
-                print("Columna avatar_url ya existe.")
-            else:
-                # La columna no existe, crearla
-                print("Columna avatar_url no existe. Creándola...")
-                try:
-                    # Limpiar transacción antes de crear
-                    try:
-                        db.session.rollback()
-                    except:
-                        pass
-                    
-                    # Detectar tipo de base de datos
-                    db_url = str(db.engine.url)
-                    if 'postgresql' in db_url.lower():
-                        db.session.execute(text("ALTER TABLE usuario ADD COLUMN avatar_url VARCHAR(200)"))
-                    else:
-                        db.session.execute(text("ALTER TABLE usuario ADD COLUMN avatar_url TEXT"))
-                    
-                    db.session.commit()
-                    print("Columna avatar_url creada exitosamente.")
-                    try:
-                        db.session.rollback()
-                    except:
-                        pass
-                except Exception as e:
-                    error_msg = str(e).lower()
-                    if 'already exists' in error_msg or 'duplicate' in error_msg or 'column' in error_msg and 'already' in error_msg:
-                        print("Columna avatar_url ya existe (detectado por error).")
-                    else:
-                        print(f"Error creando columna avatar_url: {e}")
-                    try:
-                        db.session.rollback()
-                    except:
-                        pass
-    except Exception as e:
-        print(f"Error verificando/creando columna avatar_url: {e}")
-        try:
-            db.session.rollback()
-        except:
-            pass
-        # No fallar la aplicación si hay error, solo loguear
+# Patrones para identificar retención del 10% del IVA digital
+# Nota: El patrón debe ser flexible para capturar variaciones como:
+# "RET IVA SERV DIGITAL 10%", "RET IVA SERV DIGITAL 10", etc.
+PATRONES_RETENCION_10 = [
+    'RET IVA SERV DIGITAL 10',
+    'RETENCION 10% IVA',
+    'RET 10% IVA',
+    'RET IVA 10%',
+    'RET IVA 10',
+    'RET IVA DIGITAL 10'
+]
 
-def ensure_estados_cuenta_columns():
-    """
-    Asegura que las nuevas columnas existen en la tabla estados_cuenta.
-    Se ejecuta automáticamente al iniciar la aplicación.
-    """
-    try:
-        with app.app_context():
-            # Limpiar transacción antes de empezar
-            try:
-                db.session.rollback()
-            except:
-                pass
-            
-            # Verificar y agregar fecha_inicio_periodo
-            if column_exists('estados_cuenta', 'fecha_inicio_periodo'):
-                print("Columna fecha_inicio_periodo ya existe.")
-            else:
-                print("Columna fecha_inicio_periodo no existe. Creándola...")
-                try:
-                    # Limpiar transacción antes de crear
-                    try:
-                        db.session.rollback()
-                    except:
-                        pass
-                    db.session.execute(text("ALTER TABLE estados_cuenta ADD COLUMN fecha_inicio_periodo DATE"))
-                    db.session.commit()
-                    print("Columna fecha_inicio_periodo creada exitosamente.")
-                    try:
-                        db.session.rollback()
-                    except:
-                        pass
-                except Exception as e:
-                    error_msg = str(e).lower()
-                    if 'already exists' in error_msg or 'duplicate' in error_msg or 'column' in error_msg and 'already' in error_msg:
-                        print("Columna fecha_inicio_periodo ya existe (detectado por error).")
-                    else:
-                        print(f"Error creando columna fecha_inicio_periodo: {e}")
-                    try:
-                        db.session.rollback()
-                    except:
-                        pass
-            
-            # Limpiar transacción antes de verificar minimo_a_pagar
-            try:
-                db.session.rollback()
-            except:
-                pass
-            
-            # Verificar y agregar minimo_a_pagar
-            if column_exists('estados_cuenta', 'minimo_a_pagar'):
-                print("Columna minimo_a_pagar ya existe.")
-            else:
-                print("Columna minimo_a_pagar no existe. Creándola...")
-                try:
-                    # Limpiar transacción antes de crear
-                    try:
-                        db.session.rollback()
-                    except:
-                        pass
-                    db.session.execute(text("ALTER TABLE estados_cuenta ADD COLUMN minimo_a_pagar REAL"))
-                    db.session.commit()
-                    print("Columna minimo_a_pagar creada exitosamente.")
-                    try:
-                        db.session.rollback()
-                    except:
-                        pass
-                except Exception as e:
-                    error_msg = str(e).lower()
-                    if 'already exists' in error_msg or 'duplicate' in error_msg or 'column' in error_msg and 'already' in error_msg:
-                        print("Columna minimo_a_pagar ya existe (detectado por error).")
-                    else:
-                        print(f"Error creando columna minimo_a_pagar: {e}")
-                    try:
-                        db.session.rollback()
-                    except:
-                        pass
-    except Exception as e:
-        print(f"Error verificando/creando columnas de estados_cuenta: {e}")
-        try:
-            db.session.rollback()
-        except:
-            pass
-        # No fallar la aplicación si hay error, solo loguear
+# Patrones para identificar cargos de servicios (0.31 + IVA)
+PATRONES_SERVICIOS = [
+    'TARIFA',
+    'COSTO',
+    'FEE',
+    'CARGO SERVICIO'
+]
+
+# Patrones de servicios públicos (consumos que generan el cargo de servicios)
+SERVICIOS_PUBLICOS = [
+    'AGUA', 'LUZ', 'ELECTRICIDAD', 'ENERGIA',
+    'TELEFONO', 'TELEFONIA', 'INTERNET',
+    'MATRICULACION', 'MATRICULA', 'SERVICIOS PUBLICOS'
+]
 
-def ensure_abreviaciones_columns():
+# Cada grupo del índice de montos cubre un 25% (un rango de ±5% cae en uno o dos grupos)
+_LOG_GRUPO_MONTO = math.log(1.25)
+
+class _IndiceMovimientos:
     """
-    Asegura que las columnas de abreviación existen en las tablas de estandarización.
-    Se ejecuta automáticamente al iniciar la aplicación.
+    Movimientos agrupados por monto (grupos logarítmicos) y ordenados por fecha dentro de
+    cada grupo: los de un rango de montos y fechas se obtienen con bisect en unos pocos
+    grupos, sin recorrer toda la lista. Sin agrupar por monto es solo un índice por fecha.
+    
+    Cada entrada es (día ordinal, posición en el estado de cuenta, monto, movimiento).
     """
-    try:
-        with app.app_context():
-            # Limpiar transacción antes de empezar
-            try:
-                db.session.rollback()
-            except:
-                pass
-            
-            # Verificar y agregar abreviacion en banco_estandarizado
-            if column_exists('banco_estandarizado', 'abreviacion'):
-                print("Columna abreviacion ya existe en banco_estandarizado.")
-            else:
-                print("Columna abreviacion no existe en banco_estandarizado. Creándola...")
-                try:
-                    # Limpiar transacción antes de crear
-                    try:
-                        db.session.rollback()
-                    except:
-                        pass
-                    
-                    # Detectar tipo de base de datos
-                    db_url = str(db.engine.url)
-                    if 'postgresql' in db_url.lower():
-                        db.session.execute(text("ALTER TABLE banco_estandarizado ADD COLUMN abreviacion VARCHAR(50)"))
-                    else:
-                        db.session.execute(text("ALTER TABLE banco_estandarizado ADD COLUMN abreviacion TEXT"))
-                    
-                    db.session.commit()
-                    print("Columna abreviacion creada exitosamente en banco_estandarizado.")
-                    try:
-                        db.session.rollback()
-                    except:
-                        pass
-                except Exception as e:
-                    error_msg = str(e).lower()
-                    if 'already exists' in error_msg or 'duplicate' in error_msg or 'column' in error_msg and 'already' in error_msg:
-                        print("Columna abreviacion ya existe en banco_estandarizado (detectado por error).")
-                    else:
-                        print(f"Error creando columna abreviacion en banco_estandarizado: {e}")
-                    try:
-                        db.session.rollback()
-                    except:
-                        pass
-            
-            # Limpiar transacción antes de verificar tipo_tarjeta_estandarizado
-            try:
-                db.session.rollback()
-            except:
-                pass
-            
-            # Verificar y agregar abreviacion en tipo_tarjeta_estandarizado
-            if column_exists('tipo_tarjeta_estandarizado', 'abreviacion'):
-                print("Columna abreviacion ya existe en tipo_tarjeta_estandarizado.")
-            else:
-                print("Columna abreviacion no existe en tipo_tarjeta_estandarizado. Creándola...")
-                try:
-                    # Limpiar transacción antes de crear
-                    try:
-                        db.session.rollback()
-                    except:
-                        pass
-                    
-                    # Detectar tipo de base de datos
-                    db_url = str(db.engine.url)
-                    if 'postgresql' in db_url.lower():
-                        db.session.execute(text("ALTER TABLE tipo_tarjeta_estandarizado ADD COLUMN abreviacion VARCHAR(50)"))
-                    else:
-                        db.session.execute(text("ALTER TABLE tipo_tarjeta_estandarizado ADD COLUMN abreviacion TEXT"))
-                    
-                    db.session.commit()
-                    print("Columna abreviacion creada exitosamente en tipo_tarjeta_estandarizado.")
-                    try:
-                        db.session.rollback()
-                    except:
-                        pass
-                except Exception as e:
-                    error_msg = str(e).lower()
-                    if 'already exists' in error_msg or 'duplicate' in error_msg or 'column' in error_msg and 'already' in error_msg:
-                        print("Columna abreviacion ya existe en tipo_tarjeta_estandarizado (detectado por error).")
-                    else:
-                        print(f"Error creando columna abreviacion en tipo_tarjeta_estandarizado: {e}")
-                    try:
-                        db.session.rollback()
-                    except:
-                        pass
-    except Exception as e:
-        print(f"Error verificando/creando columnas de abreviacion: {e}")
-        try:
-            db.session.rollback()
-        except:
-            pass
-        # No fallar la aplicación si hay error, solo loguear
+    
+    def __init__(self, entradas, por_monto=True):
+        self.por_monto = por_monto
+        self.grupos = {}
+        for entrada in sorted(entradas, key=lambda e: (e[0], e[1])):
+            self.grupos.setdefault(self._grupo(entrada[2]), []).append(entrada)
+        self.dias = {grupo: [entrada[0] for entrada in lista] for grupo, lista in self.grupos.items()}
+    
+    def _grupo(self, monto):
+        return math.floor(math.log(monto) / _LOG_GRUPO_MONTO) if self.por_monto else None
+    
+    def buscar(self, dia_desde, dia_hasta, rangos_monto=None):
+        """Entradas entre los dos días (inclusive) en los grupos que cubren los rangos de monto"""
+        if self.por_monto:
+            grupos = set()
+            for minimo, maximo in rangos_monto:
+                if maximo <= 0:
+                    continue
+                # Margen para el redondeo: la condición exacta la revisa quien llama
+                minimo = max(minimo * (1 - 1e-9), maximo * 1e-12)
+                grupos.update(range(self._grupo(minimo), self._grupo(maximo * (1 + 1e-9)) + 1))
+        else:
+            grupos = [None]
+        for grupo in grupos:
+            lista = self.grupos.get(grupo)
+            if lista:
+                dias = self.dias[grupo]
+                yield from lista[bisect.bisect_left(dias, dia_desde):bisect.bisect_right(dias, dia_hasta)]
 
-def relacionar_cargos_iva_con_consumos(estado_cuenta_id):
+def _primera_entrada(entradas, condicion, orden):
+    """La entrada que cumple la condición y va primero según 'orden' (None si ninguna)"""
+    mejor = None
+    for entrada in entradas:
+        if condicion(entrada) and (mejor is None or orden(entrada) < orden(mejor)):
+            mejor = entrada
+    return mejor[3] if mejor else None
+
+def relacionar_cargos_iva_en_movimientos(movimientos):
     """
     Post-procesamiento inteligente para relacionar cargos de IVA/retenciones 
     con los consumos que los generaron y actualizar su categorización.
     
+    Trabaja en memoria sobre los movimientos del estado de cuenta (dicts con fecha,
+    descripcion, monto, categoria, categoria_503020 y tipo_transaccion, en el orden del
+    estado de cuenta) y los modifica en el lugar, sin consultas: al guardar se llama antes
+    de insertar/sincronizar los movimientos, dentro de la misma transacción. Los consumos
+    se buscan con índices por fecha (bisect) y por grupos de montos: O(n log n).
+    
     Reglas:
     1. Retención IVA Digital (15%): Buscar consumo digital cercano donde cargo_iva ≈ consumo * 0.15
     2. Cargo de servicios (0.31 + 15% IVA = 0.3565): Buscar consumos de servicios públicos cercanos
     3. Actualizar categoria y categoria_503020 del cargo para que coincida con el consumo relacionado
+    Entre varios consumos posibles gana el más cercano en fecha (a igual distancia, el primero).
+    
+    Returns:
+        int: cantidad de cargos relacionados
     """
-    try:
-        # Obtener todos los movimientos del estado de cuenta
-        movimientos = ConsumosDetalle.query.filter_by(
-            estado_cuenta_id=estado_cuenta_id
-        ).order_by(ConsumosDetalle.fecha.asc()).all()
-        
-        if not movimientos:
-            return
+    # Consumos candidatos (positivos y con fecha) y cargos de IVA, con su día y posición
+    consumos = []
+    consumos_servicios = []
+    cargos_iva = []
+    for posicion, movimiento in enumerate(movimientos):
+        if not movimiento['fecha']:
+            continue
+        entrada = (movimiento['fecha'].toordinal(), posicion, movimiento['monto'] or 0, movimiento)
+        descripcion = (movimiento['descripcion'] or '').upper()
+        if movimiento['tipo_transaccion'] == 'consumo':
+            if entrada[2] <= 0:
+                continue
+            consumos.append(entrada)
+            if (any(serv in descripcion for serv in SERVICIOS_PUBLICOS) or
+                    (movimiento['categoria'] or '') in ['Servicios', 'Transporte']):
+                consumos_servicios.append(entrada)
+        elif movimiento['tipo_transaccion'] in ['cargo', 'otro']:
+            # Un IVA con monto <= 0 nunca coincide con el IVA esperado de una retención
+            if entrada[2] > 0 and any(patron in descripcion for patron in PATRONES_IVA):
+                cargos_iva.append(entrada)
+    
+    indice_consumos = _IndiceMovimientos(consumos)
+    indice_servicios = _IndiceMovimientos(consumos_servicios, por_monto=False)
+    indice_cargos_iva = _IndiceMovimientos(cargos_iva)
+    
+    relacionados = 0
+    
+    for posicion, movimiento in enumerate(movimientos):
+        # Solo procesar cargos (no consumos ni pagos)
+        if movimiento['tipo_transaccion'] not in ['cargo', 'otro']:
+            continue
+        
+        descripcion = (movimiento['descripcion'] or '').upper()
+        monto_cargo = movimiento['monto'] or 0
+        
+        # Verificar si es un cargo de IVA/retención
+        es_iva = any(patron in descripcion for patron in PATRONES_IVA)
+        es_retencion_10 = any(patron in descripcion for patron in PATRONES_RETENCION_10)
+        es_servicio = any(patron in descripcion for patron in PATRONES_SERVICIOS)
+        
+        if not (es_iva or es_retencion_10 or es_servicio):
+            continue
+        
+        if not movimiento['fecha']:
+            continue
+        
+        # Buscar en un rango de fechas (hasta 7 días antes o después), por proximidad de fecha
+        dia_cargo = movimiento['fecha'].toordinal()
+        cercania = lambda entrada: (abs(entrada[0] - dia_cargo), entrada[1])
+        
+        def consumo_con_monto(consumo_esperado):
+            """Consumo cercano con monto ≈ consumo_esperado (5% de tolerancia)"""
+            if consumo_esperado <= 0:
+                return None
+            return _primera_entrada(
+                indice_consumos.buscar(dia_cargo - 7, dia_cargo + 7, [(consumo_esperado * 0.95, consumo_esperado * 1.05)]),
+                lambda entrada: abs(entrada[2] - consumo_esperado) / consumo_esperado <= 0.05,
+                cercania
+            )
         
-        # Patrones para identificar cargos de IVA/retenciones
-        patrones_iva = [
-            'RET IVA',
-            'IVA DIGITAL',
-            'IVA SERV DIGITAL',
-            'RETENCION IVA',
-            'IVA N/D',
-            'RET IVA SERV'
-        ]
+        consumo_relacionado = None
+        
+        if es_retencion_10:
+            # Retención del 10% del IVA digital
+            # Ejemplo: Consumo $10.00 → IVA 15% = $1.50 → Retención 10% del IVA = $0.15
+            # Fórmula: retencion_10% = consumo * 0.15 * 0.10 = consumo * 0.015
+            # ESTRATEGIA DE DOBLE NIVEL:
+            # 1. Primero intentar encontrar un cargo de IVA del 15% relacionado (mismo día o
+            #    hasta 2 días de diferencia; el de fecha más temprana)
+            # 2. Si encontramos el IVA, usar ese IVA para encontrar el consumo
+            # 3. Si no encontramos el IVA, calcular directamente desde la retención
+            iva_esperado = monto_cargo / 0.10  # retencion / 0.10 = IVA del 15%
+            cargo_iva_relacionado = None
+            if iva_esperado > 0:
+                cargo_iva_relacionado = _primera_entrada(
+                    indice_cargos_iva.buscar(dia_cargo - 2, dia_cargo + 2, [(iva_esperado * 0.95, iva_esperado * 1.05)]),
+                    lambda entrada: entrada[1] != posicion and abs(entrada[2] - iva_esperado) / iva_esperado <= 0.05,
+                    lambda entrada: (entrada[0], entrada[1])
+                )
+            
+            if cargo_iva_relacionado:
+                consumo_relacionado = consumo_con_monto((cargo_iva_relacionado['monto'] or 0) / 0.15)
+            else:
+                consumo_relacionado = consumo_con_monto(monto_cargo / 0.015)
+        
+        elif es_iva:
+            # Para IVA digital: buscar consumo donde monto_cargo ≈ consumo * 0.15
+            # (o exactamente el 10% en algunos casos), tolerancia del 5% para redondeo
+            def es_iva_del_consumo(entrada):
+                iva_esperado = entrada[2] * 0.15
+                if abs(monto_cargo - iva_esperado) / iva_esperado <= 0.05:
+                    return True
+                iva_10_esperado = entrada[2] * 0.10
+                return abs(monto_cargo - iva_10_esperado) / iva_10_esperado <= 0.05
+            
+            if monto_cargo > 0:
+                consumo_relacionado = _primera_entrada(
+                    indice_consumos.buscar(dia_cargo - 7, dia_cargo + 7, [
+                        (monto_cargo / (0.15 * 1.05), monto_cargo / (0.15 * 0.95)),
+                        (monto_cargo / (0.10 * 1.05), monto_cargo / (0.10 * 0.95))
+                    ]),
+                    es_iva_del_consumo,
+                    cercania
+                )
         
-        # Patrones para identificar retención del 10% del IVA digital
-        # Nota: El patrón debe ser flexible para capturar variaciones como:
-        # "RET IVA SERV DIGITAL 10%", "RET IVA SERV DIGITAL 10", etc.
-        patrones_retencion_10 = [
-            'RET IVA SERV DIGITAL 10',
-            'RETENCION 10% IVA',
-            'RET 10% IVA',
-            'RET IVA 10%',
-            'RET IVA 10',
-            'RET IVA DIGITAL 10'
-        ]
+        elif es_servicio:
+            # Para cargos de servicios: consumo de servicios públicos del mismo día o hasta
+            # 2 días de diferencia. El cargo suele ser 0.31 + (0.31 * 0.15) = 0.3565
+            consumo_relacionado = _primera_entrada(
+                indice_servicios.buscar(dia_cargo - 2, dia_cargo + 2), lambda entrada: True, cercania
+            )
         
-        # Patrones para identificar cargos de servicios (0.31 + IVA)
-        patrones_servicios = [
-            'TARIFA',
-            'COSTO',
-            'FEE',
-            'CARGO SERVICIO'
-        ]
+        # Si encontramos un consumo relacionado, actualizar el cargo
+        if consumo_relacionado:
+            movimiento['categoria'] = consumo_relacionado['categoria']
+            # categoria_503020: la del consumo o, si no tiene, la de su categoría
+            movimiento['categoria_503020'] = (consumo_relacionado['categoria_503020'] or
+                                              mapear_categoria_a_503020(consumo_relacionado['categoria']))
+            relacionados += 1
+            print(f"✅ Relacionado: {(movimiento['descripcion'] or '')[:50]}... (${monto_cargo:.2f}) → {consumo_relacionado['categoria']} ({movimiento['categoria_503020'] or 'N/A'})")
+    
+    if relacionados > 0:
+        print(f"📊 Total de cargos relacionados: {relacionados}")
+    return relacionados
+
+def relacionar_cargos_iva_con_consumos(estado_cuenta_id):
+    """
+    Relaciona los cargos de IVA/retenciones de un estado de cuenta ya guardado (ej.
+    corregir_cargos_iva_existentes.py): lee sus movimientos en una consulta, los relaciona
+    con relacionar_cargos_iva_en_movimientos y actualiza solo los cargos que cambiaron.
+    Al guardar un estado de cuenta no hace falta: se relaciona antes del commit.
+    """
+    try:
+        filas = db.session.execute(
+            db.select(ConsumosDetalle.id, ConsumosDetalle.fecha, ConsumosDetalle.descripcion, ConsumosDetalle.monto,
+                      ConsumosDetalle.categoria, ConsumosDetalle.categoria_503020, ConsumosDetalle.tipo_transaccion)
+            .where(ConsumosDetalle.estado_cuenta_id == estado_cuenta_id)
+            .order_by(ConsumosDetalle.id)
+        ).mappings().all()
+        
+        if not filas:
+            return
         
-        relacionados = 0
+        movimientos = [dict(fila) for fila in filas]
+        relacionados = relacionar_cargos_iva_en_movimientos(movimientos)
         
-        for movimiento in movimientos:
-            # Solo procesar cargos (no consumos ni pagos)
-            if movimiento.tipo_transaccion not in ['cargo', 'otro']:
-                continue
-            
-            descripcion = (movimiento.descripcion or '').upper()
-            monto_cargo = movimiento.monto or 0
-            
-            # Verificar si es un cargo de IVA/retención
-            es_iva = any(patron in descripcion for patron in patrones_iva)
-            es_retencion_10 = any(patron in descripcion for patron in patrones_retencion_10)
-            es_servicio = any(patron in descripcion for patron in patrones_servicios)
-            
-            if not (es_iva or es_retencion_10 or es_servicio):
-                continue
-            
-            # Buscar consumo relacionado
-            consumo_relacionado = None
-            fecha_cargo = movimiento.fecha
-            
-            if not fecha_cargo:
-                continue
-            
-            # Buscar en un rango de fechas (hasta 7 días antes o después)
-            from datetime import timedelta
-            fecha_inicio = fecha_cargo - timedelta(days=7)
-            fecha_fin = fecha_cargo + timedelta(days=7)
-            
-            # Buscar consumos cercanos en fecha
-            # Ordenar por proximidad de fecha (compatible con SQLite y PostgreSQL)
-            consumos_candidatos = ConsumosDetalle.query.filter(
-                ConsumosDetalle.estado_cuenta_id == estado_cuenta_id,
-                ConsumosDetalle.tipo_transaccion == 'consumo',
-                ConsumosDetalle.monto > 0,
-                ConsumosDetalle.fecha >= fecha_inicio,
-                ConsumosDetalle.fecha <= fecha_fin,
-                ConsumosDetalle.id != movimiento.id
-            ).all()
-            
-            # Ordenar por proximidad de fecha (en memoria para compatibilidad)
-            consumos_candidatos = sorted(
-                consumos_candidatos,
-                key=lambda c: abs((c.fecha - fecha_cargo).days) if c.fecha and fecha_cargo else 999
-            )
-            
-            if es_retencion_10:
-                # Retención del 10% del IVA digital
-                # Ejemplo: Consumo $10.00 → IVA 15% = $1.50 → Retención 10% del IVA = $0.15
-                # Fórmula: retencion_10% = consumo * 0.15 * 0.10 = consumo * 0.015
-                # Entonces: consumo = retencion_10% / 0.015
-                
-                # ESTRATEGIA DE DOBLE NIVEL:
-                # 1. Primero intentar encontrar un cargo de IVA del 15% relacionado
-                #    Si retencion_10% = $0.15, entonces IVA_15% debería ser $1.50
-                # 2. Si encontramos el IVA, usar ese IVA para encontrar el consumo
-                # 3. Si no encontramos el IVA, calcular directamente desde la retención
-                
-                iva_esperado_desde_retencion = monto_cargo / 0.10  # retencion / 0.10 = IVA del 15%
-                
-                # Buscar cargo de IVA del 15% cercano
-                cargo_iva_relacionado = None
-                for otro_movimiento in movimientos:
-                    if (otro_movimiento.id == movimiento.id or 
-                        otro_movimiento.tipo_transaccion not in ['cargo', 'otro']):
-                        continue
-                    
-                    otra_desc = (otro_movimiento.descripcion or '').upper()
-                    es_iva_otro = any(patron in otra_desc for patron in patrones_iva)
-                    
-                    if es_iva_otro and otro_movimiento.fecha:
-                        # Verificar si el monto del IVA coincide
-                        monto_iva = otro_movimiento.monto or 0
-                        diferencia_iva = abs(monto_iva - iva_esperado_desde_retencion) / iva_esperado_desde_retencion if iva_esperado_desde_retencion > 0 else 1
-                        
-                        # Verificar proximidad de fecha (mismo día o día siguiente)
-                        diferencia_dias_iva = abs((otro_movimiento.fecha - fecha_cargo).days) if fecha_cargo else 999
-                        
-                        if diferencia_iva <= 0.05 and diferencia_dias_iva <= 2:
-                            cargo_iva_relacionado = otro_movimiento
-                            break
-                
-                # Si encontramos el IVA relacionado, buscar el consumo desde el IVA
-                if cargo_iva_relacionado:
-                    monto_iva = cargo_iva_relacionado.monto or 0
-                    consumo_esperado_desde_iva = monto_iva / 0.15  # IVA / 0.15 = consumo original
-                    
-                    # Buscar consumo que coincida con este cálculo
-                    for consumo in consumos_candidatos:
-                        monto_consumo = consumo.monto or 0
-                        if monto_consumo <= 0:
-                            continue
-                        
-                        diferencia_consumo = abs(monto_consumo - consumo_esperado_desde_iva) / consumo_esperado_desde_iva if consumo_esperado_desde_iva > 0 else 1
-                        
-                        if diferencia_consumo <= 0.05:  # 5% de tolerancia
-                            consumo_relacionado = consumo
-                            break
-                else:
-                    # Si no encontramos el IVA, calcular directamente desde la retención del 10%
-                    consumo_esperado = monto_cargo / 0.015  # retencion_10% / 0.015 = consumo original
-                    
-                    for consumo in consumos_candidatos:
-                        monto_consumo = consumo.monto or 0
-                        if monto_consumo <= 0:
-                            continue
-                        
-                        diferencia_consumo = abs(monto_consumo - consumo_esperado) / consumo_esperado if consumo_esperado > 0 else 1
-                        
-                        if diferencia_consumo <= 0.05:  # 5% de tolerancia
-                            consumo_relacionado = consumo
-                            break
-            
-            elif es_iva:
-                # Para IVA digital: buscar consumo donde monto_cargo ≈ consumo * 0.15
-                # Tolerancia del 5% para diferencias por redondeo
-                for consumo in consumos_candidatos:
-                    monto_consumo = consumo.monto or 0
-                    if monto_consumo <= 0:
-                        continue
-                    
-                    # Calcular IVA esperado (15%)
-                    iva_esperado = monto_consumo * 0.15
-                    
-                    # Verificar si el monto del cargo está dentro del rango esperado (tolerancia 5%)
-                    diferencia_porcentual = abs(monto_cargo - iva_esperado) / iva_esperado if iva_esperado > 0 else 1
-                    
-                    if diferencia_porcentual <= 0.05:  # 5% de tolerancia
-                        consumo_relacionado = consumo
-                        break
-                    
-                    # También verificar si el cargo es exactamente el 10% (algunos casos)
-                    iva_10_esperado = monto_consumo * 0.10
-                    diferencia_10 = abs(monto_cargo - iva_10_esperado) / iva_10_esperado if iva_10_esperado > 0 else 1
-                    if diferencia_10 <= 0.05:
-                        consumo_relacionado = consumo
-                        break
-            
-            elif es_servicio:
-                # Para cargos de servicios: buscar consumo de servicios públicos cercano
-                # El cargo suele ser 0.31 + (0.31 * 0.15) = 0.3565, pero puede variar
-                for consumo in consumos_candidatos:
-                    # Verificar si el consumo es de servicios públicos
-                    desc_consumo = (consumo.descripcion or '').upper()
-                    categoria_consumo = consumo.categoria or ''
-                    
-                    # Patrones de servicios públicos
-                    servicios_publicos = [
-                        'AGUA', 'LUZ', 'ELECTRICIDAD', 'ENERGIA',
-                        'TELEFONO', 'TELEFONIA', 'INTERNET',
-                        'MATRICULACION', 'MATRICULA', 'SERVICIOS PUBLICOS'
-                    ]
-                    
-                    es_servicio_publico = (
-                        any(serv in desc_consumo for serv in servicios_publicos) or
-                        categoria_consumo in ['Servicios', 'Transporte']
-                    )
-                    
-                    if es_servicio_publico:
-                        # Verificar proximidad de fecha (mismo día o día siguiente)
-                        diferencia_dias = abs((consumo.fecha - fecha_cargo).days) if consumo.fecha and fecha_cargo else 999
-                        
-                        if diferencia_dias <= 2:  # Mismo día o hasta 2 días de diferencia
-                            consumo_relacionado = consumo
-                            break
-            
-            # Si encontramos un consumo relacionado, actualizar el cargo
-            if consumo_relacionado:
-                # Actualizar categoría del cargo
-                movimiento.categoria = consumo_relacionado.categoria
-                
-                # Actualizar categoria_503020: si el consumo la tiene, usar la misma
-                # Si no, calcularla basándose en la nueva categoría
-                if consumo_relacionado.categoria_503020:
-                    movimiento.categoria_503020 = consumo_relacionado.categoria_503020
-                else:
-                    # Calcular categoria_503020 basándose en la categoría
-                    movimiento.categoria_503020 = mapear_categoria_a_503020(consumo_relacionado.categoria)
-                
-                relacionados += 1
-                categoria_503020_str = movimiento.categoria_503020 or 'N/A'
-                print(f"✅ Relacionado: {movimiento.descripcion[:50]}... (${movimiento.monto:.2f}) → {consumo_relacionado.categoria} ({categoria_503020_str})")
+        cambios = [
+            {'id': movimiento['id'], 'categoria': movimiento['categoria'], 'categoria_503020': movimiento['categoria_503020']}
+            for movimiento, fila in zip(movimientos, filas)
+            if (movimiento['categoria'], movimiento['categoria_503020']) != (fila['categoria'], fila['categoria_503020'])
+        ]
         
         # Guardar cambios
-        if relacionados > 0:
+        if cambios:
+            db.session.execute(update(ConsumosDetalle), cambios)
             db.session.commit()
-            print(f"📊 Total de cargos relacionados: {relacionados}")
-        else:
+        if not relacionados:
             print("ℹ️ No se encontraron cargos de IVA/retenciones para relacionar")
     
     except Exception as e:
@@ -4135,137 +4541,6 @@ def mapear_categoria_a_503020(categoria):
     
     return mapeo.get(categoria, "Deseo")  # Por defecto "Deseo" si no está en el mapeo
 
-def ensure_consumos_detalle_categoria_503020():
-    """
-    Asegura que la columna categoria_503020 existe en la tabla consumos_detalle.
-    Se ejecuta automáticamente al iniciar la aplicación.
-    """
-    try:
-        with app.app_context():
-            # Limpiar transacción antes de empezar
-            try:
-                db.session.rollback()
-            except:
-                pass
-            
-            if column_exists('consumos_detalle', 'categoria_503020'):
-                print("Columna categoria_503020 ya existe en consumos_detalle.")
-            else:
-                print("Columna categoria_503020 no existe en consumos_detalle. Creándola...")
-                try:
-                    # Limpiar transacción antes de crear
-                    try:
-                        db.session.rollback()
-                    except:
-                        pass
-                    
-                    # Detectar tipo de base de datos
-                    db_url = str(db.engine.url)
-                    if 'postgresql' in db_url.lower():
-                        db.session.execute(text("ALTER TABLE consumos_detalle ADD COLUMN categoria_503020 VARCHAR(20)"))
-                    else:
-                        db.session.execute(text("ALTER TABLE consumos_detalle ADD COLUMN categoria_503020 TEXT"))
-                    
-                    db.session.commit()
-                    print("Columna categoria_503020 creada exitosamente.")
-                    try:
-                        db.session.rollback()
-                    except:
-                        pass
-                except Exception as e:
-                    error_msg = str(e).lower()
-                    if 'already exists' in error_msg or 'duplicate' in error_msg or 'column' in error_msg and 'already' in error_msg:
-                        print("Columna categoria_503020 ya existe en consumos_detalle (detectado por error).")
-                    else:
-                        print(f"Error creando columna categoria_503020: {e}")
-                    try:
-                        db.session.rollback()
-                    except:
-                        pass
-    except Exception as e:
-        print(f"Error verificando/creando columna categoria_503020: {e}")
-        try:
-            db.session.rollback()
-        except:
-            pass
-        # No fallar la aplicación si hay error, solo loguear
-
-def ensure_password_hash_size():
-    """
-    Asegura que la columna password_hash tiene el tamaño correcto (255 caracteres).
-    Se ejecuta automáticamente al iniciar la aplicación.
-    """
-    try:
-        with app.app_context():
-            # Limpiar transacción antes de empezar
-            try:
-                db.session.rollback()
-            except:
-                pass
-            
-            # Verificar el tamaño actual de la columna
-            db_url = str(db.engine.url)
-            if 'postgresql' in db_url.lower():
-                # PostgreSQL: verificar el tamaño actual
-                query = text("""
-                    SELECT character_maximum_length 
-                    FROM information_schema.columns 
-                    WHERE table_name = 'usuario' 
-                    AND column_name = 'password_hash'
-                """)
-                result = db.session.execute(query)
-                row = result.fetchone()
-                try:
-                    db.session.rollback()
-                except:
-                    pass
-                
-                if row and row[0] and row[0] < 255:
-                    # Actualizar el tamaño de la columna
-                    print(f"Columna password_hash tiene tamaño {row[0]}, actualizando a 255...")
-                    try:
-                        db.session.rollback()
-                        db.session.execute(text("ALTER TABLE usuario ALTER COLUMN password_hash TYPE VARCHAR(255)"))
-                        db.session.commit()
-                        print("✅ Columna password_hash actualizada a VARCHAR(255)")
-                        try:
-                            db.session.rollback()
-                        except:
-                            pass
-                    except Exception as e:
-                        error_msg = str(e).lower()
-                        if 'already' in error_msg or 'duplicate' in error_msg:
-                            print("Columna password_hash ya tiene el tamaño correcto.")
-                        else:
-                            print(f"Error actualizando password_hash: {e}")
-                        try:
-                            db.session.rollback()
-                        except:
-                            pass
-                elif row and row[0] and row[0] >= 255:
-                    print("Columna password_hash ya tiene el tamaño correcto.")
-                else:
-                    # La columna no existe o no se pudo verificar, pero no es crítico
-                    print("No se pudo verificar el tamaño de password_hash (puede que no exista aún).")
-    except Exception as e:
-        print(f"Error verificando/actualizando password_hash: {e}")
-        try:
-            db.session.rollback()
-        except:
-            pass
-        # No fallar la aplicación si hay error, solo loguear
-
-# Ejecutar al iniciar la aplicación (solo si hay contexto de aplicación)
-try:
-    ensure_avatar_url_column()
-    ensure_password_hash_size()
-    ensure_fecha_inicio_periodo_column()
-    ensure_estados_cuenta_columns()
-    ensure_abreviaciones_columns()
-    ensure_consumos_detalle_categoria_503020()
-except Exception:
-    pass  # Si no hay contexto aún, se ejecutará después
-
 if __name__ == '__main__':
     # Solo para desarrollo local
     init_db()
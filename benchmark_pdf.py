@@ -0,0 +1,1179 @@
+#!/usr/bin/env python3
+"""
+Benchmarks del pipeline de análisis de PDFs de estados de cuenta.
+No llaman a la API real: usan PDFs sintéticos generados con PyMuPDF.
+
+Uso:
+    python benchmark_pdf.py extraccion [--paginas 200 400] [--workers 4] [--repeticiones 3]
+    python benchmark_pdf.py tablas [--paginas 20]
+    python benchmark_pdf.py parsers [--paginas 5] [--repeticiones 5]
+    python benchmark_pdf.py imagenes [--paginas 6] [--escaneadas 2 4] [--dpi 72 110 150]
+    python benchmark_pdf.py cliente [--peticiones 50] [--latencia 0.02] [--sin-tls]
+    python benchmark_pdf.py cache [--paginas 3] [--analisis 5]
+    python benchmark_pdf.py bloques [--paginas 20] [--ms-por-token 0.2] [--workers 4]
+    python benchmark_pdf.py salida [--paginas 3 10 20] [--api]
+    python benchmark_pdf.py resiliencia [--peticiones 100] [--latencia 0.02]
+    python benchmark_pdf.py pipeline [--grabaciones grabaciones_ia] [--grabar simulado|api] [--corpus DIR]
+                                     [--paginas 3 6 12] [--repeticiones 3]
+    python benchmark_pdf.py guardado [--movimientos 50 500 5000] [--repeticiones 3] [--database-url URL]
+    python benchmark_pdf.py sobrescritura [--movimientos 50 500 5000] [--repeticiones 3] [--database-url URL]
+"""
+
+import argparse
+import io
+import json
+import os
+import random
+import re
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager, redirect_stdout
+from functools import wraps
+from types import SimpleNamespace
+from datetime import date, datetime, timedelta
+
+import fitz  # PyMuPDF
+
+import pdf_analyzer
+from pdf_analyzer import PDFAnalyzer, EXTRACCION_WORKERS, PATRON_FECHA, PATRON_MONTO, estimar_tokens
+
+# ===== GENERACIÓN DE ESTADOS DE CUENTA SINTÉTICOS =====
+
+COMERCIOS = [
+    ('SUPERMAXI EL BOSQUE', 'Alimentación'), ('FYBECA 123', 'Salud'), ('UBER *TRIP', 'Transporte'),
+    ('NETFLIX.COM', 'Entretenimiento'), ('KFC MALL DEL SOL', 'Comida Fuera'), ('PRIMAX GASOLINERA', 'Transporte'),
+    ('DE PRATI QUICENTRO', 'Compras'), ('CNT INTERNET', 'Servicios'), ('SPOTIFY P0123', 'Entretenimiento'),
+    ('CLINICA KENNEDY', 'Salud'), ('AMAZON MKTPLACE', 'Compras'), ('SWEET & COFFEE', 'Comida Fuera'),
+]
+
+CATEGORIAS_COMERCIOS = dict(COMERCIOS)
+
+# Servicios digitales que generan un cargo de IVA (15%) aparte (cargos_iva=True)
+COMERCIOS_DIGITALES = {'NETFLIX.COM', 'SPOTIFY P0123'}
+
+LEGAL = [
+    'Banco Sintético S.A. - Todos los derechos reservados. Consulte términos y condiciones en www.banco.ec',
+    'Este documento es un estado de cuenta referencial. Para reclamos comuníquese al 1800-BANCO.',
+]
+
+
+def generar_estado_sintetico(paginas=50, movimientos_por_pagina=30, semilla=7, paginas_publicidad_cada=10,
+                             dos_columnas=False, banco='BANCO SINTÉTICO S.A.', ultimos_digitos='4321',
+                             cargos_iva=False):
+    """
+    Genera un estado de cuenta de tarjeta de crédito sintético.
+
+    Cada página tiene encabezado y pie repetidos; la primera tiene el resumen y las
+    siguientes la tabla de movimientos (fecha | descripción | monto). Cada
+    'paginas_publicidad_cada' páginas se inserta una página de publicidad sin montos.
+    Con dos_columnas=True cada página de movimientos tiene dos tablas lado a lado y con
+    cargos_iva=True cada consumo digital va seguido de su cargo 'IVA SERV DIGITAL' (15%).
+    El primer movimiento es el pago de la deuda anterior y los totales del resumen
+    cuadran con los movimientos.
+
+    Returns:
+        tuple: (pdf_bytes, movimientos) con la lista de movimientos esperados
+    """
+    rnd = random.Random(semilla)
+    fecha_corte = date(2025, 1, 15)
+    deuda_anterior = 980.15
+    # Columnas (fecha, descripción, monto) de cada tabla de una página de movimientos
+    tablas = [(30, 78, 250), (310, 358, 530)] if dos_columnas else [(50, 120, 480)]
+    filas_por_pagina = min(movimientos_por_pagina, 57)
+
+    # Generar primero los movimientos para poder imprimir el resumen con totales reales
+    paginas_movimientos = [
+        numero for numero in range(2, paginas + 1)
+        if not (paginas_publicidad_cada and numero % paginas_publicidad_cada == 0)
+    ]
+    movimientos = [{
+        'fecha': (fecha_corte - timedelta(days=20)).strftime('%d/%m/%Y'), 'descripcion': 'PAGO RECIBIDO GRACIAS',
+        'monto': deuda_anterior, 'categoria': 'Otros', 'tipo_transaccion': 'pago'
+    }] if paginas_movimientos else []
+    total_movimientos = len(paginas_movimientos) * filas_por_pagina * len(tablas)
+    while len(movimientos) < total_movimientos:
+        descripcion, categoria = rnd.choice(COMERCIOS)
+        fecha = fecha_corte - timedelta(days=rnd.randint(0, 29))
+        monto = round(rnd.uniform(1, 250), 2)
+        movimientos.append({
+            'fecha': fecha.strftime('%d/%m/%Y'), 'descripcion': descripcion,
+            'monto': monto, 'categoria': categoria, 'tipo_transaccion': 'consumo'
+        })
+        if cargos_iva and descripcion in COMERCIOS_DIGITALES:
+            movimientos.append({
+                'fecha': fecha.strftime('%d/%m/%Y'), 'descripcion': f'IVA SERV DIGITAL {descripcion}',
+                'monto': round(monto * 0.15, 2), 'categoria': 'Otros', 'tipo_transaccion': 'cargo'
+            })
+    del movimientos[total_movimientos:]
+
+    consumos = round(sum(m['monto'] for m in movimientos if m['tipo_transaccion'] != 'pago'), 2)
+    pagos = round(sum(m['monto'] for m in movimientos if m['tipo_transaccion'] == 'pago'), 2)
+    total_pagar = round(deuda_anterior + consumos - pagos, 2)
+    cupo_autorizado = max(5000.0, (total_pagar // 1000 + 5) * 1000)
+
+    doc = fitz.open()
+    pendientes = iter(movimientos)
+    for numero in range(1, paginas + 1):
+        page = doc.new_page()
+        y = 50
+
+        def linea(texto, x=50, tamano=9):
+            nonlocal y
+            page.insert_text((x, y), texto, fontsize=tamano)
+
+        linea(f'{banco} - ESTADO DE CUENTA TARJETA VISA', tamano=11)
+        y += 14
+        linea(f'Tarjeta XXXX XXXX XXXX {ultimos_digitos}      Fecha de corte: 15/01/2025')
+        y += 22
+
+        if numero == 1:
+            resumen = [
+                ('Fecha de inicio del periodo', '16/12/2024'), ('Fecha máxima de pago', '30/01/2025'),
+                ('Cupo autorizado', f'{cupo_autorizado:,.2f}'), ('Cupo disponible', f'{cupo_autorizado - total_pagar:,.2f}'),
+                ('Deuda anterior', f'{deuda_anterior:,.2f}'), ('Consumos y débitos', f'{consumos:,.2f}'),
+                ('Pagos y créditos', f'{pagos:,.2f}'), ('Pago mínimo', f'{round(total_pagar * 0.05, 2):,.2f}'),
+                ('Total a pagar', f'{total_pagar:,.2f}'),
+            ]
+            for etiqueta, valor in resumen:
+                linea(etiqueta)
+                linea(valor, x=400)
+                y += 13
+        elif numero not in paginas_movimientos:
+            for _ in range(12):
+                linea('¡Acumula millas con tu tarjeta! Promoción válida hasta agotar stock.')
+                y += 14
+        else:
+            tamano = 8 if dos_columnas else 9
+            for _ in range(filas_por_pagina):
+                for x_fecha, x_descripcion, x_monto in tablas:
+                    movimiento = next(pendientes)
+                    signo = '-' if movimiento['tipo_transaccion'] == 'pago' else ''
+                    linea(movimiento['fecha'], x=x_fecha, tamano=tamano)
+                    linea(movimiento['descripcion'], x=x_descripcion, tamano=tamano)
+                    linea(f"{movimiento['monto']:,.2f}{signo}", x=x_monto, tamano=tamano)
+                y += 12
+
+        y = 800
+        for texto_legal in LEGAL:
+            linea(texto_legal, tamano=6)
+            y += 8
+        linea(f'Página {numero} de {paginas}', x=500, tamano=6)
+
+    pdf_bytes = doc.tobytes()
+    doc.close()
+    return pdf_bytes, movimientos
+
+
+def escanear_paginas(pdf_bytes, paginas_escaneadas, dpi=150):
+    """
+    Simula un PDF escaneado: reemplaza las páginas indicadas (desde 1) por una imagen
+    de sí mismas, sin capa de texto
+    """
+    origen = fitz.open(stream=pdf_bytes, filetype='pdf')
+    doc = fitz.open()
+    for numero, page in enumerate(origen, start=1):
+        if numero in paginas_escaneadas:
+            pixmap = page.get_pixmap(dpi=dpi)
+            nueva = doc.new_page(width=page.rect.width, height=page.rect.height)
+            nueva.insert_image(nueva.rect, pixmap=pixmap)
+        else:
+            doc.insert_pdf(origen, from_page=numero - 1, to_page=numero - 1)
+    resultado = doc.tobytes()
+    doc.close()
+    origen.close()
+    return resultado
+
+
+class ClienteIAFalso:
+    """
+    Cliente con la interfaz de Anthropic (client.messages.create) que no hace llamadas
+    de red: guarda cada petición y responde un JSON fijo. Simula el caché de prompts:
+    un bloque system con cache_control se "escribe" la primera vez y se "lee" después
+    (tokens estimados con estimar_tokens), solo si el prefijo hasta ese bloque alcanza
+    el mínimo cacheable del modelo (como la API: si no, son tokens de entrada normales)
+    """
+
+    def __init__(self, datos=None):
+        self.peticiones = []
+        self.datos = datos or {'fecha_corte': '15/01/2025', 'movimientos_detallados': []}
+        self.messages = self
+        self.cache = set()
+
+    def create(self, **kwargs):
+        self.peticiones.append(kwargs)
+        texto = json.dumps(self.datos)
+
+        input_tokens = cache_lectura = cache_escritura = 0
+        prefijo = []
+        for bloque in kwargs.get('system') or []:
+            prefijo.append(bloque['text'])
+            tokens = estimar_tokens(bloque['text'])
+            if 'cache_control' not in bloque or estimar_tokens(''.join(prefijo)) < pdf_analyzer.MIN_TOKENS_CACHE_PROMPT:
+                input_tokens += tokens
+            elif bloque['text'] in self.cache:
+                cache_lectura += tokens
+            else:
+                self.cache.add(bloque['text'])
+                cache_escritura += tokens
+        for mensaje in kwargs.get('messages', []):
+            contenido = mensaje['content']
+            bloques = contenido if isinstance(contenido, list) else [{'type': 'text', 'text': contenido}]
+            input_tokens += sum(estimar_tokens(b['text']) for b in bloques if b['type'] == 'text')
+
+        return SimpleNamespace(
+            content=[SimpleNamespace(text=texto)],
+            usage=SimpleNamespace(input_tokens=input_tokens, output_tokens=estimar_tokens(texto),
+                                  cache_read_input_tokens=cache_lectura,
+                                  cache_creation_input_tokens=cache_escritura),
+            stop_reason='end_turn'
+        )
+
+
+def json_respuesta(datos, compacto=False, sangria=None):
+    """
+    JSON de respuesta como lo escribiría la IA: con objetos por movimiento o en el
+    formato compacto (un arreglo por movimiento, una línea cada uno)
+    """
+    if not compacto:
+        return json.dumps(datos, ensure_ascii=False, indent=sangria)
+    resumen = {k: v for k, v in datos.items() if k != 'movimientos_detallados'}
+    resumen['movimientos_columnas'] = pdf_analyzer.COLUMNAS_MOVIMIENTOS
+    filas = ",\n".join(
+        json.dumps([m.get(columna) for columna in pdf_analyzer.COLUMNAS_MOVIMIENTOS], ensure_ascii=False)
+        for m in datos['movimientos_detallados']
+    )
+    return json.dumps(resumen, ensure_ascii=False)[:-1] + ',"movimientos_detallados":[\n' + filas + '\n]}'
+
+
+class ClienteIAGenerador:
+    """
+    Cliente simulado para el análisis por bloques: responde con los movimientos de las
+    filas fecha|descripción|monto del mensaje, sin las de contexto repetidas del bloque
+    anterior (o el resumen dado, si se pide solo el resumen; 'resumen' puede ser una
+    función del contenido del mensaje). La duración es proporcional a los tokens de salida y una respuesta que
+    supera max_tokens se corta, como en la API. Si el último mensaje es del asistente
+    (prefill de una continuación) responde solo lo que sigue a ese texto.
+    """
+
+    def __init__(self, resumen, segundos_por_token=0.0002):
+        self.resumen = resumen
+        self.segundos_por_token = segundos_por_token
+        self.messages = self
+        self.lock = threading.Lock()
+        self.peticiones = 0
+        self.segundos_totales = 0.0
+        self.tokens_salida = 0
+
+    def create(self, **kwargs):
+        contenido = kwargs['messages'][0]['content']
+        resumen = self.resumen(contenido) if callable(self.resumen) else self.resumen
+        if pdf_analyzer.NOTA_SOLO_RESUMEN in contenido:
+            datos = dict(resumen, movimientos_detallados=[])
+        else:
+            movimientos = []
+            contexto = False
+            for linea in contenido.split('\n'):
+                if linea in (pdf_analyzer.MARCA_CONTEXTO_INICIO, pdf_analyzer.MARCA_CONTEXTO_FIN):
+                    contexto = linea == pdf_analyzer.MARCA_CONTEXTO_INICIO
+                    continue
+                if contexto:
+                    continue
+                celdas = linea.split('|')
+                if len(celdas) >= 3 and PATRON_FECHA.match(celdas[0]):
+                    monto = celdas[2]
+                    tipo = 'pago' if monto.endswith('-') else 'cargo' if celdas[1].startswith('IVA ') else 'consumo'
+                    movimientos.append({
+                        'fecha': celdas[0], 'descripcion': celdas[1],
+                        'monto': float(monto.rstrip('-').replace(',', '')),
+                        'categoria': CATEGORIAS_COMERCIOS.get(celdas[1], 'Otros'), 'tipo_transaccion': tipo
+                    })
+            datos = dict(resumen, movimientos_detallados=movimientos)
+
+        texto = json_respuesta(datos, compacto='movimientos_columnas' in kwargs['system'][0]['text'])
+        if kwargs['messages'][-1]['role'] == 'assistant':
+            texto = texto[len(kwargs['messages'][-1]['content']):]
+        tokens = estimar_tokens(texto)
+        stop_reason = 'end_turn'
+        if tokens > kwargs['max_tokens']:
+            texto = texto[:len(texto) * kwargs['max_tokens'] // tokens]
+            tokens = kwargs['max_tokens']
+            stop_reason = 'max_tokens'
+
+        duracion = tokens * self.segundos_por_token
+        time.sleep(duracion)
+        with self.lock:
+            self.peticiones += 1
+            self.segundos_totales += duracion
+            self.tokens_salida += tokens
+        return SimpleNamespace(
+            content=[SimpleNamespace(text=texto)],
+            usage=SimpleNamespace(input_tokens=estimar_tokens(contenido), output_tokens=tokens),
+            stop_reason=stop_reason
+        )
+
+
+def crear_analizador_local():
+    """PDFAnalyzer sin cliente de IA: los benchmarks solo usan las etapas locales"""
+    return PDFAnalyzer.__new__(PDFAnalyzer)
+
+
+def medir(funcion, repeticiones):
+    """Ejecuta la función varias veces y retorna (mejor_tiempo, último_resultado)"""
+    mejor = None
+    resultado = None
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        resultado = funcion()
+        duracion = time.perf_counter() - inicio
+        mejor = duracion if mejor is None else min(mejor, duracion)
+    return mejor, resultado
+
+
+# ===== BENCHMARKS =====
+
+def benchmark_extraccion(args):
+    """Extracción en serie vs. en paralelo (pool de procesos) sobre PDFs sintéticos"""
+    analyzer = crear_analizador_local()
+    workers = args.workers
+
+    print(f"Workers del pool: {workers}")
+    print(f"{'Páginas':>8} {'Serie (s)':>10} {'Paralelo (s)':>13} {'Aceleración':>12} {'Idéntico':>9}")
+
+    # Calentar el pool para no medir el arranque de los procesos
+    pdf_calentamiento, _ = generar_estado_sintetico(paginas=60)
+    inicio = time.perf_counter()
+    analyzer.extraer_texto_pdf(pdf_calentamiento, workers=workers)
+    print(f"(arranque del pool: {time.perf_counter() - inicio:.2f}s, no incluido)")
+
+    for paginas in args.paginas:
+        pdf_bytes, _ = generar_estado_sintetico(paginas=paginas)
+        t_serie, texto_serie = medir(lambda: analyzer.extraer_texto_pdf(pdf_bytes, workers=1), args.repeticiones)
+        t_paralelo, texto_paralelo = medir(lambda: analyzer.extraer_texto_pdf(pdf_bytes, workers=workers), args.repeticiones)
+        identico = 'SI' if texto_serie == texto_paralelo else 'NO'
+        print(f"{paginas:>8} {t_serie:>10.3f} {t_paralelo:>13.3f} {t_serie / t_paralelo:>11.2f}x {identico:>9}")
+
+
+def contar_filas_texto_libre(texto):
+    """
+    Filas de movimientos reconocibles en el texto libre de page.get_text(): líneas que
+    empiezan con una fecha y tienen un monto en la misma línea o en las dos siguientes
+    """
+    lineas = [l.strip() for l in texto.split('\n') if l.strip()]
+    filas = 0
+    for indice, linea in enumerate(lineas):
+        if PATRON_FECHA.match(linea) and any(PATRON_MONTO.search(l) for l in lineas[indice:indice + 3]):
+            filas += 1
+    return filas
+
+
+def benchmark_tablas(args):
+    """Filas de movimientos y tokens: texto libre (actual) vs. tablas reconstruidas por coordenadas"""
+    analyzer = crear_analizador_local()
+
+    print(f"{'Diseño':<14} {'Esperadas':>9} {'Texto libre':>12} {'Tablas':>7} {'Montos OK':>10} "
+          f"{'Tokens libre':>13} {'Tokens tablas':>14}")
+    for nombre, dos_columnas in (('una columna', False), ('dos columnas', True)):
+        pdf_bytes, movimientos = generar_estado_sintetico(paginas=args.paginas, dos_columnas=dos_columnas)
+        texto_libre, _ = PDFAnalyzer.minimizar_texto_prompt(analyzer.extraer_texto_pdf(pdf_bytes, workers=1))
+        tablas = analyzer.extraer_tablas_pdf(pdf_bytes)
+
+        # Cada fila debe conservar su propio monto (no mezclado con la tabla vecina)
+        montos_esperados = sorted(f"{m['monto']:,.2f}" for m in movimientos)
+        montos_filas = sorted(fila.split('|')[-1].rstrip('-') for fila in tablas['filas'])
+        montos_ok = 'SI' if montos_esperados == montos_filas else 'NO'
+
+        print(f"{nombre:<14} {len(movimientos):>9} {contar_filas_texto_libre(texto_libre):>12} "
+              f"{len(tablas['filas']):>7} {montos_ok:>10} {estimar_tokens(texto_libre):>13} "
+              f"{estimar_tokens(tablas['texto']):>14}")
+
+
+def benchmark_parsers(args):
+    """Parser local de los bancos conocidos: reconocimiento, cuadre de totales y tiempo del parseo local"""
+    from parsers_bancos import analizar_con_parsers_locales
+
+    analyzer = crear_analizador_local()
+    encabezados = [
+        'BANCO PICHINCHA C.A.', 'BANCO GUAYAQUIL S.A.', 'PRODUBANCO S.A.', 'DINERS CLUB DEL ECUADOR',
+        'BANCO DEL PACÍFICO S.A.', 'BANCO SINTÉTICO S.A.'
+    ]
+
+    print(f"{'Encabezado':<26} {'Parser':<20} {'Movimientos':>11} {'Esperados':>9} {'Local (ms)':>11}")
+    for encabezado in encabezados:
+        pdf_bytes, movimientos = generar_estado_sintetico(paginas=args.paginas, banco=encabezado)
+        texto_pdf = analyzer.extraer_texto_pdf(pdf_bytes, workers=1)
+
+        def parsear():
+            return analizar_con_parsers_locales(texto_pdf, analyzer.extraer_tablas_pdf(pdf_bytes))
+
+        duracion, resultado = medir(parsear, args.repeticiones)
+        if resultado:
+            nombre_parser, datos = resultado
+            encontrados = len(datos['movimientos_detallados'])
+        else:
+            nombre_parser, encontrados = '(IA)', 0
+        print(f"{encabezado:<26} {nombre_parser:<20} {encontrados:>11} {len(movimientos):>9} {duracion * 1000:>11.1f}")
+
+
+def benchmark_imagenes(args):
+    """Respaldo de páginas escaneadas: qué páginas van como imagen y el tamaño del payload por DPI"""
+    pdf_original, _ = generar_estado_sintetico(paginas=args.paginas)
+    pdf_bytes = escanear_paginas(pdf_original, set(args.escaneadas))
+
+    print(f"Páginas: {args.paginas}, escaneadas: {args.escaneadas}")
+    print(f"{'DPI':>5} {'Imágenes':>9} {'Bytes imágenes':>15} {'Bloques texto':>14} {'Páginas imagen':>15} {'Tiempo (s)':>11}")
+    for dpi in args.dpi:
+        cliente = ClienteIAFalso()
+        analyzer = PDFAnalyzer(client=cliente)
+        original_dpi = pdf_analyzer.IMAGENES_DPI
+        pdf_analyzer.IMAGENES_DPI = dpi
+        try:
+            inicio = time.perf_counter()
+            resultado = analyzer.analizar_estado_cuenta(pdf_bytes)
+            duracion = time.perf_counter() - inicio
+        finally:
+            pdf_analyzer.IMAGENES_DPI = original_dpi
+
+        contenido = cliente.peticiones[-1]['messages'][0]['content']
+        bloques = contenido if isinstance(contenido, list) else [{'type': 'text', 'text': contenido}]
+        imagenes = [b for b in bloques if b['type'] == 'image']
+        bytes_imagenes = sum(len(b['source']['data']) * 3 // 4 for b in imagenes)
+        print(f"{dpi:>5} {len(imagenes):>9} {bytes_imagenes:>15} {len(bloques) - len(imagenes):>14} "
+              f"{str(resultado.get('paginas_imagen')):>15} {duracion:>11.3f}")
+
+
+def benchmark_cache(args):
+    """
+    Caché de prompts: tokens de entrada por análisis con las instrucciones fijas en un
+    bloque system cacheable vs. sin caché (cliente IA simulado, precios de Claude Haiku 4.5:
+    entrada $1/M, escritura al caché 1.25x, lectura del caché 0.1x). Mientras las
+    instrucciones no alcancen MIN_TOKENS_CACHE_PROMPT ambos modos cuestan lo mismo
+    """
+    pdf_bytes, _ = generar_estado_sintetico(paginas=args.paginas)
+    precio = 1.0 / 1_000_000
+
+    tokens_instrucciones = estimar_tokens(pdf_analyzer.INSTRUCCIONES_ANALISIS)
+    print(f"Instrucciones fijas: ~{tokens_instrucciones} tokens estimados "
+          f"(mínimo cacheable del modelo: {pdf_analyzer.MIN_TOKENS_CACHE_PROMPT})")
+    if tokens_instrucciones < pdf_analyzer.MIN_TOKENS_CACHE_PROMPT:
+        print("El bloque no alcanza el mínimo: la API ignora la marca de caché y no hay ahorro")
+    print(f"{'Modo':<10} {'Análisis':>9} {'Entrada':>9} {'Caché escr.':>12} {'Caché lect.':>12} {'Costo entrada ($)':>18}")
+    original = pdf_analyzer.CACHE_PROMPT, pdf_analyzer.PARSERS_LOCALES
+    pdf_analyzer.PARSERS_LOCALES = False  # Siempre llamar a la IA
+    try:
+        for modo, cache in (('sin caché', False), ('con caché', True)):
+            pdf_analyzer.CACHE_PROMPT = cache
+            analyzer = PDFAnalyzer(client=ClienteIAFalso())
+            totales = {'input_tokens': 0, 'cache_creation_input_tokens': 0, 'cache_read_input_tokens': 0}
+            for _ in range(args.analisis):
+                uso = analyzer.analizar_estado_cuenta(pdf_bytes)['uso_tokens']
+                for clave in totales:
+                    totales[clave] += uso[clave]
+            costo = (totales['input_tokens'] + totales['cache_creation_input_tokens'] * 1.25
+                     + totales['cache_read_input_tokens'] * 0.1) * precio
+            print(f"{modo:<10} {args.analisis:>9} {totales['input_tokens']:>9} "
+                  f"{totales['cache_creation_input_tokens']:>12} {totales['cache_read_input_tokens']:>12} {costo:>18.5f}")
+    finally:
+        pdf_analyzer.CACHE_PROMPT, pdf_analyzer.PARSERS_LOCALES = original
+
+
+def benchmark_bloques(args):
+    """
+    Estado de cuenta largo: una sola petición (se corta en max_tokens; sin y con
+    continuaciones) vs. resumen y bloques de movimientos en paralelo (cliente IA
+    simulado con tiempo por token)
+    """
+    pdf_bytes, movimientos = generar_estado_sintetico(paginas=args.paginas)
+    consumos = round(sum(m['monto'] for m in movimientos if m['tipo_transaccion'] == 'consumo'), 2)
+    pagos = round(sum(m['monto'] for m in movimientos if m['tipo_transaccion'] == 'pago'), 2)
+    resumen = {'fecha_corte': '15/01/2025', 'consumos_debitos': consumos, 'pagos_creditos': pagos}
+
+    print(f"Páginas: {args.paginas}, movimientos esperados: {len(movimientos)}, "
+          f"{args.ms_por_token} ms por token de salida, {args.workers} peticiones simultáneas")
+    print(f"{'Modo':<24} {'Estado':<8} {'Peticiones':>10} {'Movimientos':>12} "
+          f"{'Cuadra':>7} {'Tokens salida':>14} {'Suma IA (s)':>12} {'Total (s)':>10}")
+    originales = (pdf_analyzer.ANALISIS_BLOQUES, pdf_analyzer.BLOQUES_WORKERS, pdf_analyzer.PARSERS_LOCALES,
+                  pdf_analyzer.MAX_CONTINUACIONES)
+    pdf_analyzer.PARSERS_LOCALES = False  # Siempre llamar a la IA
+    pdf_analyzer.BLOQUES_WORKERS = args.workers
+    modos = (('una petición', False, 0), ('una petición + continuar', False, originales[3]),
+             ('por bloques', True, originales[3]))
+    try:
+        for modo, bloques, continuaciones in modos:
+            pdf_analyzer.ANALISIS_BLOQUES = bloques
+            pdf_analyzer.MAX_CONTINUACIONES = continuaciones
+            cliente = ClienteIAGenerador(resumen, args.ms_por_token / 1000)
+            analyzer = PDFAnalyzer(client=cliente)
+            inicio = time.perf_counter()
+            resultado = analyzer.analizar_estado_cuenta(pdf_bytes)
+            duracion = time.perf_counter() - inicio
+
+            extraidos = resultado.get('data', {}).get('movimientos_detallados', [])
+            conciliacion = resultado.get('conciliacion') or {}
+            cuadra = 'SI' if conciliacion.get('cuadra_cargos') and conciliacion.get('cuadra_pagos') else 'NO'
+            print(f"{modo:<24} {resultado['status']:<8} {cliente.peticiones:>10} {len(extraidos):>12} "
+                  f"{cuadra:>7} {cliente.tokens_salida:>14} "
+                  f"{cliente.segundos_totales:>12.2f} {duracion:>10.2f}")
+    finally:
+        (pdf_analyzer.ANALISIS_BLOQUES, pdf_analyzer.BLOQUES_WORKERS, pdf_analyzer.PARSERS_LOCALES,
+         pdf_analyzer.MAX_CONTINUACIONES) = originales
+
+
+def benchmark_salida(args):
+    """
+    Tokens de salida de la respuesta: movimientos como objetos (formato anterior, con y
+    sin sangría) vs. formato compacto por columnas, sobre los estados de cuenta
+    sintéticos. Con --api se cuentan con messages.count_tokens (tokenizador real);
+    si no, con estimar_tokens. También verifica que el formato compacto se expande
+    a los mismos movimientos.
+    """
+    analyzer = crear_analizador_local()
+    contexto = {'texto_pdf': '', 'tablas': None, 'imagenes': [], 'minimizacion': None,
+                'paginas_imagen_omitidas': [], 'extraer_movimientos_detallados': True}
+    uso_vacio = {'input_tokens': 0, 'output_tokens': 0, 'cache_read_input_tokens': 0, 'cache_creation_input_tokens': 0}
+
+    contar = estimar_tokens
+    if args.api:
+        cliente = pdf_analyzer.obtener_cliente_anthropic()
+
+        def contar(texto):
+            # Tokens del mensaje menos los de un mensaje mínimo (encabezado del turno)
+            def tokens(contenido):
+                return cliente.messages.count_tokens(
+                    model='claude-haiku-4-5', messages=[{'role': 'user', 'content': contenido}]
+                ).input_tokens
+            return tokens(texto) - tokens('.') + 1
+
+    print(f"Conteo: {'messages.count_tokens' if args.api else 'estimar_tokens (~4 caracteres por token)'}")
+    print(f"{'Páginas':>8} {'Movimientos':>12} {'Objetos sangría':>16} {'Objetos':>8} {'Compacto':>9} "
+          f"{'Ahorro':>7} {'Expande OK':>11}")
+    for paginas in args.paginas:
+        _, movimientos = generar_estado_sintetico(paginas=paginas)
+        datos = {'fecha_corte': '15/01/2025', 'nombre_banco': 'BANCO SINTÉTICO S.A.', 'tipo_tarjeta': 'VISA',
+                 'ultimos_digitos': '4321', 'movimientos_detallados': movimientos}
+
+        con_sangria = contar(json_respuesta(datos, sangria=4))
+        objetos = contar(json_respuesta(datos))
+        texto_compacto = json_respuesta(datos, compacto=True)
+        compacto = contar(texto_compacto)
+
+        expandidos = analyzer._procesar_respuesta(texto_compacto, uso_vacio, contexto)['data']['movimientos_detallados']
+        expande_ok = 'SI' if expandidos == [PDFAnalyzer.validar_movimiento(m) for m in movimientos] else 'NO'
+        print(f"{paginas:>8} {len(movimientos):>12} {con_sangria:>16} {objetos:>8} {compacto:>9} "
+              f"{1 - compacto / con_sangria:>7.0%} {expande_ok:>11}")
+
+
+def benchmark_cliente(args):
+    """
+    Costo por petición del cliente de Anthropic contra un servidor local (HTTPS por defecto):
+    antes se creaba un cliente nuevo en cada request (load_dotenv + conexión + handshake
+    TLS); ahora se reutiliza el cliente compartido con conexiones keep-alive
+    """
+    from anthropic import DefaultHttpxClient
+    from dotenv import load_dotenv
+    from servidor_ia_local import ServidorIALocal
+    from pdf_analyzer import crear_cliente_anthropic
+
+    def llamar(cliente):
+        cliente.messages.create(
+            model='claude-haiku-4-5', max_tokens=16,
+            messages=[{'role': 'user', 'content': 'hola'}]
+        )
+
+    with ServidorIALocal(latencia=args.latencia, tls=not args.sin_tls) as servidor:
+        def http_client():
+            return DefaultHttpxClient(verify=servidor.certificado) if servidor.certificado else None
+
+        def cliente_nuevo():
+            return crear_cliente_anthropic('clave-local', base_url=servidor.url, http_client=http_client())
+
+        print(f"Servidor local: {servidor.url} (latencia simulada {args.latencia * 1000:.0f} ms)")
+        print(f"{'Modo':<28} {'ms/petición':>12} {'Preparación (ms)':>17} {'Conexiones':>11}")
+
+        # Antes: PDFAnalyzer() por request -> load_dotenv + cliente nuevo
+        conexiones_inicio = servidor.conexiones
+        preparacion = 0.0
+        inicio = time.perf_counter()
+        for _ in range(args.peticiones):
+            t0 = time.perf_counter()
+            load_dotenv()
+            cliente = cliente_nuevo()
+            preparacion += time.perf_counter() - t0
+            llamar(cliente)
+            cliente.close()
+        total = time.perf_counter() - inicio
+        print(f"{'Cliente por petición':<28} {total / args.peticiones * 1000:>12.2f} "
+              f"{preparacion / args.peticiones * 1000:>17.2f} {servidor.conexiones - conexiones_inicio:>11}")
+
+        # Ahora: un cliente compartido por el proceso
+        conexiones_inicio = servidor.conexiones
+        t0 = time.perf_counter()
+        cliente = cliente_nuevo()
+        preparacion = time.perf_counter() - t0
+        inicio = time.perf_counter()
+        for _ in range(args.peticiones):
+            llamar(cliente)
+        total = time.perf_counter() - inicio + preparacion
+        print(f"{'Cliente compartido':<28} {total / args.peticiones * 1000:>12.2f} "
+              f"{preparacion / args.peticiones * 1000:>17.2f} {servidor.conexiones - conexiones_inicio:>11}")
+        cliente.close()
+
+
+def benchmark_resiliencia(args):
+    """
+    llamar_ia_resiliente contra el servidor local con fallos y latencia inyectados:
+    sobrecarga intermitente (529), cola de latencia lenta (hedging), proveedor caído
+    (circuit breaker) y un proveedor más lento que el plazo. 'Directo' es
+    messages.create sin reintentos, como antes
+    """
+    from servidor_ia_local import ServidorIALocal, respuesta_error, respuesta_mensaje
+    from pdf_analyzer import CircuitoIA, crear_cliente_anthropic, llamar_ia_resiliente, _crear_mensaje
+
+    peticion = {'model': 'claude-haiku-4-5', 'max_tokens': 16, 'messages': [{'role': 'user', 'content': 'hola'}]}
+    aleatorio = random.Random(7)
+    contador = {'n': 0}
+
+    def sobrecarga_intermitente(cuerpo):
+        contador['n'] += 1
+        return respuesta_error(529) if contador['n'] % 3 else respuesta_mensaje('{}')
+
+    def cola_lenta(cuerpo):
+        return dict(respuesta_mensaje('{}'), _latencia=0.5 if aleatorio.random() < 0.05 else 0.0)
+
+    def caido(cuerpo):
+        return respuesta_error(500, 'api_error', 'Internal server error')
+
+    def muy_lento(cuerpo):
+        return dict(respuesta_mensaje('{}'), _latencia=2.0)
+
+    escenarios = [
+        ('sobrecarga 529 (2 de 3)', sobrecarga_intermitente, args.peticiones,
+         [('directo', None), ('reintentos', {})]),
+        ('cola lenta (5% 500ms)', cola_lenta, args.peticiones,
+         [('reintentos', {}), ('reintentos + hedging', {'hedging': True})]),
+        ('proveedor caído (500)', caido, 20,
+         [('sin circuito', {'circuito': CircuitoIA(fallos_maximos=10 ** 6)}), ('circuit breaker', {})]),
+        ('más lento que el plazo', muy_lento, 3, [('plazo 0.5s', {'segundos_plazo': 0.5})]),
+    ]
+
+    originales = pdf_analyzer.IA_BACKOFF_BASE_SEGUNDOS, pdf_analyzer.IA_MAX_REINTENTOS
+    pdf_analyzer.IA_BACKOFF_BASE_SEGUNDOS = 0.05  # Backoff corto para que el benchmark sea rápido
+    pdf_analyzer.IA_MAX_REINTENTOS = 3
+    print(f"Backoff base {pdf_analyzer.IA_BACKOFF_BASE_SEGUNDOS}s, {pdf_analyzer.IA_MAX_REINTENTOS} reintentos, "
+          f"latencia base {args.latencia * 1000:.0f} ms")
+    print(f"{'Escenario':<24} {'Modo':<22} {'OK':>8} {'p50 (ms)':>9} {'p95 (ms)':>9} {'Media (ms)':>10} {'Máx (ms)':>9} {'Peticiones':>11}")
+    try:
+        for nombre, responder, llamadas, modos in escenarios:
+            for modo, opciones in modos:
+                aleatorio.seed(7)
+                with ServidorIALocal(latencia=args.latencia, responder=responder) as servidor:
+                    cliente = crear_cliente_anthropic('clave-local', base_url=servidor.url)
+                    if opciones is not None:
+                        opciones = dict(opciones)
+                        opciones.setdefault('circuito', CircuitoIA())
+                        segundos_plazo = opciones.pop('segundos_plazo', 30)
+                    duraciones = []
+                    exitos = 0
+                    for _ in range(llamadas):
+                        inicio = time.perf_counter()
+                        try:
+                            if opciones is None:
+                                _crear_mensaje(cliente, peticion, 30)
+                            else:
+                                llamar_ia_resiliente(cliente, peticion, plazo=time.monotonic() + segundos_plazo,
+                                                     **opciones)
+                            exitos += 1
+                        except Exception:
+                            pass
+                        duraciones.append((time.perf_counter() - inicio) * 1000)
+                    time.sleep(0.6)  # Que terminen las peticiones de cobertura pendientes
+                    duraciones.sort()
+                    p95 = duraciones[min(len(duraciones) - 1, int(len(duraciones) * 0.95))]
+                    print(f"{nombre:<24} {modo:<22} {f'{exitos}/{llamadas}':>8} {duraciones[len(duraciones) // 2]:>9.1f} "
+                          f"{p95:>9.1f} {sum(duraciones) / len(duraciones):>10.1f} {duraciones[-1]:>9.1f} {len(servidor.peticiones):>11}")
+                    cliente.close()
+    finally:
+        pdf_analyzer.IA_BACKOFF_BASE_SEGUNDOS, pdf_analyzer.IA_MAX_REINTENTOS = originales
+
+
+def movimientos_sinteticos(cantidad, semilla=7, invalidos_cada=100):
+    """Movimientos como los del análisis; cada 'invalidos_cada' uno sin monto (se reporta, no se guarda)"""
+    rnd = random.Random(semilla)
+    movimientos = []
+    for indice in range(cantidad):
+        descripcion, categoria = rnd.choice(COMERCIOS)
+        movimientos.append({
+            'fecha': (date(2025, 1, 15) - timedelta(days=rnd.randint(0, 29))).strftime('%d/%m/%Y'),
+            'descripcion': descripcion, 'categoria': categoria, 'tipo_transaccion': 'consumo',
+            'monto': None if invalidos_cada and indice % invalidos_cada == invalidos_cada - 1 else round(rnd.uniform(1, 250), 2)
+        })
+    return movimientos
+
+
+def benchmark_guardado(args):
+    """
+    Guardado de los movimientos de un estado de cuenta (ConsumosDetalle): un objeto del
+    ORM y un strptime por movimiento (antes) vs. validar y convertir todo primero e
+    insertar en una sola sentencia (preparar_movimientos_detallados). Mide el INSERT y
+    el commit, y cuenta las sentencias enviadas a la base. SQLite temporal por defecto;
+    --database-url para medir contra PostgreSQL.
+    """
+    from sqlalchemy import event
+
+    aplicacion, directorio_db = importar_app(args.database_url)
+    db, ConsumosDetalle, EstadosCuenta = aplicacion.db, aplicacion.ConsumosDetalle, aplicacion.EstadosCuenta
+
+    def por_fila(estado_cuenta_id, movimientos):
+        guardados = 0
+        for movimiento_data in movimientos:
+            try:
+                fecha_movimiento = None
+                if movimiento_data.get('fecha'):
+                    try:
+                        fecha_movimiento = datetime.strptime(movimiento_data['fecha'], '%d/%m/%Y').date()
+                    except ValueError:
+                        pass
+                categoria = movimiento_data.get('categoria', 'Otros')
+                tipo_transaccion = movimiento_data.get('tipo_transaccion', 'otro')
+                monto = movimiento_data.get('monto', 0)
+                categoria_503020 = None
+                if tipo_transaccion == 'consumo' and monto > 0:
+                    categoria_503020 = aplicacion.mapear_categoria_a_503020(categoria)
+                db.session.add(ConsumosDetalle(
+                    estado_cuenta_id=estado_cuenta_id, fecha=fecha_movimiento,
+                    descripcion=movimiento_data.get('descripcion', ''), monto=monto, categoria=categoria,
+                    categoria_503020=categoria_503020, tipo_transaccion=tipo_transaccion
+                ))
+                guardados += 1
+            except Exception:
+                continue
+        return guardados, len(movimientos) - guardados
+
+    def en_bloque(estado_cuenta_id, movimientos):
+        filas, errores = aplicacion.preparar_movimientos_detallados(estado_cuenta_id, movimientos)
+        db.session.execute(aplicacion.insert(ConsumosDetalle), filas)
+        return len(filas), len(errores)
+
+    sentencias = {'n': 0}
+    filas_reporte = []
+    try:
+        with aplicacion.app.app_context(), redirect_stdout(io.StringIO()):
+            db.create_all()
+            motor = db.engine
+
+            def contar(*_):
+                sentencias['n'] += 1
+            event.listen(motor, 'before_cursor_execute', contar)
+
+            for cantidad in args.movimientos:
+                movimientos = movimientos_sinteticos(cantidad)
+                for modo, guardar in (('por fila (ORM)', por_fila), ('en bloque', en_bloque)):
+                    mejor = None
+                    for _ in range(args.repeticiones):
+                        estado = EstadosCuenta(usuario_id=1, archivo_original='benchmark-guardado')
+                        db.session.add(estado)
+                        db.session.flush()
+                        sentencias['n'] = 0
+                        inicio = time.perf_counter()
+                        guardados, con_error = guardar(estado.id, movimientos)
+                        db.session.commit()
+                        duracion = time.perf_counter() - inicio
+                        ejecutadas = sentencias['n']
+                        mejor = duracion if mejor is None else min(mejor, duracion)
+                        ConsumosDetalle.query.filter_by(estado_cuenta_id=estado.id).delete()
+                        db.session.delete(estado)
+                        db.session.commit()
+                    filas_reporte.append((cantidad, modo, guardados, con_error, ejecutadas, mejor))
+            event.remove(motor, 'before_cursor_execute', contar)
+    finally:
+        if directorio_db:
+            shutil.rmtree(directorio_db, ignore_errors=True)
+
+    print(f"Base de datos: {'SQLite temporal' if directorio_db else args.database_url.split('@')[-1]}")
+    print(f"{'Movimientos':>11} {'Modo':<18} {'Guardados':>10} {'Con error':>10} {'Sentencias':>11} {'Mejor (ms)':>11} {'ms/1000 mov.':>13}")
+    for cantidad, modo, guardados, con_error, ejecutadas, mejor in filas_reporte:
+        print(f"{cantidad:>11} {modo:<18} {guardados:>10} {con_error:>10} {ejecutadas:>11} "
+              f"{mejor * 1000:>11.1f} {mejor * 1000 / cantidad * 1000:>13.1f}")
+
+
+def benchmark_sobrescritura(args):
+    """
+    Sobrescritura de un estado de cuenta ya guardado con una versión corregida (algunos
+    movimientos agregados, quitados o con otra descripción): borrar todos los movimientos
+    y reinsertarlos (antes) vs. sincronizar solo las diferencias por huella
+    (sincronizar_movimientos_detallados). Cuenta las sentencias y las filas escritas.
+    """
+    from sqlalchemy import event
+
+    aplicacion, directorio_db = importar_app(args.database_url)
+    db, ConsumosDetalle, EstadosCuenta = aplicacion.db, aplicacion.ConsumosDetalle, aplicacion.EstadosCuenta
+
+    def borrar_y_reinsertar(estado_cuenta_id, filas):
+        eliminados = ConsumosDetalle.query.filter_by(estado_cuenta_id=estado_cuenta_id).delete()
+        db.session.execute(aplicacion.insert(ConsumosDetalle), filas)
+        return eliminados + len(filas)
+
+    def por_diferencias(estado_cuenta_id, filas):
+        resumen = aplicacion.sincronizar_movimientos_detallados(estado_cuenta_id, filas)
+        return resumen['insertados'] + resumen['actualizados'] + resumen['eliminados']
+
+    sentencias = {'n': 0}
+    filas_reporte = []
+    try:
+        with aplicacion.app.app_context(), redirect_stdout(io.StringIO()):
+            db.create_all()
+            motor = db.engine
+
+            def contar(*_):
+                sentencias['n'] += 1
+
+            for cantidad in args.movimientos:
+                originales = movimientos_sinteticos(cantidad, invalidos_cada=0)
+                # Versión corregida: ~1% de los movimientos cambian
+                cambios = max(1, cantidad // 100)
+                corregidos = [dict(m) for m in originales[cambios:]]
+                for movimiento in corregidos[:cambios]:
+                    movimiento['descripcion'] = movimiento['descripcion'].lower()
+                corregidos += movimientos_sinteticos(cambios, semilla=99, invalidos_cada=0)
+
+                for modo, sobrescribir in (('borrar y reinsertar', borrar_y_reinsertar), ('por diferencias', por_diferencias)):
+                    mejor = None
+                    for _ in range(args.repeticiones):
+                        estado = EstadosCuenta(usuario_id=1, archivo_original='benchmark-sobrescritura')
+                        db.session.add(estado)
+                        db.session.flush()
+                        filas, _ = aplicacion.preparar_movimientos_detallados(estado.id, originales)
+                        db.session.execute(aplicacion.insert(ConsumosDetalle), filas)
+                        db.session.commit()
+
+                        nuevas, _ = aplicacion.preparar_movimientos_detallados(estado.id, corregidos)
+                        event.listen(motor, 'before_cursor_execute', contar)
+                        sentencias['n'] = 0
+                        inicio = time.perf_counter()
+                        escritas = sobrescribir(estado.id, nuevas)
+                        db.session.commit()
+                        duracion = time.perf_counter() - inicio
+                        event.remove(motor, 'before_cursor_execute', contar)
+                        ejecutadas = sentencias['n']
+                        mejor = duracion if mejor is None else min(mejor, duracion)
+
+                        ConsumosDetalle.query.filter_by(estado_cuenta_id=estado.id).delete()
+                        db.session.delete(estado)
+                        db.session.commit()
+                    filas_reporte.append((cantidad, modo, escritas, ejecutadas, mejor))
+    finally:
+        if directorio_db:
+            shutil.rmtree(directorio_db, ignore_errors=True)
+
+    print(f"Base de datos: {'SQLite temporal' if directorio_db else args.database_url.split('@')[-1]}")
+    print(f"{'Movimientos':>11} {'Modo':<20} {'Filas escritas':>15} {'Sentencias':>11} {'Mejor (ms)':>11}")
+    for cantidad, modo, escritas, ejecutadas, mejor in filas_reporte:
+        print(f"{cantidad:>11} {modo:<20} {escritas:>15} {ejecutadas:>11} {mejor * 1000:>11.1f}")
+
+
+class MedidorEtapas:
+    """
+    Tiempo y memoria por etapa del pipeline. Las etapas se anidan (la clave incluye las
+    etapas que la contienen, p. ej. 'guardar/relacionar_iva') y se suman por documento.
+    Con memoria=True mide con tracemalloc el pico y lo que queda asignado al terminar
+    cada etapa (tracemalloc hace todo más lento: no medir tiempos en esa pasada)
+    """
+
+    def __init__(self, memoria=False):
+        self.reiniciar(memoria)
+
+    def reiniciar(self, memoria=False):
+        self.memoria = memoria
+        self.orden = []
+        self.documentos = defaultdict(list)
+        self.pila = []
+        self.documento = {}
+
+    @contextmanager
+    def etapa(self, nombre):
+        clave = f"{self.pila[-1]['clave']}/{nombre}" if self.pila else nombre
+        if clave not in self.orden:
+            self.orden.append(clave)
+        marco = {'clave': clave}
+        if self.memoria:
+            actual, pico = tracemalloc.get_traced_memory()
+            for padre in self.pila:
+                padre['pico'] = max(padre['pico'], pico)
+            tracemalloc.reset_peak()
+            marco.update(memoria_inicio=actual, pico=actual)
+        self.pila.append(marco)
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            duracion = time.perf_counter() - inicio
+            self.pila.pop()
+            medida = self.documento.setdefault(clave, {'segundos': 0.0, 'pico': 0, 'neto': 0})
+            medida['segundos'] += duracion
+            if self.memoria:
+                actual, pico = tracemalloc.get_traced_memory()
+                medida['pico'] = max(medida['pico'], max(marco['pico'], pico) - marco['memoria_inicio'])
+                medida['neto'] += actual - marco['memoria_inicio']
+
+    def envolver(self, nombre, funcion):
+        """La función medida como la etapa 'nombre' en cada llamada"""
+        @wraps(funcion)
+        def medida(*args, **kwargs):
+            with self.etapa(nombre):
+                return funcion(*args, **kwargs)
+        return medida
+
+    def cerrar_documento(self, descartar=False):
+        if not descartar:
+            for clave, medida in self.documento.items():
+                self.documentos[clave].append(medida)
+        self.documento = {}
+
+
+def importar_app(database_url=None):
+    """
+    Importa app.py contra una base de datos de benchmark: la indicada o una SQLite
+    temporal (nunca la base configurada en el entorno). Retorna (módulo, directorio
+    temporal o None)
+    """
+    directorio_db = None
+    if not database_url:
+        directorio_db = tempfile.mkdtemp(prefix='benchmark_app_')
+        database_url = f"sqlite:///{os.path.join(directorio_db, 'benchmark.db')}"
+    os.environ['DATABASE_URL'] = database_url
+    with redirect_stdout(io.StringIO()):
+        import app as aplicacion
+    return aplicacion, directorio_db
+
+
+def corpus_pipeline(args):
+    """PDFs del corpus (--corpus DIR) o estados de cuenta sintéticos con cargos de IVA"""
+    if args.corpus:
+        nombres = sorted(n for n in os.listdir(args.corpus) if n.lower().endswith('.pdf'))
+        corpus = []
+        for nombre in nombres:
+            with open(os.path.join(args.corpus, nombre), 'rb') as archivo:
+                corpus.append((nombre, archivo.read()))
+        return corpus
+    return [
+        (f'sintetico_{paginas}p_{indice}.pdf',
+         generar_estado_sintetico(paginas=paginas, semilla=indice, ultimos_digitos=f'55{indice:02d}', cargos_iva=True)[0])
+        for indice, paginas in enumerate(args.paginas)
+    ]
+
+
+def resumen_sintetico(contenido):
+    """Resumen que respondería la IA para un estado de cuenta sintético (tarjeta del encabezado)"""
+    texto = contenido if isinstance(contenido, str) else ' '.join(b.get('text', '') for b in contenido)
+    digitos = re.search(r'XXXX (\d{4})', texto)
+    return {'nombre_banco': 'BANCO SINTÉTICO S.A.', 'tipo_tarjeta': 'VISA', 'fecha_corte': '15/01/2025',
+            'fecha_inicio_periodo': '16/12/2024', 'fecha_pago': '30/01/2025',
+            'ultimos_digitos': digitos.group(1)[-3:] if digitos else '321'}
+
+
+def benchmark_pipeline(args):
+    """
+    Pipeline completo por documento con respuestas de IA grabadas (cliente_ia_grabado):
+    POST /analizar-pdf (extracción, preparación, llamada, parseo del JSON, estandarización)
+    y POST /api/guardar-estado-cuenta (estandarización, inserción, relación de cargos de
+    IVA), con una base SQLite temporal. Reporta latencia por etapa (mediana y p95 por
+    documento) y, en una pasada aparte con tracemalloc, el pico y el neto de memoria.
+    Sin --grabar la ejecución es offline y determinista; una petición sin grabación es
+    un error. Con --grabar se graban las que falten (con el cliente simulado o la API).
+    """
+    from cliente_ia_grabado import ClienteIAGrabado
+
+    os.environ.setdefault('ANTHROPIC_API_KEY', 'respuestas-grabadas')  # La ruta exige que exista
+    aplicacion, directorio_db = importar_app()
+
+    if args.grabar == 'api':
+        cliente_real = pdf_analyzer.obtener_cliente_anthropic()
+    elif args.grabar == 'simulado':
+        cliente_real = ClienteIAGenerador(resumen_sintetico, 0)
+    else:
+        cliente_real = None
+    cliente = ClienteIAGrabado(args.grabaciones, modo='auto' if args.grabar else 'reproducir', cliente=cliente_real)
+    corpus = corpus_pipeline(args)
+
+    medidor = MedidorEtapas()
+    analyzer = PDFAnalyzer(client=cliente)
+    analyzer.extraer_texto_pdf = medidor.envolver('extraccion', analyzer.extraer_texto_pdf)
+    analyzer.analizar_estados_cuenta = medidor.envolver('analisis', analyzer.analizar_estados_cuenta)
+    analyzer._procesar_respuesta = medidor.envolver('parseo_json', analyzer._procesar_respuesta)
+    cliente.create = medidor.envolver('llamada_ia', cliente.create)
+    aplicacion.obtener_analizador = lambda: analyzer
+    for nombre, etapa in (('estandarizar_banco', 'estandarizacion'), ('estandarizar_tipo_tarjeta', 'estandarizacion'),
+                          ('guardar_estado_cuenta', 'guardar_estado_cuenta'), ('guardar_estados_cuenta', 'guardar_estado_cuenta'),
+                          ('relacionar_cargos_iva_en_movimientos', 'relacionar_iva')):
+        setattr(aplicacion, nombre, medidor.envolver(etapa, getattr(aplicacion, nombre)))
+
+    originales = pdf_analyzer.BLOQUES_WORKERS, pdf_analyzer.PARSERS_LOCALES
+    pdf_analyzer.BLOQUES_WORKERS = 1  # Etapas en serie: los tiempos anidados suman
+    pdf_analyzer.PARSERS_LOCALES = False  # Siempre pasar por la IA (grabada)
+    with aplicacion.app.app_context(), redirect_stdout(io.StringIO()):
+        aplicacion.db.create_all()
+        usuario = aplicacion.Usuario(email='benchmark@pipeline.local', nombre='Benchmark', is_admin=True,
+                                     daily_ai_limit=10 ** 6)
+        aplicacion.db.session.add(usuario)
+        aplicacion.db.session.commit()
+        usuario_id = usuario.id
+
+    def ejecutar(repeticiones):
+        """Cada repetición parte de la base vacía (sin caché de análisis)"""
+        errores = []
+        guardados = relacionados = 0
+        http = aplicacion.app.test_client()
+        with http.session_transaction() as sesion:
+            sesion['user_id'] = usuario_id
+        for _ in range(repeticiones):
+            with aplicacion.app.app_context():
+                for modelo in (aplicacion.ConsumosDetalle, aplicacion.EstadosCuenta, aplicacion.CacheAnalisisPDF,
+                               aplicacion.UsoIA, aplicacion.MetricasIA):
+                    modelo.query.delete()
+                aplicacion.db.session.commit()
+            for nombre, pdf_bytes in corpus:
+                with medidor.etapa('analizar-pdf'):
+                    respuesta = http.post('/analizar-pdf', data={
+                        'pdf_file': (io.BytesIO(pdf_bytes), nombre), 'ignorar_duplicado': '1'
+                    }, content_type='multipart/form-data').get_json()
+                if respuesta.get('status') != 'success':
+                    errores.append(f"{nombre}: {respuesta.get('message')}")
+                    medidor.cerrar_documento(descartar=True)
+                    continue
+                with medidor.etapa('guardar'):
+                    guardado = http.post('/api/guardar-estado-cuenta', json={
+                        'datos_analisis': respuesta['data'], 'archivo_original': nombre
+                    }).get_json()
+                if guardado.get('status') != 'success':
+                    errores.append(f"{nombre}: {guardado.get('message')}")
+                guardados += guardado.get('movimientos_guardados', 0)
+                medidor.cerrar_documento()
+            with aplicacion.app.app_context():
+                relacionados = aplicacion.ConsumosDetalle.query.filter(
+                    aplicacion.ConsumosDetalle.tipo_transaccion == 'cargo',
+                    aplicacion.ConsumosDetalle.categoria != 'Otros'
+                ).count()
+        return errores, guardados, relacionados
+
+    try:
+        with redirect_stdout(io.StringIO()):
+            errores, guardados, relacionados = ejecutar(args.repeticiones)
+        orden, tiempos = medidor.orden, medidor.documentos
+        medidor.reiniciar(memoria=True)
+        if not errores:
+            tracemalloc.start()
+            try:
+                with redirect_stdout(io.StringIO()):
+                    errores, _, _ = ejecutar(1)
+            finally:
+                tracemalloc.stop()
+        memoria = medidor.documentos
+    finally:
+        pdf_analyzer.BLOQUES_WORKERS, pdf_analyzer.PARSERS_LOCALES = originales
+        if directorio_db:
+            shutil.rmtree(directorio_db, ignore_errors=True)
+
+    if errores:
+        print(f"{len(errores)} documentos con error:")
+        for error in errores[:10]:
+            print(f"  {error}")
+        if cliente.modo == 'reproducir':
+            print(f"Faltan grabaciones en {args.grabaciones}: ejecutar con --grabar simulado (o --grabar api)")
+        return
+
+    print(f"Documentos: {len(corpus)} x {args.repeticiones} repeticiones, movimientos guardados por repetición: "
+          f"{guardados // args.repeticiones}, cargos de IVA relacionados: {relacionados}")
+    print(f"Respuestas de IA: {cliente.reproducidas} reproducidas, {cliente.grabadas} grabadas ({args.grabaciones})")
+    print(f"{'Etapa (por documento)':<32} {'Mediana (ms)':>13} {'p95 (ms)':>9} {'Pico memoria (KB)':>18} {'Neto (KB)':>10}")
+    for clave in orden:
+        medidas = sorted(m['segundos'] * 1000 for m in tiempos[clave])
+        picos = [m['pico'] for m in memoria.get(clave, [])]
+        netos = [m['neto'] for m in memoria.get(clave, [])]
+        etiqueta = '  ' * clave.count('/') + clave.rsplit('/', 1)[-1]
+        p95 = medidas[min(len(medidas) - 1, int(len(medidas) * 0.95))]
+        print(f"{etiqueta:<32} {medidas[len(medidas) // 2]:>13.1f} {p95:>9.1f} "
+              f"{max(picos, default=0) / 1024:>18.0f} {sum(netos) / max(len(netos), 1) / 1024:>10.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks del análisis de PDFs')
+    subparsers = parser.add_subparsers(dest='comando', required=True)
+
+    p_extraccion = subparsers.add_parser('extraccion', help='Extracción de texto en serie vs. en paralelo')
+    p_extraccion.add_argument('--paginas', type=int, nargs='+', default=[100, 200, 400])
+    p_extraccion.add_argument('--workers', type=int, default=max(2, EXTRACCION_WORKERS))
+    p_extraccion.add_argument('--repeticiones', type=int, default=3)
+    p_extraccion.set_defaults(funcion=benchmark_extraccion)
+
+    p_tablas = subparsers.add_parser('tablas', help='Filas de movimientos: texto libre vs. tablas por coordenadas')
+    p_tablas.add_argument('--paginas', type=int, default=20)
+    p_tablas.set_defaults(funcion=benchmark_tablas)
+
+    p_parsers = subparsers.add_parser('parsers', help='Parsers locales por banco (sin IA)')
+    p_parsers.add_argument('--paginas', type=int, default=5)
+    p_parsers.add_argument('--repeticiones', type=int, default=5)
+    p_parsers.set_defaults(funcion=benchmark_parsers)
+
+    p_imagenes = subparsers.add_parser('imagenes', help='Páginas escaneadas enviadas como imagen (cliente IA simulado)')
+    p_imagenes.add_argument('--paginas', type=int, default=6)
+    p_imagenes.add_argument('--escaneadas', type=int, nargs='+', default=[2, 4])
+    p_imagenes.add_argument('--dpi', type=int, nargs='+', default=[72, 110, 150])
+    p_imagenes.set_defaults(funcion=benchmark_imagenes)
+
+    p_cliente = subparsers.add_parser('cliente', help='Cliente por petición vs. cliente compartido (servidor local)')
+    p_cliente.add_argument('--peticiones', type=int, default=50)
+    p_cliente.add_argument('--latencia', type=float, default=0.02)
+    p_cliente.add_argument('--sin-tls', action='store_true')
+    p_cliente.set_defaults(funcion=benchmark_cliente)
+
+    p_cache = subparsers.add_parser('cache', help='Caché de prompts de las instrucciones fijas (cliente IA simulado)')
+    p_cache.add_argument('--paginas', type=int, default=3)
+    p_cache.add_argument('--analisis', type=int, default=5)
+    p_cache.set_defaults(funcion=benchmark_cache)
+
+    p_bloques = subparsers.add_parser('bloques', help='Estado de cuenta largo: una petición vs. bloques en paralelo')
+    p_bloques.add_argument('--paginas', type=int, default=20)
+    p_bloques.add_argument('--ms-por-token', type=float, default=0.2)
+    p_bloques.add_argument('--workers', type=int, default=4)
+    p_bloques.set_defaults(funcion=benchmark_bloques)
+
+    p_salida = subparsers.add_parser('salida', help='Tokens de salida: movimientos como objetos vs. formato compacto')
+    p_salida.add_argument('--paginas', type=int, nargs='+', default=[3, 10, 20])
+    p_salida.add_argument('--api', action='store_true', help='Contar con messages.count_tokens (requiere ANTHROPIC_API_KEY)')
+    p_salida.set_defaults(funcion=benchmark_salida)
+
+    p_resiliencia = subparsers.add_parser('resiliencia', help='Reintentos, hedging, circuit breaker y plazo (servidor local con fallos)')
+    p_resiliencia.add_argument('--peticiones', type=int, default=100)
+    p_resiliencia.add_argument('--latencia', type=float, default=0.02)
+    p_resiliencia.set_defaults(funcion=benchmark_resiliencia)
+
+    p_pipeline = subparsers.add_parser('pipeline', help='Pipeline completo (análisis, guardado, IVA) con respuestas de IA grabadas')
+    p_pipeline.add_argument('--grabaciones', default='grabaciones_ia', help='Directorio de las respuestas grabadas')
+    p_pipeline.add_argument('--grabar', choices=['simulado', 'api'],
+                            help='Grabar las respuestas que falten (cliente simulado o API real)')
+    p_pipeline.add_argument('--corpus', help='Directorio con PDFs (por defecto, estados de cuenta sintéticos)')
+    p_pipeline.add_argument('--paginas', type=int, nargs='+', default=[3, 6, 12])
+    p_pipeline.add_argument('--repeticiones', type=int, default=3)
+    p_pipeline.set_defaults(funcion=benchmark_pipeline)
+
+    p_guardado = subparsers.add_parser('guardado', help='Movimientos de un estado de cuenta: INSERT por fila vs. en bloque')
+    p_guardado.add_argument('--movimientos', type=int, nargs='+', default=[50, 500, 5000])
+    p_guardado.add_argument('--repeticiones', type=int, default=3)
+    p_guardado.add_argument('--database-url', help='Base de datos de prueba (por defecto, SQLite temporal)')
+    p_guardado.set_defaults(funcion=benchmark_guardado)
+
+    p_sobrescritura = subparsers.add_parser('sobrescritura', help='Sobrescribir un estado de cuenta: borrar todo vs. por diferencias')
+    p_sobrescritura.add_argument('--movimientos', type=int, nargs='+', default=[50, 500, 5000])
+    p_sobrescritura.add_argument('--repeticiones', type=int, default=3)
+    p_sobrescritura.add_argument('--database-url', help='Base de datos de prueba (por defecto, SQLite temporal)')
+    p_sobrescritura.set_defaults(funcion=benchmark_sobrescritura)
+
+    args = parser.parse_args()
+    args.funcion(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+Cliente de IA que graba y reproduce las respuestas de la API (record/replay).
+
+Cada petición a messages.create / messages.stream se identifica con el SHA-256 de sus
+argumentos (JSON canónico, sin 'stream'). Al grabar se llama al cliente real y el par
+petición/respuesta se guarda en <directorio>/<hash>.json; al reproducir se responde
+desde el disco, sin red y siempre igual. Lo usan los benchmarks (benchmark_pdf.py
+pipeline) para medir el pipeline completo sin la API real.
+
+Modos:
+    'reproducir'  solo disco; una petición sin grabación lanza GrabacionNoEncontrada
+    'grabar'      siempre llama al cliente real y sobrescribe la grabación
+    'auto'        reproduce si existe la grabación; si no, llama al cliente real y la graba
+
+Uso:
+    cliente = ClienteIAGrabado('grabaciones_ia', modo='auto', cliente=obtener_cliente_anthropic())
+    analizador = PDFAnalyzer(client=cliente)
+"""
+
+import hashlib
+import json
+import os
+import threading
+
+from anthropic.types import Message
+
+
+class GrabacionNoEncontrada(KeyError):
+    """No hay grabación para la petición (en modo 'reproducir')"""
+
+
+def clave_peticion(kwargs):
+    """SHA-256 de los argumentos de messages.create; 'stream' no cuenta"""
+    peticion = {clave: valor for clave, valor in kwargs.items() if clave != 'stream'}
+    canonico = json.dumps(peticion, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(canonico.encode('utf-8')).hexdigest()
+
+
+def respuesta_a_dict(response, modelo=None):
+    """Respuesta del cliente como dict de Message (acepta también clientes simulados)"""
+    if hasattr(response, 'model_dump'):
+        return response.model_dump(mode='json')
+    uso = getattr(response, 'usage', None)
+    return {
+        'id': getattr(response, 'id', 'msg_grabado'),
+        'type': 'message',
+        'role': 'assistant',
+        'model': getattr(response, 'model', None) or modelo or 'claude-haiku-4-5',
+        'content': [{'type': 'text', 'text': bloque.text} for bloque in response.content],
+        'stop_reason': getattr(response, 'stop_reason', None) or 'end_turn',
+        'stop_sequence': None,
+        'usage': {
+            'input_tokens': getattr(uso, 'input_tokens', None) or 0,
+            'output_tokens': getattr(uso, 'output_tokens', None) or 0,
+            'cache_read_input_tokens': getattr(uso, 'cache_read_input_tokens', None) or 0,
+            'cache_creation_input_tokens': getattr(uso, 'cache_creation_input_tokens', None) or 0
+        }
+    }
+
+
+class _StreamGrabado:
+    """Equivalente a messages.stream(...) para una respuesta ya completa"""
+
+    def __init__(self, mensaje, caracteres_por_evento=40):
+        self.mensaje = mensaje
+        self.caracteres_por_evento = caracteres_por_evento
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    @property
+    def text_stream(self):
+        for bloque in self.mensaje.content:
+            texto = getattr(bloque, 'text', '')
+            for inicio in range(0, len(texto), self.caracteres_por_evento):
+                yield texto[inicio:inicio + self.caracteres_por_evento]
+
+    def get_final_message(self):
+        return self.mensaje
+
+
+class ClienteIAGrabado:
+    """
+    Cliente con la interfaz que usa PDFAnalyzer (messages.create y messages.stream).
+    'cliente' es el cliente real (o simulado) que se llama al grabar.
+    """
+
+    def __init__(self, directorio, modo='reproducir', cliente=None):
+        if modo not in ('reproducir', 'grabar', 'auto'):
+            raise ValueError(f"Modo desconocido: {modo}")
+        if modo != 'reproducir' and cliente is None:
+            raise ValueError("Para grabar hace falta el cliente real")
+        self.directorio = directorio
+        self.modo = modo
+        self.cliente = cliente
+        self.messages = self
+        self.lock = threading.Lock()
+        self.reproducidas = 0
+        self.grabadas = 0
+        os.makedirs(directorio, exist_ok=True)
+
+    def _ruta(self, clave):
+        return os.path.join(self.directorio, f"{clave}.json")
+
+    def create(self, **kwargs):
+        clave = clave_peticion(kwargs)
+        ruta = self._ruta(clave)
+
+        if self.modo != 'grabar' and os.path.exists(ruta):
+            with open(ruta, encoding='utf-8') as archivo:
+                grabacion = json.load(archivo)
+            with self.lock:
+                self.reproducidas += 1
+            return Message.model_validate(grabacion['respuesta'])
+
+        if self.modo == 'reproducir':
+            raise GrabacionNoEncontrada(
+                f"No hay grabación para la petición {clave[:12]} en {self.directorio} (grabar con modo 'auto')"
+            )
+
+        peticion = {clave_kwarg: valor for clave_kwarg, valor in kwargs.items() if clave_kwarg != 'stream'}
+        respuesta = respuesta_a_dict(self.cliente.messages.create(**peticion), kwargs.get('model'))
+        temporal = f"{ruta}.{threading.get_ident()}.tmp"
+        with open(temporal, 'w', encoding='utf-8') as archivo:
+            json.dump({'clave': clave, 'peticion': peticion, 'respuesta': respuesta}, archivo, ensure_ascii=False)
+        os.replace(temporal, ruta)
+        with self.lock:
+            self.grabadas += 1
+        return Message.model_validate(respuesta)
+
+    def stream(self, **kwargs):
+        """La grabación es la misma que la de create: el texto se entrega en fragmentos"""
+        return _StreamGrabado(self.create(**kwargs))
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+Migraciones de esquema versionadas.
+
+La tabla schema_version registra las migraciones aplicadas. aplicar_migraciones()
+ejecuta las pendientes en orden, en una sola transacción: una vez por despliegue
+(pre-deploy: python migraciones.py) y al iniciar la app, por si no se ejecutó. Las
+rutas solo llaman a asegurar_esquema(), que después de la primera verificación del
+proceso no consulta la base.
+
+Las migraciones 1-6 reemplazan a las funciones ensure_* que app.py ejecutaba en cada
+request: agregan la columna solo si falta, porque las bases existentes ya la tienen
+(y db.create_all() crea las tablas nuevas completas).
+
+Uso:
+    python migraciones.py            # aplicar las pendientes (DATABASE_URL)
+    python migraciones.py --estado   # solo mostrar la versión
+    python migraciones.py --indice-codigo   # reintentar el índice único de la migración 7
+"""
+
+import argparse
+import re
+import threading
+from datetime import datetime
+
+from sqlalchemy import inspect, text
+
+# Clave del advisory lock de PostgreSQL: un solo proceso migra a la vez (workers de gunicorn)
+CLAVE_BLOQUEO_MIGRACIONES = 5030200
+
+# Índice único parcial: un estado de cuenta por usuario y código generado DDMMAAAA-XXX
+# (fecha de corte + últimos dígitos). Los nombres de archivo de respaldo (sin fecha de
+# corte) no entran en el índice y se pueden repetir
+INDICE_CODIGO_ESTADO_CUENTA = 'uq_estados_cuenta_usuario_codigo'
+
+# Condición del índice parcial, la misma en Python (codigo_en_indice) y en SQL: en
+# PostgreSQL la expresión regular tal cual, en SQLite el GLOB equivalente
+PATRON_CODIGO_ESTADO_CUENTA = '^[0-9]{8}-[0-9]'
+CONDICION_CODIGO_ESTADO_CUENTA = {
+    'postgresql': f"archivo_original ~ '{PATRON_CODIGO_ESTADO_CUENTA}'",
+    'sqlite': "archivo_original GLOB '[0-9][0-9][0-9][0-9][0-9][0-9][0-9][0-9]-[0-9]*'",
+}
+
+
+def codigo_en_indice(codigo):
+    """Si el código entra en el índice único parcial (si no, la base no detecta duplicados)"""
+    return bool(codigo and re.match(PATRON_CODIGO_ESTADO_CUENTA, codigo, re.ASCII))
+
+
+def columnas_tabla(conexion, tabla):
+    """Nombres de las columnas de la tabla (vacío si la tabla no existe)"""
+    inspector = inspect(conexion)
+    if not inspector.has_table(tabla):
+        return set()
+    return {columna['name'] for columna in inspector.get_columns(tabla)}
+
+
+def agregar_columna(conexion, tabla, columna, tipo_postgres, tipo_sqlite=None):
+    """ALTER TABLE ... ADD COLUMN si la tabla existe y no tiene la columna"""
+    existentes = columnas_tabla(conexion, tabla)
+    if not existentes or columna in existentes:
+        return
+    tipo = tipo_postgres if conexion.dialect.name == 'postgresql' else (tipo_sqlite or tipo_postgres)
+    conexion.execute(text(f"ALTER TABLE {tabla} ADD COLUMN {columna} {tipo}"))
+    print(f"Columna {tabla}.{columna} creada")
+
+
+def tiene_indice(engine_o_conexion, tabla, nombre):
+    """Si la tabla tiene un índice con ese nombre"""
+    inspector = inspect(engine_o_conexion)
+    if not inspector.has_table(tabla):
+        return False
+    return any(indice['name'] == nombre for indice in inspector.get_indexes(tabla))
+
+
+def crear_indice_codigo_estado_cuenta(conexion):
+    """
+    Crea el índice único parcial de códigos de estados de cuenta. Si ya hay códigos
+    repetidos no se puede crear: se avisa y la app sigue con la verificación previa
+    (eliminar los duplicados y ejecutar python migraciones.py --indice-codigo).
+
+    Returns:
+        bool: si el índice existe al terminar
+    """
+    condicion = CONDICION_CODIGO_ESTADO_CUENTA['postgresql' if conexion.dialect.name == 'postgresql' else 'sqlite']
+    repetidos = conexion.execute(text(f"""
+        SELECT COUNT(*) FROM (
+            SELECT usuario_id, archivo_original FROM estados_cuenta
+            WHERE {condicion}
+            GROUP BY usuario_id, archivo_original
+            HAVING COUNT(*) > 1
+        ) repetidos
+    """)).scalar()
+    if repetidos:
+        print(f"ADVERTENCIA: {repetidos} códigos de estados de cuenta repetidos; no se crea el índice "
+              f"{INDICE_CODIGO_ESTADO_CUENTA} (se usa la verificación previa de duplicados)")
+        return False
+    conexion.execute(text(
+        f"CREATE UNIQUE INDEX IF NOT EXISTS {INDICE_CODIGO_ESTADO_CUENTA} "
+        f"ON estados_cuenta (usuario_id, archivo_original) WHERE {condicion}"
+    ))
+    return True
+
+
+# Cada cuánto la app vuelve a buscar el índice si no lo encontró (ej. después de --indice-codigo)
+SEGUNDOS_RECHEQUEO_INDICE = 300
+
+
+# ===== MIGRACIONES =====
+
+def _usuario_avatar_url(conexion):
+    agregar_columna(conexion, 'usuario', 'avatar_url', 'VARCHAR(200)', 'TEXT')
+
+
+def _usuario_password_hash_255(conexion):
+    # SQLite no limita el largo de VARCHAR: solo aplica a PostgreSQL
+    if conexion.dialect.name != 'postgresql':
+        return
+    largo = conexion.execute(text("""
+        SELECT character_maximum_length
+        FROM information_schema.columns
+        WHERE table_name = 'usuario' AND column_name = 'password_hash'
+    """)).scalar()
+    if largo and largo < 255:
+        conexion.execute(text("ALTER TABLE usuario ALTER COLUMN password_hash TYPE VARCHAR(255)"))
+        print("Columna usuario.password_hash actualizada a VARCHAR(255)")
+
+
+def _estados_cuenta_periodo_y_minimo(conexion):
+    agregar_columna(conexion, 'estados_cuenta', 'fecha_inicio_periodo', 'DATE')
+    agregar_columna(conexion, 'estados_cuenta', 'minimo_a_pagar', 'REAL')
+
+
+def _abreviaciones(conexion):
+    agregar_columna(conexion, 'banco_estandarizado', 'abreviacion', 'VARCHAR(50)', 'TEXT')
+    agregar_columna(conexion, 'tipo_tarjeta_estandarizado', 'abreviacion', 'VARCHAR(50)', 'TEXT')
+
+
+def _consumos_detalle_categoria_503020(conexion):
+    agregar_columna(conexion, 'consumos_detalle', 'categoria_503020', 'VARCHAR(20)', 'TEXT')
+
+
+def _metricas_ia_tokens_y_tiempos(conexion):
+    for columna, tipo in (
+        ('tokens_cache_lectura', 'INTEGER DEFAULT 0'),
+        ('tokens_cache_escritura', 'INTEGER DEFAULT 0'),
+        ('tokens_entrada', 'INTEGER DEFAULT 0'),
+        ('tokens_salida', 'INTEGER DEFAULT 0'),
+        ('duracion_extraccion', 'REAL'),
+        ('duracion_preparacion', 'REAL'),
+        ('duracion_llamada_ia', 'REAL'),
+        ('duracion_parseo', 'REAL'),
+    ):
+        agregar_columna(conexion, 'metricas_ia', columna, tipo)
+
+
+def _estados_cuenta_codigo_unico(conexion):
+    if columnas_tabla(conexion, 'estados_cuenta'):
+        crear_indice_codigo_estado_cuenta(conexion)
+
+
+# (versión, descripción, función): nunca cambiar una ya publicada, solo agregar al final
+MIGRACIONES = [
+    (1, 'usuario.avatar_url', _usuario_avatar_url),
+    (2, 'usuario.password_hash VARCHAR(255)', _usuario_password_hash_255),
+    (3, 'estados_cuenta.fecha_inicio_periodo y minimo_a_pagar', _estados_cuenta_periodo_y_minimo),
+    (4, 'abreviacion en banco_estandarizado y tipo_tarjeta_estandarizado', _abreviaciones),
+    (5, 'consumos_detalle.categoria_503020', _consumos_detalle_categoria_503020),
+    (6, 'metricas_ia: tokens reales y tiempos por fase', _metricas_ia_tokens_y_tiempos),
+    (7, 'índice único de códigos de estados de cuenta por usuario', _estados_cuenta_codigo_unico),
+]
+
+VERSION_ACTUAL = MIGRACIONES[-1][0]
+
+
+# ===== EJECUCIÓN =====
+
+def version_esquema(conexion):
+    """Última migración aplicada (0 si nunca se migró)"""
+    if not inspect(conexion).has_table('schema_version'):
+        return 0
+    return conexion.execute(text("SELECT COALESCE(MAX(version), 0) FROM schema_version")).scalar()
+
+
+def aplicar_migraciones(engine):
+    """
+    Aplica en orden las migraciones pendientes, en una transacción (en PostgreSQL con
+    un advisory lock, para que varios workers no migren a la vez).
+
+    Returns:
+        list: versiones aplicadas (vacía si el esquema ya estaba al día)
+    """
+    aplicadas = []
+    with engine.begin() as conexion:
+        if conexion.dialect.name == 'postgresql':
+            conexion.execute(text("SELECT pg_advisory_xact_lock(:clave)"), {'clave': CLAVE_BLOQUEO_MIGRACIONES})
+        conexion.execute(text("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                descripcion VARCHAR(200) NOT NULL,
+                aplicada_en TIMESTAMP NOT NULL
+            )
+        """))
+        version = version_esquema(conexion)
+        for numero, descripcion, migracion in MIGRACIONES:
+            if numero <= version:
+                continue
+            print(f"Aplicando migración {numero}: {descripcion}")
+            migracion(conexion)
+            conexion.execute(
+                text("INSERT INTO schema_version (version, descripcion, aplicada_en) VALUES (:version, :descripcion, :fecha)"),
+                {'version': numero, 'descripcion': descripcion, 'fecha': datetime.utcnow()}
+            )
+            aplicadas.append(numero)
+    _esquemas_al_dia.add(str(engine.url))
+    return aplicadas
+
+
+# Bases (por URL) ya verificadas en este proceso
+_esquemas_al_dia = set()
+_lock_esquema = threading.Lock()
+
+
+def asegurar_esquema(engine, forzar=False):
+    """
+    Verificación para las rutas: la primera vez en el proceso lee la versión (y aplica
+    las migraciones pendientes si el pre-deploy no lo hizo); después no hace consultas.
+    forzar=True vuelve a verificar (ej. después de un error por una columna faltante).
+    """
+    clave = str(engine.url)
+    if clave in _esquemas_al_dia and not forzar:
+        return
+    with _lock_esquema:
+        if clave in _esquemas_al_dia and not forzar:
+            return
+        with engine.connect() as conexion:
+            version = version_esquema(conexion)
+        if version < VERSION_ACTUAL:
+            aplicar_migraciones(engine)
+        _esquemas_al_dia.add(clave)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Migraciones de esquema de la base de datos')
+    parser.add_argument('--estado', action='store_true', help='Solo mostrar la versión del esquema')
+    parser.add_argument('--indice-codigo', action='store_true',
+                        help='Volver a crear el índice único de códigos (después de eliminar duplicados)')
+    args = parser.parse_args()
+
+    # Importar la app crea las tablas que falten y aplica las migraciones al iniciar
+    from app import app, db
+
+    with app.app_context():
+        if not args.estado:
+            aplicadas = aplicar_migraciones(db.engine)
+            print(f"✅ Migraciones aplicadas: {aplicadas}" if aplicadas else "✅ Sin migraciones pendientes")
+        if args.indice_codigo:
+            with db.engine.begin() as conexion:
+                if crear_indice_codigo_estado_cuenta(conexion):
+                    print(f"✅ Índice {INDICE_CODIGO_ESTADO_CUENTA} creado (los procesos de la app en ejecución "
+                          f"lo empiezan a usar en hasta {SEGUNDOS_RECHEQUEO_INDICE // 60} minutos, o al reiniciarlos)")
+        with db.engine.connect() as conexion:
+            print(f"📊 Esquema en la versión {version_esquema(conexion)} (última: {VERSION_ACTUAL})")
+
+
+if __name__ == '__main__':
+    main()
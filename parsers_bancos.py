@@ -0,0 +1,327 @@
+"""
+Parser local (sin IA) para los estados de cuenta de los bancos más frecuentes.
+
+Reconoce el emisor en el texto del PDF (tabla BANCOS), lee el resumen (cupos, deudas,
+fechas) y convierte las filas reconstruidas por PDFAnalyzer.extraer_tablas_pdf en
+movimientos_detallados. El resultado tiene la misma forma que el 'data' de
+PDFAnalyzer.analizar_estado_cuenta.
+
+Ningún formato es propio de un banco: todos usan las mismas etiquetas del resumen y
+las mismas reglas de columnas (ParserEstadoCuenta). El banco solo da el nombre y el
+tipo de tarjeta por defecto.
+
+Solo se usa el resultado local si los totales cuadran (suma de movimientos contra
+el resumen y deuda anterior + cargos - pagos = total a pagar); en cualquier otro
+caso se retorna None y el análisis sigue con Claude.
+
+Para agregar un banco: una entrada en BANCOS.
+"""
+
+import re
+
+from pdf_analyzer import PDFAnalyzer, PATRON_FECHA_NUMERICA, PATRON_FECHA_MES_TEXTO, MESES_ABREVIADOS
+
+TOLERANCIA_CUADRE = 0.05  # Diferencia máxima aceptada (USD) al cuadrar totales
+
+PATRON_VALOR_MONTO = re.compile(r'\(?-?\$?\s*\d{1,3}(?:[,.]?\d{3})*[.,]\d{2}\)?-?')
+PATRON_DIA_MES = re.compile(r'^(\d{1,2})[/\-.](\d{1,2})$')
+PATRON_DIA_MES_TEXTO = re.compile(r'^(\d{1,2})[\s/\-.]*(ENE|FEB|MAR|ABR|MAY|JUN|JUL|AGO|SEP|SET|OCT|NOV|DIC)[A-Z]*\.?$', re.IGNORECASE)
+
+# Etiquetas del resumen comunes a los bancos ecuatorianos. El orden importa: cada
+# línea se asigna al primer campo cuya etiqueta coincide (las más específicas primero)
+ETIQUETAS_RESUMEN = [
+    ('fecha_inicio_periodo', r'fecha\s*(?:de\s*)?inicio(?:\s*del?\s*periodo)?|periodo\s*desde|inicio\s*(?:del\s*)?periodo'),
+    ('fecha_pago', r'fecha\s*m[aá]xima\s*(?:de\s*)?pago|fecha\s*l[ií]mite\s*(?:de\s*)?pago|pagar\s*hasta|fecha\s*de\s*pago'),
+    ('fecha_corte', r'fecha\s*(?:de\s*)?corte|corte\s*al|fecha\s*de\s*cierre|fecha\s*de\s*facturaci[oó]n'),
+    ('cupo_disponible', r'cupo\s*disponible|cr[eé]dito\s*disponible'),
+    ('cupo_utilizado', r'cupo\s*utilizado|cr[eé]dito\s*utilizado'),
+    ('cupo_autorizado', r'cupo\s*(?:total|autorizado|aprobado)|l[ií]mite\s*de\s*cr[eé]dito'),
+    ('consumos_cargos_totales', r'(?:total\s*(?:de\s*)?)?consumos\s*y\s*cargos|total\s*cargos'),
+    ('pagos_creditos', r'pagos\s*(?:y|/)\s*cr[eé]ditos|total\s*(?:de\s*)?pagos'),
+    ('otros_cargos', r'otros\s*cargos'),
+    ('intereses', r'intereses'),
+    ('consumos_debitos', r'consumos\s*(?:y|/)\s*d[eé]bitos|total\s*(?:de\s*)?consumos|consumos\s*del\s*periodo'),
+    ('minimo_a_pagar', r'(?:pago|valor)\s*m[ií]nimo|m[ií]nimo\s*a\s*pagar'),
+    ('deuda_anterior', r'(?:deuda|saldo)\s*anterior'),
+    ('deuda_total_pagar', r'total\s*a\s*pagar|deuda\s*total|saldo\s*total|pago\s*(?:total|de\s*contado)'),
+]
+CAMPOS_FECHA = ('fecha_corte', 'fecha_inicio_periodo', 'fecha_pago')
+
+MARCAS_TARJETA = [
+    ('AMERICAN EXPRESS', r'american\s*express|\bamex\b'),
+    ('DINERS CLUB', r'diners'),
+    ('MASTERCARD', r'master\s*card'),
+    ('VISA', r'\bvisa\b'),
+    ('DISCOVER', r'\bdiscover\b'),
+]
+
+# Emisores reconocidos, en orden de prioridad: (nombre_banco, regex del encabezado,
+# tipo de tarjeta si no aparece la marca)
+BANCOS = [
+    ('Diners Club', r'diners\s*club', 'DINERS CLUB'),  # Antes que Pichincha: sus estados mencionan al grupo en el pie
+    ('Banco Pichincha', r'banco\s*pichincha', ''),
+    ('Banco Guayaquil', r'banco\s*(?:de\s*)?guayaquil', ''),
+    ('Produbanco', r'produbanco', ''),
+    ('Banco del Pacífico', r'banco\s*del\s*pac[ií]fico', ''),
+]
+PATRONES_BANCOS = [(nombre, re.compile(patron, re.IGNORECASE), tipo) for nombre, patron, tipo in BANCOS]
+
+# Clasificación de movimientos por palabras clave (mismas categorías que el prompt de IA)
+PALABRAS_TIPO_TRANSACCION = [
+    ('pago', r'\bpago\b|\babono\b|nota\s*de\s*cr[eé]dito|reverso|devoluci[oó]n|reembolso'),
+    ('interes', r'inter[eé]s'),
+    ('cargo', r'\biva\b|\bret\b|comisi[oó]n|seguro|membres[ií]a|renovaci[oó]n|tarifa|impuesto|\bisd\b|cargo'),
+]
+PALABRAS_CATEGORIA = [
+    ('Alimentación', r'supermaxi|megamaxi|mi\s*comisariato|tia\b|santa\s*maria|aki\b|coral|gran\s*aki|supermercado'),
+    ('Comida Fuera', r'kfc|mcdonald|burger|pizza|restaurant|cafe|coffee|juan\s*valdez|uber\s*eats|rappi|pedidosya|deli'),
+    ('Transporte', r'uber|cabify|indriver|primax|petroecuador|terpel|mobil|gasolinera|peaje'),
+    ('Salud', r'fybeca|pharmacys|sana\s*sana|cruz\s*azul|farmacia|clinica|hospital|medic|laboratorio'),
+    ('Entretenimiento', r'netflix|spotify|disney|hbo|prime\s*video|cinemark|supercines|steam|playstation'),
+    ('Servicios', r'cnt\b|claro|movistar|netlife|empresa\s*electrica|agua\s*potable|emaap|cnel'),
+    ('Compras', r'de\s*prati|etafashion|amazon|aliexpress|shein|kiwy|sukasa|almacenes|mall'),
+    ('Seguros', r'seguros?\s'),
+    ('Educación', r'universidad|colegio|escuela|libreria|udemy|coursera'),
+    ('Viajes/Vacaciones', r'hotel|latam|avianca|copa\s*air|booking|airbnb|despegar'),
+    ('Cuidado Personal', r'peluquer|spa\b|barber|salon'),
+]
+
+
+def reconocer_banco(texto):
+    """(nombre_banco, tipo_tarjeta_por_defecto) del primer emisor de BANCOS en el encabezado, o None"""
+    encabezado = texto[:3000]
+    for nombre, patron, tipo_tarjeta in PATRONES_BANCOS:
+        if patron.search(encabezado):
+            return nombre, tipo_tarjeta
+    return None
+
+
+def convertir_monto(texto):
+    """
+    Convierte un monto del estado de cuenta a float.
+    Acepta '1,749.60', '1.749,60', '$ 45.30', '45.30-' y '(45.30)' (negativos).
+    """
+    texto = texto.strip()
+    negativo = texto.startswith('-') or texto.endswith('-') or (texto.startswith('(') and texto.endswith(')'))
+    numero = re.sub(r'[^\d,.]', '', texto)
+    if re.search(r',\d{2}$', numero):
+        numero = numero.replace('.', '').replace(',', '.')
+    else:
+        numero = numero.replace(',', '')
+    valor = float(numero)
+    return -valor if negativo else valor
+
+
+class ParserEstadoCuenta:
+    """
+    Parser genérico basado en reglas, el mismo para todos los bancos de BANCOS
+    (etiquetas del resumen en ETIQUETAS_RESUMEN, filas de extraer_tablas_pdf).
+    """
+
+    def __init__(self, nombre_banco, tipo_tarjeta_por_defecto=''):
+        self.nombre_banco = nombre_banco
+        self.tipo_tarjeta_por_defecto = tipo_tarjeta_por_defecto
+        self._etiquetas = [(campo, re.compile(patron, re.IGNORECASE)) for campo, patron in ETIQUETAS_RESUMEN]
+
+    def extraer_resumen(self, lineas_resumen):
+        """Lee los campos del resumen: cada línea aporta el valor que sigue a su etiqueta"""
+        resumen = {}
+        for linea in lineas_resumen:
+            for campo, patron in self._etiquetas:
+                coincidencia = patron.search(linea)
+                if not coincidencia:
+                    continue
+                resto = linea[coincidencia.end():]
+                if campo in CAMPOS_FECHA:
+                    fecha = self._buscar_fecha(resto)
+                    if fecha and campo not in resumen:
+                        resumen[campo] = fecha
+                else:
+                    monto = PATRON_VALOR_MONTO.search(resto)
+                    if monto and campo not in resumen:
+                        resumen[campo] = abs(convertir_monto(monto.group(0)))
+                break
+        return resumen
+
+    @staticmethod
+    def _buscar_fecha(texto):
+        """Primera fecha completa del texto (date) o None"""
+        numerica = PATRON_FECHA_NUMERICA.search(texto)
+        if numerica:
+            return PDFAnalyzer._convertir_fecha(*numerica.groups())
+        mes_texto = PATRON_FECHA_MES_TEXTO.search(texto)
+        if mes_texto:
+            dia, mes, anio = mes_texto.groups()
+            return PDFAnalyzer._convertir_fecha(dia, MESES_ABREVIADOS[mes[:3].upper()], anio)
+        return None
+
+    @staticmethod
+    def _fecha_movimiento(texto, fecha_corte):
+        """
+        Fecha de una fila; si no trae año ('15/01', '15 ENE') se toma el del corte
+        (o el anterior si el mes es posterior al del corte)
+        """
+        fecha = ParserEstadoCuenta._buscar_fecha(texto)
+        if fecha:
+            return fecha
+        dia_mes = PATRON_DIA_MES.match(texto.strip())
+        dia_mes_texto = PATRON_DIA_MES_TEXTO.match(texto.strip())
+        if dia_mes:
+            dia, mes = int(dia_mes.group(1)), int(dia_mes.group(2))
+        elif dia_mes_texto:
+            dia, mes = int(dia_mes_texto.group(1)), MESES_ABREVIADOS[dia_mes_texto.group(2)[:3].upper()]
+        else:
+            return None
+        anio = fecha_corte.year - (1 if mes > fecha_corte.month else 0)
+        return PDFAnalyzer._convertir_fecha(dia, mes, anio)
+
+    @staticmethod
+    def clasificar_movimiento(descripcion, monto):
+        """Retorna (tipo_transaccion, categoria) según palabras clave y el signo del monto"""
+        tipo = 'pago' if monto < 0 else 'consumo'
+        if tipo == 'consumo':
+            for tipo_palabra, patron in PALABRAS_TIPO_TRANSACCION:
+                if re.search(patron, descripcion, re.IGNORECASE):
+                    tipo = tipo_palabra
+                    break
+        if tipo != 'consumo':
+            return tipo, 'Otros'
+        for categoria, patron in PALABRAS_CATEGORIA:
+            if re.search(patron, descripcion, re.IGNORECASE):
+                return tipo, categoria
+        return tipo, 'Otros'
+
+    def extraer_movimientos(self, filas, fecha_corte, columna_monto=2):
+        """
+        Convierte las filas 'fecha|descripción|monto[|...]' en movimientos_detallados.
+        columna_monto: celda del monto si la fila tiene varias columnas de montos
+        (2 = la primera, -1 = la última)
+        """
+        movimientos = []
+        for fila in filas:
+            celdas = fila.split('|')
+            if len(celdas) < 3:
+                continue
+            fecha = self._fecha_movimiento(celdas[0], fecha_corte)
+            if not fecha:
+                return None  # Fila que no se entiende: mejor que lo resuelva la IA
+            try:
+                monto = convertir_monto(celdas[columna_monto])
+            except ValueError:
+                return None
+            descripcion = celdas[1].strip()
+            tipo, categoria = self.clasificar_movimiento(descripcion, monto)
+            movimientos.append({
+                'fecha': fecha.strftime('%d/%m/%Y'),
+                'descripcion': descripcion,
+                'monto': abs(monto),
+                'categoria': categoria,
+                'tipo_transaccion': tipo
+            })
+        return movimientos
+
+    def detectar_tipo_tarjeta(self, texto):
+        encabezado = texto[:3000]
+        for marca, patron in MARCAS_TARJETA:
+            if re.search(patron, encabezado, re.IGNORECASE):
+                return marca
+        return self.tipo_tarjeta_por_defecto
+
+    @staticmethod
+    def totales_cuadran(datos):
+        """
+        Verifica los movimientos contra el resumen:
+        - Cargos (consumos + cargos + intereses) contra consumos_cargos_totales o sus componentes
+        - Pagos contra pagos_creditos
+        - deuda_anterior + cargos - pagos contra deuda_total_pagar
+        Se exige que al menos el cuadre de cargos sea posible.
+        """
+        movimientos = datos['movimientos_detallados']
+        cargos = round(sum(m['monto'] for m in movimientos if m['tipo_transaccion'] != 'pago'), 2)
+        pagos = round(sum(m['monto'] for m in movimientos if m['tipo_transaccion'] == 'pago'), 2)
+
+        candidatos_cargos = [
+            datos['consumos_cargos_totales'],
+            datos['consumos_debitos'] + datos['otros_cargos'] + datos['intereses'],
+            datos['consumos_debitos'] + datos['otros_cargos'],
+        ]
+        candidatos_cargos = [c for c in candidatos_cargos if c > 0]
+        if not candidatos_cargos or not any(abs(c - cargos) <= TOLERANCIA_CUADRE for c in candidatos_cargos):
+            return False
+
+        if (datos['pagos_creditos'] > 0 or pagos > 0) and abs(datos['pagos_creditos'] - pagos) > TOLERANCIA_CUADRE:
+            return False
+
+        if datos['deuda_total_pagar'] > 0:
+            saldo = datos['deuda_anterior'] + cargos - pagos
+            if abs(saldo - datos['deuda_total_pagar']) > TOLERANCIA_CUADRE:
+                return False
+
+        return True
+
+    def analizar(self, texto_pdf, tablas):
+        """
+        Retorna el dict 'data' (misma forma que analizar_estado_cuenta) o None si el
+        formato no se reconoce completo o los totales no cuadran
+        """
+        resumen = self.extraer_resumen(tablas['resumen'])
+        fecha_corte = resumen.get('fecha_corte')
+        if not fecha_corte:
+            return None
+
+        # Con varias columnas de montos (referencia, cuota, saldo diferido) no se sabe cuál
+        # es el monto del movimiento: se prueba la primera y la última, y vale la que cuadra
+        columnas_monto = [2]
+        if any(fila.count('|') > 2 for fila in tablas['filas']):
+            columnas_monto.append(-1)
+        for columna_monto in columnas_monto:
+            datos = self._datos_estado(texto_pdf, resumen, fecha_corte, tablas['filas'], columna_monto)
+            if datos and self.totales_cuadran(datos):
+                return datos
+        print(f"DEBUG - Parser {self.nombre_banco}: los totales no cuadran, se usará la IA")
+        return None
+
+    def _datos_estado(self, texto_pdf, resumen, fecha_corte, filas, columna_monto):
+        """El dict 'data' con los movimientos leídos de columna_monto (None si alguna fila no se entiende)"""
+        movimientos = self.extraer_movimientos(filas, fecha_corte, columna_monto)
+        if not movimientos:
+            return None
+
+        identificadores = PDFAnalyzer.detectar_identificadores_estado(texto_pdf)
+        datos = {
+            'fecha_corte': fecha_corte.strftime('%d/%m/%Y'),
+            'fecha_inicio_periodo': resumen['fecha_inicio_periodo'].strftime('%d/%m/%Y') if resumen.get('fecha_inicio_periodo') else '',
+            'fecha_pago': resumen['fecha_pago'].strftime('%d/%m/%Y') if resumen.get('fecha_pago') else '',
+            'nombre_banco': self.nombre_banco,
+            'tipo_tarjeta': self.detectar_tipo_tarjeta(texto_pdf),
+            # Los 3 últimos dígitos, como los devuelve la IA: el código DDMMAAAA-XXX debe coincidir
+            'ultimos_digitos': (identificadores['ultimos_digitos'] or [''])[-1],
+            'movimientos_detallados': movimientos,
+        }
+        for campo, _ in ETIQUETAS_RESUMEN:
+            if campo not in CAMPOS_FECHA:
+                datos[campo] = resumen.get(campo, 0.00)
+        if not datos['cupo_utilizado'] and datos['cupo_autorizado'] and datos['cupo_disponible']:
+            datos['cupo_utilizado'] = round(datos['cupo_autorizado'] - datos['cupo_disponible'], 2)
+        if not datos['consumos_cargos_totales']:
+            datos['consumos_cargos_totales'] = round(datos['consumos_debitos'] + datos['otros_cargos'] + datos['intereses'], 2)
+        return datos
+
+
+def analizar_con_parsers_locales(texto_pdf, tablas):
+    """
+    Reconoce el banco (BANCOS) y analiza el estado de cuenta con el parser genérico.
+    Retorna (nombre_banco, datos) si el formato se entiende y los totales cuadran, o None.
+    """
+    banco = reconocer_banco(texto_pdf)
+    if not banco:
+        return None
+    parser = ParserEstadoCuenta(*banco)
+    try:
+        datos = parser.analizar(texto_pdf, tablas)
+    except Exception as e:
+        print(f"DEBUG - Parser {parser.nombre_banco} falló: {str(e)}")
+        datos = None
+    if datos:
+        return parser.nombre_banco, datos
+    return None
@@ -1,159 +1,209 @@
 import os
+import io
+import base64
+import re
 import json
-import tempfile
-from anthropic import Anthropic
-from datetime import datetime
+import random
+import threading
+import time
+import multiprocessing
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as TimeoutFuturo
+import httpx
+from anthropic import Anthropic, APIConnectionError, APIStatusError, DefaultHttpxClient
+from datetime import datetime, date
 import fitz  # PyMuPDF
 import PyPDF2
 
-class PDFAnalyzer:
+# Patrones para la detección local (sin IA) de la fecha de corte y la tarjeta
+MESES_ABREVIADOS = {
+    'ENE': 1, 'FEB': 2, 'MAR': 3, 'ABR': 4, 'MAY': 5, 'JUN': 6,
+    'JUL': 7, 'AGO': 8, 'SEP': 9, 'SET': 9, 'OCT': 10, 'NOV': 11, 'DIC': 12
+}
+PATRON_ETIQUETA_CORTE = re.compile(
+    r'fecha\s*(?:de\s*)?corte|corte\s*al|fecha\s*de\s*cierre|fecha\s*de\s*facturaci[oó]n',
+    re.IGNORECASE
+)
+PATRON_FECHA_NUMERICA = re.compile(r'\b(\d{1,2})[/\-.](\d{1,2})[/\-.](\d{4}|\d{2})\b')
+PATRON_FECHA_MES_TEXTO = re.compile(
+    r'\b(\d{1,2})[\s/\-.]*(?:DE\s+)?(ENE|FEB|MAR|ABR|MAY|JUN|JUL|AGO|SEP|SET|OCT|NOV|DIC)[A-Z]*\.?[\s/\-.]*(?:DE\s+)?(\d{4}|\d{2})\b',
+    re.IGNORECASE
+)
+PATRON_TARJETA_ENMASCARADA = re.compile(r'(?:[X\*•]{2,}[\s\-]*){1,4}(\d{3,4})\b', re.IGNORECASE)
+PATRON_TARJETA_TERMINADA = re.compile(r'terminad[ao]\s+en\s*[:\-]?\s*(\d{3,4})\b', re.IGNORECASE)
+
+# Tabla de traducción para normalizar caracteres Unicode problemáticos (una sola pasada)
+TABLA_NORMALIZACION = str.maketrans({
+    '\u2212': '-',  # Menos matemático → guión normal
+    '\u2013': '-',  # En dash → guión normal
+    '\u2014': '-',  # Em dash → guión normal
+    '\u2018': "'",  # Comilla simple izquierda → comilla normal
+    '\u2019': "'",  # Comilla simple derecha → comilla normal
+    '\u201C': '"',  # Comilla doble izquierda → comilla normal
+    '\u201D': '"',  # Comilla doble derecha → comilla normal
+    '\u00A0': ' ',  # Espacio no separador → espacio normal
+})
+
+# Minimización del texto enviado al prompt (PDF_MINIMIZAR_PROMPT=0 para desactivar)
+MINIMIZAR_PROMPT = os.environ.get('PDF_MINIMIZAR_PROMPT', '1') not in ('0', 'false', 'False')
+PATRON_MARCA_PAGINA = re.compile(r'\n--- PÁGINA (\d+) ---\n')
+PATRON_MONTO = re.compile(r'\d[\d,.]*[.,]\d{2}\b')
+PATRON_FECHA = re.compile(
+    r'\b\d{1,2}[/\-.]\d{1,2}[/\-.]\d{2,4}\b|\b\d{1,2}[\s/\-.]*(?:ENE|FEB|MAR|ABR|MAY|JUN|JUL|AGO|SEP|SET|OCT|NOV|DIC)[A-Z]*\b',
+    re.IGNORECASE
+)
+PATRON_SOLO_MONTO = re.compile(r'^-?\$?\s*\d[\d,.]*[.,]\d{2}\s*-?$')
+PATRON_ESPACIOS = re.compile(r'[ \t\f\v]+')
+LINEAS_BANDA_ENCABEZADO_PIE = 8  # Líneas al inicio y al final de cada página donde se buscan encabezados/pies
+
+def estimar_tokens(texto):
+    """Aproximación de tokens para reportes (~4 caracteres por token)"""
+    return (len(texto) + 3) // 4 if texto else 0
+
+def segundos_desde(inicio):
+    """Segundos transcurridos desde un time.perf_counter() (para los tiempos por fase)"""
+    return round(time.perf_counter() - inicio, 4)
+
+# Reconstrucción local de tablas con coordenadas de PyMuPDF (PDF_TABLAS_LOCALES=0 para desactivar)
+# Si se reconstruyen al menos PDF_TABLAS_MIN_FILAS movimientos, al prompt solo van las filas
+# compactas "fecha|descripción|monto" y el bloque de resumen en lugar del texto libre
+TABLAS_LOCALES = os.environ.get('PDF_TABLAS_LOCALES', '1') not in ('0', 'false', 'False')
+TABLAS_MIN_FILAS = int(os.environ.get('PDF_TABLAS_MIN_FILAS', '3'))
+# Parser local de los bancos conocidos (parsers_bancos.py): si entiende el formato y los totales
+# cuadran no se llama a la IA (PDF_PARSERS_LOCALES=0 para desactivar)
+PARSERS_LOCALES = os.environ.get('PDF_PARSERS_LOCALES', '1') not in ('0', 'false', 'False')
+NOTA_FORMATO_TABLAS = """
+7. FORMATO DEL TEXTO:
+   - El texto tiene un bloque RESUMEN y un bloque MOVIMIENTOS ya separado en filas
+   - Cada fila de MOVIMIENTOS es un movimiento: fecha|descripción|monto
+   - Si una fila tiene más de un monto (cuotas, saldo pendiente), el monto del movimiento es el primero
+"""
+PATRON_CELDA_FECHA = re.compile(
+    r'^(?:\d{1,2}[/\-.]\d{1,2}(?:[/\-.]\d{2,4})?|\d{1,2}[\s/\-.]*(?:ENE|FEB|MAR|ABR|MAY|JUN|JUL|AGO|SEP|SET|OCT|NOV|DIC)[A-Z]*\.?(?:[\s/\-.]*\d{2,4})?)$',
+    re.IGNORECASE
+)
+PATRON_CELDA_MONTO = re.compile(r'^\(?-?\$?\s*\d{1,3}(?:[,.]?\d{3})*[.,]\d{2}\)?\s*-?$')
+
+def _agrupar_lineas_visuales(palabras):
     """
-    Analizador de PDFs de estados de cuenta usando Claude Haiku 4.5 (solo método texto)
+    Agrupa las palabras de page.get_text("words") en líneas visuales según su
+    coordenada vertical (columnas distintas a la misma altura quedan en la misma línea).
+    Cada línea es una lista de (x0, x1, alto, texto) ordenada de izquierda a derecha.
     """
+    lineas = []
+    for x0, y0, x1, y1, texto, *_ in sorted(palabras, key=lambda w: ((w[1] + w[3]) / 2, w[0])):
+        centro = (y0 + y1) / 2
+        alto = max(y1 - y0, 1.0)
+        if lineas and abs(centro - lineas[-1]['centro']) <= lineas[-1]['alto'] / 2:
+            lineas[-1]['palabras'].append((x0, x1, alto, texto))
+        else:
+            lineas.append({'centro': centro, 'alto': alto, 'palabras': [(x0, x1, alto, texto)]})
+    return [sorted(linea['palabras']) for linea in lineas]
+
+def _separar_celdas(palabras_linea):
+    """
+    Separa una línea visual en celdas: un espacio horizontal mayor a ~0.6 veces
+    el alto del texto marca el cambio de columna
+    """
+    celdas = []
+    fin_anterior = None
+    anterior_aislada = False
+    for x0, x1, alto, texto in palabras_linea:
+        # Montos y fechas numéricas son siempre una celda propia aunque estén pegados al texto
+        aislada = bool(PATRON_CELDA_MONTO.match(texto) or PATRON_FECHA_NUMERICA.fullmatch(texto))
+        if fin_anterior is not None and x0 - fin_anterior <= alto * 0.6 and not aislada and not anterior_aislada:
+            celdas[-1] = f"{celdas[-1]} {texto}"
+        else:
+            celdas.append(texto)
+        fin_anterior = x1
+        anterior_aislada = aislada
+    return celdas
+
+def reconstruir_filas_pagina(palabras):
+    """
+    Reconstruye las filas de movimientos de una página a partir de las palabras con
+    coordenadas (page.get_text("words")).
     
-    def __init__(self):
-        """Inicializar el cliente de Anthropic"""
-        # Intentar cargar desde .env primero
-        try:
-            from dotenv import load_dotenv
-            load_dotenv()
-        except:
-            pass
-        
-        self.api_key = os.environ.get('ANTHROPIC_API_KEY')
-        
-        if not self.api_key:
-            print("ERROR en PDFAnalyzer.__init__: ANTHROPIC_API_KEY no está configurado")
-            print(f"Variables de entorno disponibles: {list(os.environ.keys())}")
-            raise ValueError("ANTHROPIC_API_KEY no está configurado. Verifica las variables de entorno en Render.")
-        
-        try:
-            self.client = Anthropic(api_key=self.api_key)
-            print("DEBUG - Cliente Anthropic inicializado correctamente")
-        except Exception as e:
-            print(f"ERROR inicializando cliente Anthropic: {str(e)}")
-            raise
+    Una fila de movimiento empieza con una celda de fecha y termina con una o más
+    celdas de monto; si en la misma línea visual hay dos tablas (diseño a dos
+    columnas) se separa en dos filas al encontrar otra fecha después de un monto.
     
-    def normalizar_texto(self, texto):
-        """
-        Normaliza el texto para manejar caracteres Unicode problemáticos
-        Reemplaza caracteres especiales que pueden causar problemas de codificación
-        """
-        if not texto:
-            return ""
-        
-        # Reemplazar caracteres Unicode problemáticos
-        reemplazos = {
-            '\u2212': '-',  # Menos matemático → guión normal
-            '\u2013': '-',  # En dash → guión normal
-            '\u2014': '-',  # Em dash → guión normal
-            '\u2018': "'",  # Comilla simple izquierda → comilla normal
-            '\u2019': "'",  # Comilla simple derecha → comilla normal
-            '\u201C': '"',  # Comilla doble izquierda → comilla normal
-            '\u201D': '"',  # Comilla doble derecha → comilla normal
-            '\u00A0': ' ',  # Espacio no separador → espacio normal
-        }
-        
-        texto_normalizado = texto
-        for char_unicode, char_reemplazo in reemplazos.items():
-            texto_normalizado = texto_normalizado.replace(char_unicode, char_reemplazo)
+    Returns:
+        tuple: (filas, otras_lineas) donde cada fila es "fecha|descripción|monto[|monto...]"
+               y otras_lineas son las líneas que no son movimientos (resumen, encabezados)
+    """
+    filas = []
+    otras_lineas = []
+    for palabras_linea in _agrupar_lineas_visuales(palabras):
+        celdas = _separar_celdas(palabras_linea)
         
-        return texto_normalizado
-    
-    def extraer_texto_pdf(self, pdf_path):
-        """
-        Extrae texto del PDF usando múltiples métodos (más robusto)
-        """
-        try:
-            # Verificar que el archivo existe
-            if not os.path.exists(pdf_path):
-                raise Exception(f"El archivo temporal no existe: {pdf_path}")
-            
-            print(f"DEBUG - Intentando extraer texto de: {pdf_path} (tamaño: {os.path.getsize(pdf_path)} bytes)")
-            
-            # Método 1: PyMuPDF (más robusto)
-            try:
-                doc = fitz.open(pdf_path)
-                texto_completo = ""
-                
-                # Extraer texto de todas las páginas
-                for page_num in range(doc.page_count):
-                    page = doc[page_num]
-                    texto_pagina = page.get_text()
-                    texto_completo += f"\n--- PÁGINA {page_num + 1} ---\n"
-                    texto_completo += texto_pagina
-                
-                doc.close()
-                
-                if texto_completo.strip():
-                    # Normalizar el texto para evitar problemas de codificación
-                    texto_completo = self.normalizar_texto(texto_completo)
-                    print(f"DEBUG - PyMuPDF extrajo {len(texto_completo)} caracteres")
-                    return texto_completo
-                    
-            except Exception as e:
-                print(f"DEBUG - PyMuPDF falló: {str(e)}")
-            
-            # Método 2: PyPDF2 (fallback)
-            try:
-                import PyPDF2
-                with open(pdf_path, 'rb') as file:
-                    reader = PyPDF2.PdfReader(file)
-                    texto_completo = ""
-                    
-                    for page_num in range(len(reader.pages)):
-                        page = reader.pages[page_num]
-                        texto_pagina = page.extract_text()
-                        texto_completo += f"\n--- PÁGINA {page_num + 1} ---\n"
-                        texto_completo += texto_pagina
-                    
-                    if texto_completo.strip():
-                        # Normalizar el texto para evitar problemas de codificación
-                        texto_completo = self.normalizar_texto(texto_completo)
-                        print(f"DEBUG - PyPDF2 extrajo {len(texto_completo)} caracteres")
-                        return texto_completo
-                        
-            except Exception as e:
-                print(f"DEBUG - PyPDF2 falló: {str(e)}")
-            
-            # Si ambos métodos fallan
-            raise Exception("No se pudo extraer texto del PDF con ningún método")
-            
-        except Exception as e:
-            raise Exception(f"Error extrayendo texto del PDF: {str(e)}")
-    
-    def analizar_estado_cuenta(self, pdf_path, extraer_movimientos_detallados=True):
-        """
-        Analiza un PDF de estado de cuenta usando Claude Haiku 4.5 (método texto)
-        Siempre extrae movimientos detallados completos.
+        # Cortar la línea en segmentos que empiezan con fecha (tablas lado a lado)
+        segmentos = []
+        actual = []
+        for celda in celdas:
+            if PATRON_CELDA_FECHA.match(celda) and actual and PATRON_CELDA_MONTO.match(actual[-1]):
+                segmentos.append(actual)
+                actual = []
+            actual.append(celda)
+        if actual:
+            segmentos.append(actual)
         
-        Args:
-            pdf_path (str): Ruta al archivo PDF
-            extraer_movimientos_detallados (bool): Siempre True - extrae todos los movimientos detallados
-            
-        Returns:
-            dict: Diccionario con los datos extraídos del estado de cuenta
-        """
-        try:
-            # Extraer texto del PDF
-            texto_pdf = self.extraer_texto_pdf(pdf_path)
-            
-            # Asegurar que el texto esté normalizado (por si acaso)
-            texto_pdf = self.normalizar_texto(texto_pdf)
-            
-            # Debug: mostrar los primeros 500 caracteres del texto extraído
-            # Usar encoding seguro para evitar errores de charmap
-            try:
-                texto_debug = texto_pdf[:500].encode('utf-8', errors='replace').decode('utf-8')
-                print(f"DEBUG - Texto extraído (primeros 500 chars): {texto_debug}")
-            except Exception as e:
-                print(f"DEBUG - Error mostrando texto debug: {str(e)}")
-            print(f"DEBUG - Longitud total del texto: {len(texto_pdf)}")
-            
-            # Prompt para extraer datos básicos + todos los movimientos detallados
-            prompt = f"""Analiza este texto de estado de cuenta bancario y extrae EXACTAMENTE los siguientes campos en formato JSON:
+        for segmento in segmentos:
+            fila = None
+            if len(segmento) >= 3 and PATRON_CELDA_FECHA.match(segmento[0]):
+                montos = []
+                while len(segmento) > len(montos) + 1 and PATRON_CELDA_MONTO.match(segmento[-1 - len(montos)]):
+                    montos.insert(0, segmento[-1 - len(montos)])
+                # Fechas adicionales (ej. fecha de proceso) no forman parte de la descripción
+                resto = segmento[1:len(segmento) - len(montos)]
+                while resto and PATRON_CELDA_FECHA.match(resto[0]):
+                    resto = resto[1:]
+                if montos and resto:
+                    fila = "|".join([segmento[0], " ".join(resto)] + montos)
+            if fila:
+                filas.append(fila)
+            else:
+                otras_lineas.append(" ".join(segmento))
+    return filas, otras_lineas
+
+# Extracción en paralelo con PyMuPDF (configurable por variables de entorno)
+# PDF_EXTRACCION_WORKERS: procesos del pool (1 = siempre en serie)
+# PDF_EXTRACCION_MIN_PAGINAS: a partir de cuántas páginas se usa el pool
+# PDF_EXTRACCION_PAGINAS_POR_RANGO: páginas que extrae cada tarea del pool
+EXTRACCION_WORKERS = int(os.environ.get('PDF_EXTRACCION_WORKERS', str(min(4, os.cpu_count() or 1))))
+EXTRACCION_MIN_PAGINAS = int(os.environ.get('PDF_EXTRACCION_MIN_PAGINAS', '40'))
+EXTRACCION_PAGINAS_POR_RANGO = int(os.environ.get('PDF_EXTRACCION_PAGINAS_POR_RANGO', '25'))
+
+# Páginas escaneadas (sin capa de texto): se envían a la IA como imágenes en escala de grises
+# PDF_IMAGENES_PAGINAS=0 desactiva el respaldo; DPI y lado máximo acotan el tamaño de cada
+# imagen y PDF_IMAGENES_MAX_PAGINAS cuántas páginas se envían por análisis
+IMAGENES_PAGINAS = os.environ.get('PDF_IMAGENES_PAGINAS', '1') not in ('0', 'false', 'False')
+IMAGENES_DPI = int(os.environ.get('PDF_IMAGENES_DPI', '110'))
+IMAGENES_MAX_LADO = int(os.environ.get('PDF_IMAGENES_MAX_LADO', '1568'))
+IMAGENES_MAX_PAGINAS = int(os.environ.get('PDF_IMAGENES_MAX_PAGINAS', '10'))
+MIN_CARACTERES_PAGINA_CON_TEXTO = 20  # Menos que esto se considera una página sin capa de texto
+NOTA_PAGINAS_IMAGEN = """
+8. PÁGINAS ESCANEADAS:
+   - Algunas páginas no tienen texto y se adjuntan como imágenes después de este mensaje
+   - Extrae los datos y movimientos de esas imágenes igual que del texto
+"""
 
-{{
+# Análisis en paralelo de los estados de cuenta de un mismo PDF (varias tarjetas)
+ANALISIS_WORKERS = int(os.environ.get('PDF_ANALISIS_WORKERS', '4'))
+
+# Instrucciones fijas del análisis (idénticas en cada llamada). Se envían como bloque
+# "system" marcado para el caché de prompts de Anthropic; el mensaje del usuario solo
+# lleva las notas variables y el texto del estado de cuenta.
+# PDF_CACHE_PROMPT=0 envía las instrucciones sin la marca de caché
+CACHE_PROMPT = os.environ.get('PDF_CACHE_PROMPT', '1') not in ('0', 'false', 'False')
+# Claude Haiku 4.5 solo cachea prefijos de al menos 4096 tokens: con instrucciones más
+# cortas (hoy ~1.4k) la API ignora la marca (no escribe ni lee el caché, sin costo extra).
+# La marca se envía igual, así el caché funciona en cuanto el prefijo alcance el mínimo
+MIN_TOKENS_CACHE_PROMPT = 4096
+INSTRUCCIONES_ANALISIS = """Analiza este texto de estado de cuenta bancario y extrae EXACTAMENTE los siguientes campos en formato JSON:
+
+{
     "fecha_corte": "DD/MM/YYYY",
     "fecha_inicio_periodo": "DD/MM/YYYY",
     "fecha_pago": "DD/MM/YYYY", 
@@ -172,15 +222,15 @@ class PDFAnalyzer:
     "tipo_tarjeta": "TIPO_TARJETA",
     "ultimos_digitos": "XXX",
     "movimientos_detallados": [
-        {{
+        {
             "fecha": "DD/MM/YYYY",
             "descripcion": "DESCRIPCION_COMPLETA",
             "monto": 0.00,
             "categoria": "CATEGORIA",
             "tipo_transaccion": "consumo|pago|interes|cargo|otro"
-        }}
+        }
     ]
-}}
+}
 
 🔍 **INSTRUCCIONES CRÍTICAS PARA MOVIMIENTOS DETALLADOS:**
 
@@ -266,113 +316,1783 @@ class PDFAnalyzer:
    - Mantén la descripción original del establecimiento
    - Si hay códigos o números, inclúyelos
    - Ejemplo: "SUPERMERCADO WALMART 1234" en lugar de solo "WALMART"
+"""
 
-TEXTO COMPLETO DEL ESTADO DE CUENTA:
-{texto_pdf}"""
+# Salida compacta: cada movimiento es un arreglo con los valores en el orden de
+# "movimientos_columnas" en lugar de un objeto que repite las claves en cada fila
+# (menos tokens de salida). PDF_SALIDA_COMPACTA=0 vuelve a pedir objetos.
+SALIDA_COMPACTA = os.environ.get('PDF_SALIDA_COMPACTA', '1') not in ('0', 'false', 'False')
+COLUMNAS_MOVIMIENTOS = ['fecha', 'descripcion', 'monto', 'categoria', 'tipo_transaccion']
+FORMATO_MOVIMIENTOS_OBJETOS = """    "movimientos_detallados": [
+        {
+            "fecha": "DD/MM/YYYY",
+            "descripcion": "DESCRIPCION_COMPLETA",
+            "monto": 0.00,
+            "categoria": "CATEGORIA",
+            "tipo_transaccion": "consumo|pago|interes|cargo|otro"
+        }
+    ]"""
+FORMATO_MOVIMIENTOS_COMPACTO = """    "movimientos_columnas": ["fecha", "descripcion", "monto", "categoria", "tipo_transaccion"],
+    "movimientos_detallados": [
+        ["DD/MM/YYYY", "DESCRIPCION_COMPLETA", 0.00, "CATEGORIA", "consumo|pago|interes|cargo|otro"]
+    ]"""
+NOTA_SALIDA_COMPACTA = """
+**FORMATO COMPACTO DE MOVIMIENTOS:**
+- Cada movimiento es un arreglo JSON con los valores en el orden de "movimientos_columnas"
+- NO escribas los nombres de los campos en cada movimiento
+- Escribe el JSON sin sangría ni espacios innecesarios, un movimiento por línea
+"""
+INSTRUCCIONES_ANALISIS_COMPACTAS = INSTRUCCIONES_ANALISIS.replace(
+    FORMATO_MOVIMIENTOS_OBJETOS, FORMATO_MOVIMIENTOS_COMPACTO
+).replace(
+    "\n🔍 **INSTRUCCIONES CRÍTICAS PARA MOVIMIENTOS DETALLADOS:**", NOTA_SALIDA_COMPACTA + "\n🔍 **INSTRUCCIONES CRÍTICAS PARA MOVIMIENTOS DETALLADOS:**"
+)
+
+# Estados de cuenta largos: el resumen va en una petición y los movimientos en bloques
+# analizados en paralelo (cada bloque con su propio límite de tokens de salida)
+# PDF_ANALISIS_BLOQUES=0 desactiva el modo por bloques
+# PDF_BLOQUES_FILAS: filas de movimientos por bloque (tablas reconstruidas)
+# PDF_BLOQUES_PAGINAS: páginas por bloque (texto libre)
+# PDF_BLOQUES_SOLAPAMIENTO: filas/líneas del bloque anterior repetidas al inicio del siguiente
+#   (solo como contexto, entre MARCA_CONTEXTO_INICIO y MARCA_CONTEXTO_FIN: no se extraen)
+# PDF_BLOQUES_WORKERS: peticiones simultáneas a la IA
+ANALISIS_BLOQUES = os.environ.get('PDF_ANALISIS_BLOQUES', '1') not in ('0', 'false', 'False')
+BLOQUES_FILAS = int(os.environ.get('PDF_BLOQUES_FILAS', '120'))
+BLOQUES_PAGINAS = int(os.environ.get('PDF_BLOQUES_PAGINAS', '4'))
+BLOQUES_SOLAPAMIENTO = int(os.environ.get('PDF_BLOQUES_SOLAPAMIENTO', '3'))
+BLOQUES_WORKERS = int(os.environ.get('PDF_BLOQUES_WORKERS', '4'))
+BLOQUES_MAX_TOKENS_RESUMEN = 2000
+MARCA_CONTEXTO_INICIO = "[CONTEXTO: final del bloque anterior, NO extraer]"
+MARCA_CONTEXTO_FIN = "[FIN DEL CONTEXTO]"
+NOTA_SOLO_RESUMEN = """
+9. SOLO RESUMEN:
+   - Este texto tiene solo el resumen del estado de cuenta (los movimientos se extraen aparte)
+   - Extrae los campos del resumen y deja "movimientos_detallados" como lista vacía []
+"""
+NOTA_BLOQUE_MOVIMIENTOS = """
+9. EXTRACCIÓN POR BLOQUES:
+   - Este texto es el bloque {indice} de {total} de los movimientos del estado de cuenta
+   - Extrae TODOS los movimientos de este bloque en "movimientos_detallados"
+   - Las líneas entre [CONTEXTO: ...] y [FIN DEL CONTEXTO] ya se extrajeron en el bloque anterior:
+     úsalas solo para entender un movimiento cortado y NO las incluyas en "movimientos_detallados"
+   - Los campos del resumen déjalos en 0.00 o "" (el resumen se extrae aparte)
+"""
+TOLERANCIA_CONCILIACION = 0.05  # Diferencia máxima (USD) entre movimientos y totales del resumen
+
+# Respuestas cortadas por max_tokens: se continúa desde el último movimiento completo
+# (prefill del asistente) en lugar de repetir el análisis. PDF_MAX_CONTINUACIONES=0 desactiva
+MAX_CONTINUACIONES = int(os.environ.get('PDF_MAX_CONTINUACIONES', '2'))
+
+_pools_extraccion = {}
+_pools_extraccion_lock = threading.Lock()
+
+def _obtener_pool_extraccion(workers):
+    """
+    Pool de procesos compartido por todo el proceso (se crea una sola vez por tamaño).
+    Usa 'spawn' para no hacer fork de un worker de gunicorn con hilos activos.
+    """
+    with _pools_extraccion_lock:
+        pool = _pools_extraccion.get(workers)
+        if pool is None:
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+            _pools_extraccion[workers] = pool
+        return pool
+
+def _extraer_rango_paginas(fuente, inicio, fin):
+    """
+    Extrae con PyMuPDF el texto de las páginas [inicio, fin) (se ejecuta en el pool de procesos).
+    Debe ser una función de módulo para poder enviarse a otro proceso.
+    """
+    if isinstance(fuente, (bytes, bytearray)):
+        doc = fitz.open(stream=fuente, filetype='pdf')
+    else:
+        doc = fitz.open(fuente)
+    try:
+        return [doc[page_num].get_text() for page_num in range(inicio, fin)]
+    finally:
+        doc.close()
+
+def dividir_en_rangos(total_paginas, workers, paginas_por_rango=EXTRACCION_PAGINAS_POR_RANGO):
+    """Divide el documento en rangos [inicio, fin) de páginas para repartir entre los workers"""
+    if total_paginas <= 0:
+        return []
+    # Al menos un rango por worker, pero sin pasar de paginas_por_rango páginas por rango
+    tamano = max(1, min(paginas_por_rango, -(-total_paginas // max(1, workers))))
+    return [(inicio, min(inicio + tamano, total_paginas)) for inicio in range(0, total_paginas, tamano)]
+
+# Cliente de Anthropic compartido por todo el proceso: reutiliza las conexiones HTTPS
+# (keep-alive) en lugar de abrir una nueva conexión y hacer el handshake TLS en cada análisis
+IA_TIMEOUT_SEGUNDOS = float(os.environ.get('ANTHROPIC_TIMEOUT', '120'))
+IA_TIMEOUT_CONEXION_SEGUNDOS = float(os.environ.get('ANTHROPIC_TIMEOUT_CONEXION', '10'))
+IA_MAX_REINTENTOS = int(os.environ.get('ANTHROPIC_MAX_REINTENTOS', '2'))
+IA_MAX_CONEXIONES = int(os.environ.get('ANTHROPIC_MAX_CONEXIONES', '20'))
+IA_KEEPALIVE_SEGUNDOS = float(os.environ.get('ANTHROPIC_KEEPALIVE_SEGUNDOS', '60'))
+
+# Llamadas resilientes a la IA (llamar_ia_resiliente): reintentos con backoff exponencial
+# y jitter, plazo total por análisis, petición de cobertura (hedging) opcional y circuit
+# breaker. Los reintentos los hace llamar_ia_resiliente (el SDK solo en streaming)
+IA_PLAZO_SEGUNDOS = float(os.environ.get('ANTHROPIC_PLAZO_SEGUNDOS', '150'))
+IA_BACKOFF_BASE_SEGUNDOS = float(os.environ.get('ANTHROPIC_BACKOFF_BASE', '1'))
+IA_BACKOFF_MAX_SEGUNDOS = float(os.environ.get('ANTHROPIC_BACKOFF_MAX', '20'))
+IA_HEDGING = os.environ.get('ANTHROPIC_HEDGING', '0') not in ('0', 'false', 'False')
+IA_HEDGING_PERCENTIL = 0.95
+IA_HEDGING_MIN_MUESTRAS = 20  # Llamadas exitosas necesarias antes de usar el percentil
+IA_CIRCUITO_FALLOS = int(os.environ.get('ANTHROPIC_CIRCUITO_FALLOS', '5'))
+IA_CIRCUITO_ESPERA_SEGUNDOS = float(os.environ.get('ANTHROPIC_CIRCUITO_ESPERA', '30'))
+ESTADOS_HTTP_REINTENTABLES = {408, 409, 429}  # Además de los 5xx (529 = sobrecarga)
+MENSAJE_IA_NO_DISPONIBLE = ("El servicio de análisis con IA no está disponible en este momento. "
+                            "Intenta de nuevo en unos minutos.")
+
+_cliente_compartido = None
+_analizador_compartido = None
+_pid_cliente = None  # Tras un fork (gunicorn --preload) cada proceso crea su propio cliente
+_cliente_lock = threading.Lock()
+
+def crear_cliente_anthropic(api_key, base_url=None, http_client=None):
+    """Cliente de Anthropic con pool de conexiones keep-alive y timeouts configurables"""
+    if http_client is None:
+        http_client = DefaultHttpxClient(limits=httpx.Limits(
+            max_connections=IA_MAX_CONEXIONES,
+            max_keepalive_connections=IA_MAX_CONEXIONES,
+            keepalive_expiry=IA_KEEPALIVE_SEGUNDOS
+        ))
+    return Anthropic(
+        api_key=api_key,
+        base_url=base_url,
+        timeout=httpx.Timeout(IA_TIMEOUT_SEGUNDOS, connect=IA_TIMEOUT_CONEXION_SEGUNDOS),
+        max_retries=IA_MAX_REINTENTOS,
+        http_client=http_client
+    )
+
+def obtener_cliente_anthropic():
+    """
+    Cliente de Anthropic compartido por el proceso (se crea la primera vez que se usa).
+    Es seguro usarlo desde varios hilos.
+    """
+    global _cliente_compartido, _pid_cliente
+    cliente = _cliente_compartido
+    if cliente is not None and _pid_cliente == os.getpid():
+        return cliente
+    
+    with _cliente_lock:
+        if _cliente_compartido is None or _pid_cliente != os.getpid():
+            # Intentar cargar desde .env primero
+            try:
+                from dotenv import load_dotenv
+                load_dotenv()
+            except:
+                pass
             
-            # Siempre usar 8000 tokens para análisis completo con movimientos detallados
-            max_tokens = 8000
+            api_key = os.environ.get('ANTHROPIC_API_KEY')
+            if not api_key:
+                print("ERROR en obtener_cliente_anthropic: ANTHROPIC_API_KEY no está configurado")
+                print(f"Variables de entorno disponibles: {list(os.environ.keys())}")
+                raise ValueError("ANTHROPIC_API_KEY no está configurado. Verifica las variables de entorno en Render.")
             
-            # Enviar a Claude Haiku 4.5 (método texto)
-            response = self.client.messages.create(
-                model="claude-haiku-4-5",  # Claude Haiku 4.5
-                max_tokens=max_tokens,
-                messages=[{
-                    "role": "user",
-                    "content": prompt
-                }]
+            try:
+                _cliente_compartido = crear_cliente_anthropic(api_key)
+                _pid_cliente = os.getpid()
+                print("DEBUG - Cliente Anthropic compartido inicializado correctamente")
+            except Exception as e:
+                print(f"ERROR inicializando cliente Anthropic: {str(e)}")
+                raise
+        return _cliente_compartido
+
+def obtener_analizador():
+    """
+    PDFAnalyzer compartido por el proceso (no guarda estado por petición, solo el cliente).
+    Usar en lugar de PDFAnalyzer() en cada request.
+    """
+    global _analizador_compartido
+    cliente = obtener_cliente_anthropic()
+    analizador = _analizador_compartido
+    if analizador is None or analizador.client is not cliente:
+        with _cliente_lock:
+            if _analizador_compartido is None or _analizador_compartido.client is not cliente:
+                _analizador_compartido = PDFAnalyzer(client=cliente)
+            analizador = _analizador_compartido
+    return analizador
+
+class ProveedorIANoDisponible(Exception):
+    """La IA no respondió: circuito abierto, plazo agotado o reintentos agotados"""
+    
+    def __init__(self, mensaje=MENSAJE_IA_NO_DISPONIBLE):
+        super().__init__(mensaje)
+
+
+class CircuitoIA:
+    """
+    Circuit breaker de las llamadas a la IA, compartido por el proceso. Después de
+    'fallos_maximos' fallos seguidos del proveedor se abre: las llamadas fallan al
+    instante con ProveedorIANoDisponible durante 'espera' segundos. Luego deja pasar una
+    sola llamada de prueba (semiabierto): si sale bien se cierra, si falla se abre otra vez.
+    También guarda la latencia de las últimas llamadas exitosas (umbral del hedging).
+    """
+    
+    def __init__(self, fallos_maximos=IA_CIRCUITO_FALLOS, espera=IA_CIRCUITO_ESPERA_SEGUNDOS):
+        self.fallos_maximos = fallos_maximos
+        self.espera = espera
+        self.fallos = 0
+        self.abierto_hasta = None
+        self.prueba_en_curso = False
+        self.latencias = deque(maxlen=200)
+        self.lock = threading.Lock()
+    
+    @property
+    def estado(self):
+        with self.lock:
+            if self.abierto_hasta is None:
+                return 'cerrado'
+            return 'abierto' if time.monotonic() < self.abierto_hasta else 'semiabierto'
+    
+    def permitir(self):
+        """Lanza ProveedorIANoDisponible si el circuito está abierto"""
+        with self.lock:
+            if self.abierto_hasta is None:
+                return
+            if time.monotonic() < self.abierto_hasta or self.prueba_en_curso:
+                raise ProveedorIANoDisponible()
+            self.prueba_en_curso = True
+    
+    def registrar_exito(self, duracion=None):
+        """El proveedor respondió (duracion: latencia de una llamada exitosa, para el hedging)"""
+        with self.lock:
+            if self.abierto_hasta is not None:
+                print("DEBUG - Circuito de la IA cerrado: el proveedor volvió a responder")
+            self.fallos = 0
+            self.abierto_hasta = None
+            self.prueba_en_curso = False
+            if duracion is not None:
+                self.latencias.append(duracion)
+    
+    def registrar_fallo(self):
+        with self.lock:
+            self.fallos += 1
+            if self.prueba_en_curso or self.fallos >= self.fallos_maximos:
+                print(f"DEBUG - Circuito de la IA abierto por {self.espera}s ({self.fallos} fallos seguidos)")
+                self.abierto_hasta = time.monotonic() + self.espera
+            self.prueba_en_curso = False
+    
+    def liberar_prueba(self):
+        """La llamada de prueba terminó sin resultado (ej. el cliente se desconectó): otra puede probar"""
+        with self.lock:
+            self.prueba_en_curso = False
+    
+    def umbral_hedging(self):
+        """Percentil IA_HEDGING_PERCENTIL de las latencias recientes (None sin suficientes muestras)"""
+        with self.lock:
+            if len(self.latencias) < IA_HEDGING_MIN_MUESTRAS:
+                return None
+            ordenadas = sorted(self.latencias)
+        return ordenadas[min(len(ordenadas) - 1, int(len(ordenadas) * IA_HEDGING_PERCENTIL))]
+
+
+_circuito_ia = CircuitoIA()
+_pool_hedging = ThreadPoolExecutor(max_workers=2 * IA_MAX_CONEXIONES, thread_name_prefix='ia-hedging')
+
+def es_error_reintentable(error):
+    """Sobrecarga (529), límite de tasa (429), errores 5xx, timeouts y errores de conexión"""
+    if isinstance(error, APIStatusError):
+        return error.status_code >= 500 or error.status_code in ESTADOS_HTTP_REINTENTABLES
+    return isinstance(error, APIConnectionError)  # Incluye APITimeoutError
+
+def espera_reintento(intento, error=None):
+    """Backoff exponencial con jitter completo; respeta el retry-after del proveedor si lo envía"""
+    espera = random.uniform(0, min(IA_BACKOFF_MAX_SEGUNDOS, IA_BACKOFF_BASE_SEGUNDOS * 2 ** intento))
+    try:
+        retry_after = float(error.response.headers.get('retry-after'))
+    except (AttributeError, TypeError, ValueError):
+        return espera
+    return max(espera, min(retry_after, IA_BACKOFF_MAX_SEGUNDOS))
+
+def _crear_mensaje(cliente, peticion, segundos):
+    """messages.create sin los reintentos del SDK y con un timeout que no pasa del plazo"""
+    if hasattr(cliente, 'with_options'):
+        cliente = cliente.with_options(max_retries=0, timeout=httpx.Timeout(
+            min(segundos, IA_TIMEOUT_SEGUNDOS), connect=min(segundos, IA_TIMEOUT_CONEXION_SEGUNDOS)
+        ))
+    return cliente.messages.create(**peticion)
+
+def _crear_mensaje_con_hedging(cliente, peticion, segundos, umbral):
+    """
+    Si la llamada tarda más que 'umbral' se lanza una segunda igual y se usa la primera
+    que responda bien (la otra se descarta, pero igual se cobra)
+    """
+    if umbral is None or umbral >= segundos:
+        return _crear_mensaje(cliente, peticion, segundos)
+    
+    inicio = time.monotonic()
+    primera = _pool_hedging.submit(_crear_mensaje, cliente, peticion, segundos)
+    try:
+        return primera.result(timeout=umbral)
+    except TimeoutFuturo:
+        pass
+    
+    print(f"DEBUG - La IA tarda más de {umbral:.2f}s (p{int(IA_HEDGING_PERCENTIL * 100)}): se lanza una segunda petición")
+    segunda = _pool_hedging.submit(_crear_mensaje, cliente, peticion, segundos - (time.monotonic() - inicio))
+    pendientes = {primera, segunda}
+    while pendientes:
+        terminadas, pendientes = wait(pendientes, return_when=FIRST_COMPLETED)
+        for futuro in terminadas:
+            if futuro.exception() is None:
+                return futuro.result()
+    return primera.result()  # Las dos fallaron: error de la primera
+
+def llamar_ia_resiliente(cliente, peticion, plazo=None, circuito=None, hedging=None):
+    """
+    cliente.messages.create(**peticion) con reintentos (backoff exponencial con jitter)
+    ante sobrecarga, límite de tasa, errores 5xx y de conexión, sin pasar del plazo
+    (instante de time.monotonic(); por defecto IA_PLAZO_SEGUNDOS desde ahora).
+    Con hedging (IA_HEDGING) se lanza una segunda petición si la primera tarda más que
+    el p95 de las anteriores. Los errores que no son del proveedor (p. ej. 400) se
+    propagan sin reintentar.
+    
+    Raises:
+        ProveedorIANoDisponible: circuito abierto, plazo agotado o reintentos agotados
+    """
+    circuito = circuito or _circuito_ia
+    hedging = IA_HEDGING if hedging is None else hedging
+    plazo = plazo or time.monotonic() + IA_PLAZO_SEGUNDOS
+    ultimo_error = None
+    
+    for intento in range(IA_MAX_REINTENTOS + 1):
+        restante = plazo - time.monotonic()
+        if restante <= 0:
+            break
+        circuito.permitir()
+        inicio = time.monotonic()
+        try:
+            response = _crear_mensaje_con_hedging(
+                cliente, peticion, restante, circuito.umbral_hedging() if hedging else None
             )
+        except Exception as e:
+            if not es_error_reintentable(e):
+                circuito.registrar_exito()  # El proveedor respondió; el error es de la petición
+                raise
+            circuito.registrar_fallo()
+            ultimo_error = e
+            espera = espera_reintento(intento, e)
+            print(f"DEBUG - Llamada a la IA falló (intento {intento + 1}/{IA_MAX_REINTENTOS + 1}): "
+                  f"{type(e).__name__}: {str(e)[:200]}")
+            if intento == IA_MAX_REINTENTOS or time.monotonic() + espera >= plazo:
+                break
+            time.sleep(espera)
+            continue
+        except BaseException:
+            # KeyboardInterrupt, cancelación del hilo...: no deja la prueba del circuito ocupada
+            circuito.liberar_prueba()
+            raise
+        circuito.registrar_exito(time.monotonic() - inicio)
+        return response
+    
+    print(f"DEBUG - IA no disponible: {'reintentos agotados' if ultimo_error else 'plazo agotado'}")
+    raise ProveedorIANoDisponible() from ultimo_error
+
+def expandir_movimiento(movimiento, columnas=None):
+    """
+    Movimiento de la respuesta de la IA como dict: un arreglo compacto se convierte con
+    las columnas dadas (por defecto COLUMNAS_MOVIMIENTOS); un objeto se retorna igual.
+    Retorna None si no es ninguno de los dos.
+    """
+    if isinstance(movimiento, dict):
+        return movimiento
+    if isinstance(movimiento, list):
+        return dict(zip(columnas or COLUMNAS_MOVIMIENTOS, movimiento))
+    return None
+
+# Inicio de la lista de movimientos en la respuesta JSON de la IA (para el modo streaming)
+PATRON_INICIO_MOVIMIENTOS = re.compile(r'"movimientos_detallados"\s*:\s*\[')
+
+
+class ParserMovimientosIncremental:
+    """
+    Lee la respuesta JSON de la IA a medida que llega (streaming) y retorna eventos:
+    - ('resumen', dict): los campos anteriores a "movimientos_detallados", apenas empieza la lista
+    - ('movimiento', dict): cada movimiento de "movimientos_detallados" (objeto o arreglo
+      compacto, ver expandir_movimiento), apenas se cierra
+    El JSON completo se sigue validando al final con _procesar_respuesta.
+    """
+    
+    def __init__(self):
+        self.texto = ''
+        self.posicion = 0  # Hasta dónde se revisó el texto
+        self.en_lista = False
+        self.lista_cerrada = False
+        self.profundidad = 0
+        self.en_cadena = False
+        self.escape = False
+        self.inicio_objeto = None
+        self.columnas = COLUMNAS_MOVIMIENTOS
+        self.fin_ultimo_movimiento = None  # Índice después del último movimiento completo
+    
+    @staticmethod
+    def _resumen(prefijo):
+        """Campos del encabezado: el prefijo '{ ... ,' cerrado con '}'"""
+        inicio = prefijo.find('{')
+        if inicio == -1:
+            return None
+        try:
+            return json.loads(prefijo[inicio:].rstrip().rstrip(',') + '}')
+        except json.JSONDecodeError:
+            return None
+    
+    def agregar(self, fragmento):
+        """Agrega un fragmento de texto de la respuesta; retorna la lista de eventos nuevos"""
+        self.texto += fragmento
+        eventos = []
+        
+        if not self.en_lista:
+            # Buscar desde un poco antes por si la clave quedó partida entre fragmentos
+            coincidencia = PATRON_INICIO_MOVIMIENTOS.search(self.texto, max(0, self.posicion - 40))
+            if not coincidencia:
+                self.posicion = len(self.texto)
+                return eventos
+            self.en_lista = True
+            self.posicion = self.fin_ultimo_movimiento = coincidencia.end()
+            resumen = self._resumen(self.texto[:coincidencia.start()])
+            if resumen is not None:
+                self.columnas = resumen.pop('movimientos_columnas', None) or COLUMNAS_MOVIMIENTOS
+                eventos.append(('resumen', resumen))
+        
+        while self.posicion < len(self.texto) and not self.lista_cerrada:
+            caracter = self.texto[self.posicion]
+            if self.en_cadena:
+                if self.escape:
+                    self.escape = False
+                elif caracter == '\\':
+                    self.escape = True
+                elif caracter == '"':
+                    self.en_cadena = False
+            elif caracter == '"':
+                self.en_cadena = True
+            elif caracter in '{[':
+                if self.profundidad == 0:
+                    self.inicio_objeto = self.posicion
+                self.profundidad += 1
+            elif caracter == ']' and self.profundidad == 0:
+                self.lista_cerrada = True
+                self.fin_ultimo_movimiento = self.posicion + 1
+            elif caracter in '}]':
+                self.profundidad -= 1
+                if self.profundidad == 0 and self.inicio_objeto is not None:
+                    self.fin_ultimo_movimiento = self.posicion + 1
+                    try:
+                        movimiento = expandir_movimiento(
+                            json.loads(self.texto[self.inicio_objeto:self.posicion + 1]), self.columnas
+                        )
+                        if movimiento is not None:
+                            eventos.append(('movimiento', movimiento))
+                    except json.JSONDecodeError:
+                        pass  # El JSON final decide; aquí solo se omite del avance
+                    self.inicio_objeto = None
+            self.posicion += 1
+        
+        return eventos
+    
+    def cortar_en_ultimo_movimiento(self):
+        """
+        Para continuar una respuesta cortada por max_tokens: descarta lo que sigue al último
+        movimiento completo (o al cierre de la lista) y deja el parser listo para seguir
+        leyendo desde ahí. Retorna ese texto, o None si la lista de movimientos no empezó.
+        """
+        if not self.en_lista:
+            return None
+        self.texto = self.texto[:self.fin_ultimo_movimiento]
+        self.posicion = len(self.texto)
+        self.profundidad = 0
+        self.en_cadena = False
+        self.escape = False
+        self.inicio_objeto = None
+        return self.texto
+
+
+class PDFAnalyzer:
+    """
+    Analizador de PDFs de estados de cuenta usando Claude Haiku 4.5 (solo método texto)
+    """
+    
+    def __init__(self, client=None):
+        """
+        Inicializar el analizador con el cliente de Anthropic compartido del proceso.
+        client permite inyectar otro cliente con la misma interfaz (client.messages.create),
+        por ejemplo un cliente simulado en pruebas y benchmarks; en ese caso no se
+        requiere ANTHROPIC_API_KEY.
+        """
+        # Sin cliente inyectado se usa el cliente compartido del proceso
+        self.client = client if client is not None else obtener_cliente_anthropic()
+    
+    def normalizar_texto(self, texto):
+        """
+        Normaliza el texto para manejar caracteres Unicode problemáticos
+        Reemplaza caracteres especiales que pueden causar problemas de codificación
+        """
+        if not texto:
+            return ""
+        
+        # Reemplazar caracteres Unicode problemáticos en una sola pasada
+        return texto.translate(TABLA_NORMALIZACION)
+    
+    @staticmethod
+    def minimizar_texto_prompt(texto):
+        """
+        Reduce el texto del estado de cuenta antes de enviarlo al prompt:
+        1. Colapsa espacios y elimina líneas vacías
+        2. Elimina encabezados/pies repetidos: líneas que aparecen en la misma posición
+           (contando desde arriba o desde abajo) en muchas páginas. Se conserva la
+           primera aparición, así no se pierde la fecha de corte ni el número de
+           tarjeta. Nunca elimina líneas que parecen un movimiento (fecha + monto) ni
+           las que están junto a un monto suelto (descripción de un movimiento).
+        3. Elimina páginas sin montos ni fechas (publicidad, avisos legales)
+        
+        Returns:
+            tuple: (texto_minimizado, estadisticas) con tokens estimados antes y después
+        """
+        estadisticas = {
+            'tokens_antes': estimar_tokens(texto),
+            'tokens_despues': estimar_tokens(texto),
+            'lineas_repetidas_eliminadas': 0,
+            'paginas_eliminadas': 0
+        }
+        if not texto:
+            return texto, estadisticas
+        
+        # Separar por las marcas de página que agrega extraer_texto_pdf
+        partes = PATRON_MARCA_PAGINA.split(texto)
+        if len(partes) < 3:
+            paginas = [(None, partes[0])]
+        else:
+            paginas = [(int(partes[i]), partes[i + 1]) for i in range(1, len(partes), 2)]
+        
+        # 1. Colapsar espacios y quitar líneas vacías
+        lineas_por_pagina = []
+        for numero, contenido in paginas:
+            lineas = [PATRON_ESPACIOS.sub(' ', linea).strip() for linea in contenido.split('\n')]
+            lineas_por_pagina.append((numero, [linea for linea in lineas if linea]))
+        
+        # 2. Detectar encabezados/pies: misma línea en la misma posición de muchas páginas
+        def posiciones(total, indice):
+            claves = []
+            if indice < LINEAS_BANDA_ENCABEZADO_PIE:
+                claves.append(('arriba', indice))
+            if total - 1 - indice < LINEAS_BANDA_ENCABEZADO_PIE:
+                claves.append(('abajo', total - 1 - indice))
+            return claves
+        
+        paginas_por_posicion = {}
+        for _, lineas in lineas_por_pagina:
+            for indice, linea in enumerate(lineas):
+                for posicion in posiciones(len(lineas), indice):
+                    clave = (posicion, linea)
+                    paginas_por_posicion[clave] = paginas_por_posicion.get(clave, 0) + 1
+        
+        minimo_repeticiones = max(3, (len(lineas_por_pagina) + 1) // 2)
+        repetidas = {clave for clave, cantidad in paginas_por_posicion.items() if cantidad >= minimo_repeticiones}
+        
+        def es_encabezado_o_pie(lineas, indice):
+            linea = lineas[indice]
+            if PATRON_FECHA.search(linea) and PATRON_MONTO.search(linea):
+                return False
+            vecinas = lineas[max(0, indice - 1):indice] + lineas[indice + 1:indice + 2]
+            if any(PATRON_SOLO_MONTO.match(vecina) for vecina in vecinas):
+                return False
+            return any((posicion, linea) in repetidas for posicion in posiciones(len(lineas), indice))
+        
+        vistas = set()
+        paginas_resultado = []
+        for numero, lineas in lineas_por_pagina:
+            conservadas = []
+            for indice, linea in enumerate(lineas):
+                if es_encabezado_o_pie(lineas, indice):
+                    if linea in vistas:
+                        estadisticas['lineas_repetidas_eliminadas'] += 1
+                        continue
+                    vistas.add(linea)
+                conservadas.append(linea)
             
-            # Extraer el texto de la respuesta
-            response_text = response.content[0].text.strip()
-            
-            # Intentar parsear el JSON
+            # 3. Descartar páginas sin montos ni fechas
+            contenido = '\n'.join(conservadas)
+            if not (PATRON_MONTO.search(contenido) or PATRON_FECHA.search(contenido)):
+                estadisticas['paginas_eliminadas'] += 1
+                continue
+            paginas_resultado.append((numero, contenido))
+        
+        if not paginas_resultado:
+            # Nada parece tener datos: enviar el texto original antes que un prompt vacío
+            return texto, estadisticas
+        
+        if paginas_resultado[0][0] is None:
+            texto_minimizado = paginas_resultado[0][1]
+        else:
+            texto_minimizado = ''.join(f"\n--- PÁGINA {numero} ---\n{contenido}\n" for numero, contenido in paginas_resultado)
+        
+        estadisticas['tokens_despues'] = estimar_tokens(texto_minimizado)
+        return texto_minimizado, estadisticas
+    
+    @staticmethod
+    def _convertir_fecha(dia, mes, anio):
+        """Convierte partes de una fecha a date (años de 2 dígitos se asumen 20XX)"""
+        try:
+            anio = int(anio)
+            if anio < 100:
+                anio += 2000
+            return date(anio, int(mes), int(dia))
+        except (ValueError, TypeError):
+            return None
+    
+    @staticmethod
+    def detectar_identificadores_estado(texto):
+        """
+        Detección local y barata (solo regex, sin IA) de los datos que forman el código
+        del estado de cuenta DDMMAAAA-XXX: fecha de corte y últimos dígitos de la tarjeta.
+        
+        Returns:
+            dict: {'fecha_corte': date | None, 'ultimos_digitos': [candidatos]}
+                  Los candidatos incluyen los últimos 4 y los últimos 3 dígitos, porque
+                  la IA puede haber devuelto cualquiera de los dos formatos.
+        """
+        resultado = {'fecha_corte': None, 'ultimos_digitos': []}
+        if not texto:
+            return resultado
+        
+        # Fecha de corte: primera fecha válida cerca de la etiqueta
+        for etiqueta in PATRON_ETIQUETA_CORTE.finditer(texto):
+            ventana = texto[etiqueta.end():etiqueta.end() + 80]
+            coincidencias = []
+            numerica = PATRON_FECHA_NUMERICA.search(ventana)
+            if numerica:
+                coincidencias.append((numerica.start(), PDFAnalyzer._convertir_fecha(*numerica.groups())))
+            con_mes = PATRON_FECHA_MES_TEXTO.search(ventana)
+            if con_mes:
+                dia, mes, anio = con_mes.groups()
+                coincidencias.append((con_mes.start(), PDFAnalyzer._convertir_fecha(dia, MESES_ABREVIADOS[mes.upper()], anio)))
+            coincidencias = sorted(c for c in coincidencias if c[1])
+            if coincidencias:
+                resultado['fecha_corte'] = coincidencias[0][1]
+                break
+        
+        # Últimos dígitos de la tarjeta: número enmascarado o "terminada en"
+        tarjeta = PATRON_TARJETA_ENMASCARADA.search(texto) or PATRON_TARJETA_TERMINADA.search(texto)
+        if tarjeta:
+            digitos = tarjeta.group(1)
+            resultado['ultimos_digitos'] = [digitos] if len(digitos) == 3 else [digitos, digitos[-3:]]
+        
+        return resultado
+    
+    def _preparar_fuente_pdf(self, fuente):
+        """
+        Acepta la fuente del PDF en cualquiera de estas formas y la deja lista para abrir:
+        - Ruta en disco (str / PathLike)
+        - Buffer en memoria (bytes, bytearray o memoryview)
+        - Stream con .read() (ej. el FileStorage subido en Flask)
+        
+        Los buffers se pasan tal cual a PyMuPDF / PyPDF2, sin escribir archivos temporales.
+        """
+        if isinstance(fuente, (str, os.PathLike)):
+            if not os.path.exists(fuente):
+                raise Exception(f"El archivo temporal no existe: {fuente}")
+            print(f"DEBUG - Intentando extraer texto de: {fuente} (tamaño: {os.path.getsize(fuente)} bytes)")
+            return fuente
+        
+        if hasattr(fuente, 'read'):
+            fuente = fuente.read()
+        
+        if not isinstance(fuente, (bytes, bytearray, memoryview)):
+            raise Exception(f"Fuente de PDF no soportada: {type(fuente).__name__}")
+        
+        if len(fuente) == 0:
+            raise Exception("El PDF recibido está vacío")
+        
+        print(f"DEBUG - Intentando extraer texto desde memoria (tamaño: {len(fuente)} bytes)")
+        return fuente
+    
+    def _paginas_pymupdf(self, fuente, workers=None):
+        """
+        Genera (numero_pagina, texto) con PyMuPDF, una página a la vez.
+        Los documentos grandes se extraen por rangos en el pool de procesos y se
+        entregan en orden; el resultado es idéntico a la extracción en serie.
+        """
+        workers = EXTRACCION_WORKERS if workers is None else workers
+        
+        if isinstance(fuente, (bytes, bytearray, memoryview)):
+            doc = fitz.open(stream=fuente, filetype='pdf')
+        else:
+            doc = fitz.open(fuente)
+        
+        if workers > 1 and doc.page_count >= EXTRACCION_MIN_PAGINAS:
+            total_paginas = doc.page_count
+            doc.close()
+            yield from self._paginas_pymupdf_paralelo(fuente, total_paginas, workers)
+            return
+        
+        try:
+            for page_num in range(doc.page_count):
+                yield page_num + 1, doc[page_num].get_text()
+        finally:
+            doc.close()
+    
+    def _paginas_pymupdf_paralelo(self, fuente, total_paginas, workers):
+        """
+        Reparte los rangos de páginas en el pool de procesos (acotado a 'workers')
+        y reensambla el texto en el orden original
+        """
+        if isinstance(fuente, memoryview):
+            fuente = fuente.tobytes()  # memoryview no se puede enviar a otro proceso
+        
+        rangos = dividir_en_rangos(total_paginas, workers)
+        print(f"DEBUG - Extracción en paralelo: {total_paginas} páginas en {len(rangos)} rangos con {workers} procesos")
+        
+        pool = _obtener_pool_extraccion(workers)
+        futuros = [(inicio, pool.submit(_extraer_rango_paginas, fuente, inicio, fin)) for inicio, fin in rangos]
+        try:
+            for inicio, futuro in futuros:
+                for desplazamiento, texto_pagina in enumerate(futuro.result()):
+                    yield inicio + desplazamiento + 1, texto_pagina
+        finally:
+            # Si el consumidor se detiene antes, no seguir extrayendo rangos pendientes
+            for _, futuro in futuros:
+                futuro.cancel()
+    
+    def _contar_paginas(self, fuente):
+        """Número de páginas del PDF (PyMuPDF y, si falla, PyPDF2); None si ninguno lo abre"""
+        try:
+            if isinstance(fuente, (bytes, bytearray, memoryview)):
+                doc = fitz.open(stream=fuente, filetype='pdf')
+            else:
+                doc = fitz.open(fuente)
+            with doc:
+                return doc.page_count
+        except Exception:
+            pass
+        try:
+            if isinstance(fuente, (bytes, bytearray, memoryview)):
+                return len(PyPDF2.PdfReader(io.BytesIO(fuente)).pages)
+            with open(fuente, 'rb') as file:
+                return len(PyPDF2.PdfReader(file).pages)
+        except Exception:
+            return None
+    
+    def _paginas_pypdf2(self, fuente):
+        """
+        Genera (numero_pagina, texto) con PyPDF2, una página a la vez
+        """
+        if isinstance(fuente, (bytes, bytearray, memoryview)):
+            file = io.BytesIO(fuente)
+        else:
+            file = open(fuente, 'rb')
+        
+        with file:
+            reader = PyPDF2.PdfReader(file)
+            for page_num, page in enumerate(reader.pages):
+                yield page_num + 1, page.extract_text() or ""
+    
+    def iterar_paginas_pdf(self, pdf_fuente, workers=None):
+        """
+        Extrae el texto del PDF página por página (generador).
+        
+        pdf_fuente puede ser una ruta, un buffer en memoria (bytes/memoryview) o el
+        stream del archivo subido. workers permite forzar el número de procesos de
+        extracción (None = PDF_EXTRACCION_WORKERS, 1 = en serie).
+        
+        Cada página se entrega ya normalizada como un diccionario:
+            {'pagina': 1, 'texto': '...', 'caracteres': 1234}
+        
+        Permite que las etapas siguientes filtren páginas o se detengan antes de
+        terminar el documento, sin mantener todo el texto en memoria.
+        Usa PyMuPDF y, si no obtiene texto o falla, continúa con PyPDF2 desde la
+        primera página que no se haya entregado todavía. Las páginas que ningún método
+        pudo leer se entregan vacías (el análisis las envía como imágenes), así el
+        documento nunca queda más corto sin aviso.
+        """
+        fuente = self._preparar_fuente_pdf(pdf_fuente)
+        
+        metodos = [
+            ('PyMuPDF', lambda f: self._paginas_pymupdf(f, workers=workers)),
+            ('PyPDF2', self._paginas_pypdf2)
+        ]
+        ultima_pagina_entregada = 0
+        paginas_vacias = []  # Páginas del método que más páginas leyó (por si todo está escaneado)
+        
+        for nombre_metodo, generar_paginas in metodos:
+            # Las páginas vacías se retienen hasta confirmar que el método encuentra texto;
+            # si ninguna página tiene texto se prueba el siguiente método
+            pendientes = []
+            hay_texto = False
+            caracteres_metodo = 0
             try:
-                # Limpiar el texto para extraer solo el JSON
-                json_start = response_text.find('{')
-                json_end = response_text.rfind('}') + 1
-                
-                if json_start != -1 and json_end != -1:
-                    json_text = response_text[json_start:json_end]
-                    datos_extraidos = json.loads(json_text)
-                    
-                    # Validar que tenemos los campos requeridos
-                    campos_requeridos = [
-                        'fecha_corte', 'fecha_inicio_periodo', 'fecha_pago', 'cupo_autorizado', 
-                        'cupo_disponible', 'cupo_utilizado', 'deuda_anterior',
-                        'consumos_debitos', 'otros_cargos', 'consumos_cargos_totales',
-                        'pagos_creditos', 'intereses', 'minimo_a_pagar', 'deuda_total_pagar',
-                        'nombre_banco', 'tipo_tarjeta', 'ultimos_digitos'
-                    ]
-                    
-                    for campo in campos_requeridos:
-                        if campo not in datos_extraidos:
-                            if campo in ['nombre_banco', 'tipo_tarjeta', 'ultimos_digitos']:
-                                datos_extraidos[campo] = ""
-                            else:
-                                datos_extraidos[campo] = 0.00
-                    
-                    # Validar movimientos detallados (siempre se extraen)
-                    if 'movimientos_detallados' not in datos_extraidos:
-                        datos_extraidos['movimientos_detallados'] = []
-                    
-                    # Validar cada movimiento
-                    movimientos_validos = []
-                    for movimiento in datos_extraidos['movimientos_detallados']:
-                        if isinstance(movimiento, dict):
-                            monto_raw = movimiento.get('monto', 0)
-                            # Asegurar que el monto sea siempre positivo
-                            monto_positivo = abs(float(monto_raw)) if monto_raw else 0
-                            
-                            movimiento_valido = {
-                                'fecha': movimiento.get('fecha', ''),
-                                'descripcion': movimiento.get('descripcion', ''),
-                                'monto': monto_positivo,
-                                'categoria': movimiento.get('categoria', 'Otros'),
-                                'tipo_transaccion': movimiento.get('tipo_transaccion', 'otro')
-                            }
-                            movimientos_validos.append(movimiento_valido)
+                for numero_pagina, texto_pagina in generar_paginas(fuente):
+                    if numero_pagina <= ultima_pagina_entregada:
+                        continue
                     
-                    datos_extraidos['movimientos_detallados'] = movimientos_validos
-                    print(f"DEBUG - Movimientos detallados extraídos: {len(movimientos_validos)}")
-                    
-                    # Validación adicional: mostrar algunos movimientos para verificar
-                    if movimientos_validos:
-                        print("DEBUG - Primeros 3 movimientos extraídos:")
-                        for i, mov in enumerate(movimientos_validos[:3]):
-                            print(f"  {i+1}. {mov['descripcion']} - ${mov['monto']} ({mov['categoria']})")
-                    
-                    # Los nombres se estandarizarán en app.py después de recibir el resultado
-                    # Aquí solo limpiamos los espacios
-                    if 'nombre_banco' in datos_extraidos and datos_extraidos['nombre_banco']:
-                        datos_extraidos['nombre_banco'] = datos_extraidos['nombre_banco'].strip()
-                    
-                    if 'tipo_tarjeta' in datos_extraidos and datos_extraidos['tipo_tarjeta']:
-                        datos_extraidos['tipo_tarjeta'] = datos_extraidos['tipo_tarjeta'].strip()
-                    
-                    return {
-                        'status': 'success',
-                        'data': datos_extraidos,
-                        'raw_response': response_text,
-                        'method': 'texto',
-                        'extraer_movimientos_detallados': extraer_movimientos_detallados
-                    }
-                else:
-                    return {
-                        'status': 'error',
-                        'message': 'No se pudo extraer JSON de la respuesta',
-                        'raw_response': response_text,
-                        'method': 'texto'
+                    texto_pagina = self.normalizar_texto(texto_pagina)
+                    bloque = {
+                        'pagina': numero_pagina,
+                        'texto': texto_pagina,
+                        'caracteres': len(texto_pagina)
                     }
                     
-            except json.JSONDecodeError as e:
+                    if not hay_texto:
+                        if not texto_pagina.strip():
+                            pendientes.append(bloque)
+                            continue
+                        hay_texto = True
+                        for bloque_pendiente in pendientes:
+                            ultima_pagina_entregada = bloque_pendiente['pagina']
+                            yield bloque_pendiente
+                        pendientes = []
+                    
+                    caracteres_metodo += bloque['caracteres']
+                    ultima_pagina_entregada = numero_pagina
+                    yield bloque
+                
+                if hay_texto:
+                    print(f"DEBUG - {nombre_metodo} extrajo {caracteres_metodo} caracteres")
+                    return
+            except Exception as e:
+                print(f"DEBUG - {nombre_metodo} falló: {str(e)}")
+            if len(pendientes) > len(paginas_vacias):
+                paginas_vacias = pendientes
+        
+        # Algún método entregó páginas pero el siguiente no pudo leer las que faltaban
+        if ultima_pagina_entregada > 0:
+            total_paginas = self._contar_paginas(fuente) or max(
+                [ultima_pagina_entregada] + [bloque['pagina'] for bloque in paginas_vacias]
+            )
+            if total_paginas > ultima_pagina_entregada:
+                print(f"DEBUG - Páginas {ultima_pagina_entregada + 1}-{total_paginas} sin texto legible: se entregan vacías")
+                for numero_pagina in range(ultima_pagina_entregada + 1, total_paginas + 1):
+                    yield {'pagina': numero_pagina, 'texto': '', 'caracteres': 0}
+            return
+        
+        # Si ningún método encontró texto
+        if IMAGENES_PAGINAS and paginas_vacias:
+            # PDF escaneado: se entregan las páginas vacías y el análisis las enviará como imágenes
+            print(f"DEBUG - Ningún método encontró texto; {len(paginas_vacias)} páginas se analizarán como imágenes")
+            yield from paginas_vacias
+            return
+        raise Exception("No se pudo extraer texto del PDF con ningún método")
+    
+    def extraer_texto_pdf(self, pdf_fuente, workers=None):
+        """
+        Extrae texto del PDF usando múltiples métodos (más robusto)
+        pdf_fuente puede ser una ruta, bytes/memoryview o un stream (ver iterar_paginas_pdf)
+        """
+        try:
+            partes = []
+            for bloque in self.iterar_paginas_pdf(pdf_fuente, workers=workers):
+                partes.append(f"\n--- PÁGINA {bloque['pagina']} ---\n")
+                partes.append(bloque['texto'])
+            
+            return "".join(partes)
+            
+        except Exception as e:
+            raise Exception(f"Error extrayendo texto del PDF: {str(e)}")
+    
+    def extraer_tablas_pdf(self, pdf_fuente):
+        """
+        Reconstruye localmente las tablas de movimientos usando las coordenadas de
+        las palabras (PyMuPDF), en lugar del texto libre de page.get_text().
+        
+        Returns:
+            dict: {
+                'filas': ['15/01/2025|SUPERMAXI|45.30', ...],
+                'resumen': [...],   # Líneas fuera de las tablas con datos (cupos, totales, fechas)
+                'texto': '...',     # Texto compacto listo para el prompt
+                'paginas': 12
+            }
+        """
+        fuente = self._preparar_fuente_pdf(pdf_fuente)
+        if isinstance(fuente, (bytes, bytearray, memoryview)):
+            doc = fitz.open(stream=fuente, filetype='pdf')
+        else:
+            doc = fitz.open(fuente)
+        
+        filas = []
+        resumen = []
+        vistas = set()
+        try:
+            for page_num in range(doc.page_count):
+                palabras = [
+                    (x0, y0, x1, y1, self.normalizar_texto(texto))
+                    for x0, y0, x1, y1, texto, *_ in doc[page_num].get_text("words")
+                ]
+                filas_pagina, otras_lineas = reconstruir_filas_pagina(palabras)
+                filas.extend(filas_pagina)
+                
+                # Resumen: toda la primera página y, en las demás, solo líneas con montos o
+                # fechas (totales, fechas de pago); sin repetir encabezados ni pies
+                for linea in otras_lineas:
+                    if linea in vistas:
+                        continue
+                    if page_num == 0 or PATRON_MONTO.search(linea) or PATRON_FECHA.search(linea):
+                        vistas.add(linea)
+                        resumen.append(linea)
+            paginas = doc.page_count
+        finally:
+            doc.close()
+        
+        texto = (
+            "RESUMEN:\n" + "\n".join(resumen) +
+            "\n\nMOVIMIENTOS (fecha|descripción|monto):\n" + "\n".join(filas)
+        )
+        return {'filas': filas, 'resumen': resumen, 'texto': texto, 'paginas': paginas}
+    
+    @staticmethod
+    def paginas_sin_texto(texto_pdf):
+        """Números de página cuyo texto extraído está vacío (páginas escaneadas)"""
+        return [
+            numero for numero, texto in PDFAnalyzer.paginas_desde_texto(texto_pdf)
+            if len(texto.strip()) < MIN_CARACTERES_PAGINA_CON_TEXTO
+        ]
+    
+    def renderizar_paginas_imagen(self, pdf_fuente, numeros_pagina, dpi=None, max_lado=None, paginas_documento=None):
+        """
+        Renderiza las páginas indicadas (numeradas desde 1) como PNG en escala de grises,
+        reducidas a 'dpi' y sin pasar de 'max_lado' píxeles en el lado mayor.
+        
+        paginas_documento: número original de cada página del PDF, en orden, si es un
+        sub-documento (ver _subdocumento_pdf); numeros_pagina usa esos números.
+        
+        Returns:
+            list: [{'pagina': 3, 'media_type': 'image/png', 'data': '<base64>', 'bytes': 123456}, ...]
+        """
+        dpi = IMAGENES_DPI if dpi is None else dpi
+        max_lado = IMAGENES_MAX_LADO if max_lado is None else max_lado
+        
+        fuente = self._preparar_fuente_pdf(pdf_fuente)
+        if isinstance(fuente, (bytes, bytearray, memoryview)):
+            doc = fitz.open(stream=fuente, filetype='pdf')
+        else:
+            doc = fitz.open(fuente)
+        
+        indices = ({numero: indice for indice, numero in enumerate(paginas_documento)} if paginas_documento
+                   else {numero: numero - 1 for numero in numeros_pagina})
+        imagenes = []
+        try:
+            for numero in numeros_pagina:
+                page = doc[indices[numero]]
+                escala = dpi / 72
+                lado_mayor = max(page.rect.width, page.rect.height) * escala
+                if lado_mayor > max_lado:
+                    escala *= max_lado / lado_mayor
+                pixmap = page.get_pixmap(matrix=fitz.Matrix(escala, escala), colorspace=fitz.csGRAY, alpha=False)
+                png = pixmap.tobytes('png')
+                imagenes.append({
+                    'pagina': numero,
+                    'media_type': 'image/png',
+                    'data': base64.b64encode(png).decode('ascii'),
+                    'bytes': len(png)
+                })
+        finally:
+            doc.close()
+        return imagenes
+    
+    @staticmethod
+    def paginas_desde_texto(texto_pdf):
+        """Separa el texto de extraer_texto_pdf en [(numero_pagina, texto), ...]"""
+        partes = PATRON_MARCA_PAGINA.split(texto_pdf)
+        return [(int(partes[i]), partes[i + 1]) for i in range(1, len(partes) - 1, 2)]
+    
+    @classmethod
+    def dividir_estados_en_paginas(cls, paginas):
+        """
+        Detecta los límites entre estados de cuenta de un mismo PDF (tarjeta principal
+        y adicionales, o Visa y Mastercard del mismo banco).
+        
+        Cada página se asigna a la tarjeta que aparece primero en ella (encabezado);
+        las páginas sin tarjeta siguen a la anterior. Una tarjeta solo forma un estado
+        aparte si sus páginas tienen fecha de corte; si no, se une al grupo anterior.
+        
+        Returns:
+            list: grupos de páginas [(numero_pagina, texto), ...], en el orden del documento
+        """
+        grupos = []  # [(tarjeta, [paginas])]
+        indice_por_tarjeta = {}
+        actual = None
+        for numero, texto in paginas:
+            digitos = cls.detectar_identificadores_estado(texto)['ultimos_digitos']
+            tarjeta = digitos[-1] if digitos else None  # Últimos 3 dígitos (4321 y 321 son la misma)
+            if tarjeta and tarjeta not in indice_por_tarjeta:
+                indice_por_tarjeta[tarjeta] = len(grupos)
+                grupos.append((tarjeta, []))
+            if tarjeta:
+                actual = indice_por_tarjeta[tarjeta]
+            if actual is None:
+                if not grupos:
+                    grupos.append((None, []))
+                actual = 0
+            grupos[actual][1].append((numero, texto))
+        
+        estados = []
+        for _, paginas_grupo in grupos:
+            tiene_corte = any(PATRON_ETIQUETA_CORTE.search(texto) for _, texto in paginas_grupo)
+            if estados and not tiene_corte:
+                estados[-1] = sorted(estados[-1] + paginas_grupo)
+            else:
+                estados.append(paginas_grupo)
+        return estados
+    
+    def _subdocumento_pdf(self, fuente, numeros_pagina):
+        """PDF en memoria (bytes) solo con las páginas indicadas (numeradas desde 1)"""
+        if isinstance(fuente, (bytes, bytearray, memoryview)):
+            doc = fitz.open(stream=fuente, filetype='pdf')
+        else:
+            doc = fitz.open(fuente)
+        try:
+            subdocumento = fitz.open()
+            for numero in numeros_pagina:
+                subdocumento.insert_pdf(doc, from_page=numero - 1, to_page=numero - 1)
+            pdf_bytes = subdocumento.tobytes()
+            subdocumento.close()
+            return pdf_bytes
+        finally:
+            doc.close()
+    
+    def analizar_estados_cuenta(self, pdf_fuente, extraer_movimientos_detallados=True, texto_pdf=None):
+        """
+        Analiza un PDF que puede contener varios estados de cuenta.
+        
+        Separa el documento por tarjeta (ver dividir_estados_en_paginas) y analiza cada
+        parte en paralelo con analizar_estado_cuenta, así cada estado tiene su propio
+        límite de tokens de salida.
+        
+        Returns:
+            list: un resultado de analizar_estado_cuenta por estado de cuenta, en orden
+        """
+        if not texto_pdf:
+            texto_pdf = self.extraer_texto_pdf(pdf_fuente)
+        
+        grupos = self.dividir_estados_en_paginas(self.paginas_desde_texto(texto_pdf))
+        if len(grupos) <= 1:
+            return [self.analizar_estado_cuenta(pdf_fuente, extraer_movimientos_detallados, texto_pdf=texto_pdf)]
+        
+        print(f"DEBUG - El PDF contiene {len(grupos)} estados de cuenta: "
+              f"{[[numero for numero, _ in grupo] for grupo in grupos]}")
+        fuente = self._preparar_fuente_pdf(pdf_fuente)
+        partes = [
+            (
+                self._subdocumento_pdf(fuente, [numero for numero, _ in grupo]),
+                "".join(f"\n--- PÁGINA {numero} ---\n{texto}" for numero, texto in grupo)
+            )
+            for grupo in grupos
+        ]
+        
+        with ThreadPoolExecutor(max_workers=max(1, min(len(partes), ANALISIS_WORKERS))) as pool:
+            futuros = [
+                pool.submit(self.analizar_estado_cuenta, subdocumento, extraer_movimientos_detallados, texto,
+                            paginas_documento=[numero for numero, _ in grupo])
+                for (subdocumento, texto), grupo in zip(partes, grupos)
+            ]
+            return [futuro.result() for futuro in futuros]
+    
+    # ===== ANÁLISIS EN LOTE (Message Batches) =====
+    
+    def preparar_lote(self, pdf_fuente, texto_pdf=None):
+        """
+        Etapas locales de analizar_estados_cuenta sin llamar a la IA, para enviar las
+        peticiones en un lote. Retorna un contexto por estado de cuenta del PDF; cada uno
+        trae 'peticiones' (la petición única, o resumen + bloques) o, si lo resolvió un
+        parser local, 'resultado'. pdf_fuente puede ser None si se da texto_pdf.
+        """
+        if not texto_pdf:
+            texto_pdf = self.extraer_texto_pdf(pdf_fuente)
+        
+        grupos = self.dividir_estados_en_paginas(self.paginas_desde_texto(texto_pdf))
+        partes = [(pdf_fuente, texto_pdf, None)]
+        if len(grupos) > 1:
+            fuente = self._preparar_fuente_pdf(pdf_fuente) if pdf_fuente is not None else None
+            partes = [
+                (
+                    self._subdocumento_pdf(fuente, [numero for numero, _ in grupo]) if fuente is not None else None,
+                    "".join(f"\n--- PÁGINA {numero} ---\n{texto}" for numero, texto in grupo),
+                    [numero for numero, _ in grupo]
+                )
+                for grupo in grupos
+            ]
+        
+        contextos = []
+        for subdocumento, texto, paginas_documento in partes:
+            contexto = self._preparar_analisis(subdocumento, True, texto, paginas_documento=paginas_documento)
+            if 'resultado' not in contexto:
+                contexto['peticiones'] = (self._peticiones_bloques(contexto) if contexto['bloques']
+                                          else [contexto['peticion']])
+            contextos.append(contexto)
+        return contextos
+    
+    def resultado_lote(self, contexto, respuestas):
+        """
+        Resultado de un contexto de preparar_lote a partir de las respuestas del lote
+        (objetos Message, en el orden de contexto['peticiones']). Una respuesta None
+        (petición con error o vencida en el lote) se pide en el momento; las cortadas por
+        max_tokens se continúan como en analizar_estado_cuenta.
+        """
+        if 'resultado' in contexto:
+            return contexto['resultado']
+        
+        # El plazo corre desde ahora, no desde que se preparó el lote
+        contexto['plazo'] = time.monotonic() + IA_PLAZO_SEGUNDOS
+        try:
+            resultados = [
+                self._analizar_con_ia(peticion, contexto, response)
+                for peticion, response in zip(contexto['peticiones'], respuestas)
+            ]
+            if not contexto['bloques']:
+                return resultados[0]
+            resultado = self._unir_resultados_bloques(resultados, contexto)
+            if resultado:
+                return resultado
+            resultado = self._analizar_con_ia(contexto['peticion'], contexto)
+            # Los bloques descartados también se cobraron
+            uso_tokens, uso_tokens_lote = dict(resultado.get('uso_tokens') or {}), {}
+            for r in resultados:
+                self._sumar_uso(uso_tokens, r.get('uso_tokens') or {})
+                self._sumar_uso(uso_tokens_lote, r.get('uso_tokens_lote') or {})
+            resultado['uso_tokens'] = uso_tokens
+            resultado['uso_tokens_lote'] = uso_tokens_lote or None
+            return resultado
+        
+        except ProveedorIANoDisponible as e:
+            return {'status': 'error', 'message': str(e), 'method': 'lote', 'error_type': type(e).__name__}
+        except Exception as e:
+            print(f"ERROR en resultado_lote: {str(e)}")
+            return {'status': 'error', 'message': f'Error analizando PDF: {str(e)}', 'method': 'lote',
+                    'error_type': type(e).__name__}
+    
+    def enviar_lote(self, peticiones):
+        """
+        Crea un lote con las peticiones ({custom_id: kwargs de messages.create}).
+        Retorna el id del lote. Lanza la excepción del cliente si el endpoint de lotes
+        no está disponible (el llamador puede analizar directamente).
+        """
+        lote = self.client.messages.batches.create(requests=[
+            {'custom_id': custom_id, 'params': peticion} for custom_id, peticion in peticiones.items()
+        ])
+        print(f"DEBUG - Lote {lote.id} creado con {len(peticiones)} peticiones")
+        return lote.id
+    
+    def esperar_lote(self, lote_id, intervalo=30, progreso=None):
+        """
+        Consulta el lote cada 'intervalo' segundos hasta que termina; progreso(lote) se
+        llama en cada consulta. Retorna el lote terminado.
+        """
+        while True:
+            lote = self.client.messages.batches.retrieve(lote_id)
+            if progreso:
+                progreso(lote)
+            if lote.processing_status == 'ended':
+                return lote
+            time.sleep(intervalo)
+    
+    def respuestas_lote(self, lote_id):
+        """{custom_id: Message} de las peticiones exitosas de un lote terminado"""
+        respuestas = {}
+        for item in self.client.messages.batches.results(lote_id):
+            if item.result.type == 'succeeded':
+                respuestas[item.custom_id] = item.result.message
+            else:
+                print(f"DEBUG - Petición {item.custom_id} del lote sin respuesta: {item.result.type}")
+        return respuestas
+    
+    @staticmethod
+    def combinar_resultados(resultados, texto_pdf=None):
+        """
+        Junta los resultados de analizar_estados_cuenta en un solo resultado.
+        Con un solo estado retorna ese resultado tal cual; con varios, 'estados' tiene
+        la lista y 'method' es 'multiple'.
+        """
+        if len(resultados) == 1:
+            return resultados[0]
+        
+        exitosos = [r for r in resultados if r.get('status') == 'success']
+        if not exitosos:
+            return resultados[0]
+        
+        # Tokens de todas las llamadas a la IA (incluidas las que fallaron) y la parte del lote
+        uso_tokens = {}
+        uso_tokens_lote = {}
+        for r in resultados:
+            PDFAnalyzer._sumar_uso(uso_tokens, r.get('uso_tokens') or {})
+            PDFAnalyzer._sumar_uso(uso_tokens_lote, r.get('uso_tokens_lote') or {})
+        
+        # Las partes se analizan en paralelo: por fase cuenta la más lenta
+        tiempos = {}
+        for r in resultados:
+            for clave, valor in (r.get('tiempos') or {}).items():
+                if valor is not None:
+                    tiempos[clave] = max(tiempos.get(clave, 0), valor)
+        
+        return {
+            'status': 'success',
+            'estados': resultados,
+            'raw_response': "\n".join(r.get('raw_response', '') for r in exitosos),
+            'texto_extraido': texto_pdf,
+            'method': 'multiple',
+            'uso_tokens': uso_tokens or None,
+            'uso_tokens_lote': uso_tokens_lote or None,
+            'tiempos': tiempos,
+            # Si todos se resolvieron con parsers locales no se usó la IA
+            'uso_ia': any(r.get('method') != 'parser_local' for r in exitosos)
+        }
+    
+    @staticmethod
+    def _contenido_mensaje(prompt, imagenes):
+        """Contenido del mensaje: solo texto, o texto + un bloque de imagen por página escaneada"""
+        if not imagenes:
+            return prompt
+        contenido = [{"type": "text", "text": prompt}]
+        for imagen in imagenes:
+            contenido.append({"type": "text", "text": f"--- PÁGINA {imagen['pagina']} (imagen) ---"})
+            contenido.append({
+                "type": "image",
+                "source": {"type": "base64", "media_type": imagen['media_type'], "data": imagen['data']}
+            })
+        return contenido
+    
+    @staticmethod
+    def _bloques_sistema():
+        """
+        Instrucciones fijas como bloque system, marcado para el caché de prompts si está
+        activo (la API decide si el prefijo alcanza el mínimo cacheable)
+        """
+        bloque = {"type": "text", "text": INSTRUCCIONES_ANALISIS_COMPACTAS if SALIDA_COMPACTA else INSTRUCCIONES_ANALISIS}
+        if CACHE_PROMPT:
+            bloque["cache_control"] = {"type": "ephemeral"}
+        return [bloque]
+    
+    @staticmethod
+    def _uso_tokens(response):
+        """Tokens reportados por la API en response.usage (incluye lectura/escritura del caché)"""
+        uso = getattr(response, 'usage', None)
+        return {
+            'input_tokens': getattr(uso, 'input_tokens', None) or 0,
+            'output_tokens': getattr(uso, 'output_tokens', None) or 0,
+            'cache_read_input_tokens': getattr(uso, 'cache_read_input_tokens', None) or 0,
+            'cache_creation_input_tokens': getattr(uso, 'cache_creation_input_tokens', None) or 0
+        }
+    
+    def _preparar_analisis(self, pdf_fuente, extraer_movimientos_detallados=True, texto_pdf=None, paginas_documento=None):
+        """
+        Etapas locales del análisis: extracción de texto, tablas, parsers locales por banco,
+        minimización del prompt e imágenes de páginas escaneadas. paginas_documento: números
+        originales de las páginas de un sub-documento (ver renderizar_paginas_imagen).
+        
+        Returns:
+            dict: {'resultado': ...} si un parser local resolvió el estado de cuenta, o
+                  {'peticion': kwargs de messages.create, ...} con el contexto para
+                  procesar la respuesta de la IA (ver _procesar_respuesta)
+        """
+        # Tiempos por fase (segundos): extracción (si el texto no vino dado) y preparación
+        tiempos = {}
+        
+        # Extraer texto del PDF (ya normalizado página por página)
+        if not texto_pdf:
+            inicio = time.perf_counter()
+            texto_pdf = self.extraer_texto_pdf(pdf_fuente)
+            tiempos['extraccion'] = segundos_desde(inicio)
+        inicio_preparacion = time.perf_counter()
+        
+        # Debug: mostrar los primeros 500 caracteres del texto extraído
+        # Usar encoding seguro para evitar errores de charmap
+        try:
+            texto_debug = texto_pdf[:500].encode('utf-8', errors='replace').decode('utf-8')
+            print(f"DEBUG - Texto extraído (primeros 500 chars): {texto_debug}")
+        except Exception as e:
+            print(f"DEBUG - Error mostrando texto debug: {str(e)}")
+        print(f"DEBUG - Longitud total del texto: {len(texto_pdf)}")
+        
+        # Reconstruir las tablas con coordenadas (para los parsers locales y el prompt)
+        tablas = None
+        if (TABLAS_LOCALES or PARSERS_LOCALES) and pdf_fuente is not None:
+            try:
+                tablas = self.extraer_tablas_pdf(pdf_fuente)
+                print(f"DEBUG - Tablas locales: {len(tablas['filas'])} filas, {len(tablas['resumen'])} líneas de resumen")
+            except Exception as e:
+                print(f"DEBUG - Reconstrucción de tablas falló, se usa el texto libre: {str(e)}")
+        
+        # Bancos conocidos: parseo local sin IA si el formato se reconoce y los totales cuadran
+        if PARSERS_LOCALES and tablas and tablas['filas']:
+            from parsers_bancos import analizar_con_parsers_locales
+            resultado_local = analizar_con_parsers_locales(texto_pdf, tablas)
+            if resultado_local:
+                nombre_parser, datos_extraidos = resultado_local
+                print(f"DEBUG - Estado de cuenta analizado localmente con el parser de {nombre_parser}: "
+                      f"{len(datos_extraidos['movimientos_detallados'])} movimientos")
+                return {'resultado': {
+                    'status': 'success',
+                    'data': datos_extraidos,
+                    'raw_response': '',
+                    'texto_extraido': texto_pdf,
+                    'minimizacion_prompt': None,
+                    'method': 'parser_local',
+                    'parser': nombre_parser,
+                    'tiempos': dict(tiempos, preparacion=segundos_desde(inicio_preparacion)),
+                    'extraer_movimientos_detallados': extraer_movimientos_detallados
+                }}
+        
+        # Preferir las filas reconstruidas para el prompt; si no se reconocen
+        # suficientes movimientos se usa el texto libre
+        if not TABLAS_LOCALES or (tablas and len(tablas['filas']) < TABLAS_MIN_FILAS):
+            tablas = None
+        
+        # Reducir tokens del prompt: sin encabezados/pies repetidos ni páginas sin datos
+        texto_prompt = texto_pdf
+        minimizacion = None
+        if tablas:
+            texto_prompt = tablas['texto']
+            minimizacion = {
+                'tokens_antes': estimar_tokens(texto_pdf),
+                'tokens_despues': estimar_tokens(texto_prompt),
+                'filas_tabla': len(tablas['filas'])
+            }
+            print(f"DEBUG - Tokens estimados del texto: {minimizacion['tokens_antes']} -> {minimizacion['tokens_despues']} (filas de tabla)")
+        elif MINIMIZAR_PROMPT:
+            texto_prompt, minimizacion = self.minimizar_texto_prompt(texto_pdf)
+            print(f"DEBUG - Tokens estimados del texto: {minimizacion['tokens_antes']} -> {minimizacion['tokens_despues']} "
+                  f"({minimizacion['lineas_repetidas_eliminadas']} líneas repetidas y "
+                  f"{minimizacion['paginas_eliminadas']} páginas sin datos eliminadas)")
+        
+        # Páginas sin capa de texto (escaneadas): se envían como imágenes, hasta el límite
+        imagenes = []
+        paginas_imagen_omitidas = []
+        if IMAGENES_PAGINAS and pdf_fuente is not None:
+            paginas_vacias = self.paginas_sin_texto(texto_pdf)
+            if paginas_vacias:
+                paginas_imagen_omitidas = paginas_vacias[IMAGENES_MAX_PAGINAS:]
+                try:
+                    imagenes = self.renderizar_paginas_imagen(pdf_fuente, paginas_vacias[:IMAGENES_MAX_PAGINAS],
+                                                              paginas_documento=paginas_documento)
+                except Exception as e:
+                    print(f"DEBUG - No se pudieron renderizar las páginas sin texto: {str(e)}")
+                print(f"DEBUG - Páginas sin texto enviadas como imagen: {[i['pagina'] for i in imagenes]} "
+                      f"({sum(i['bytes'] for i in imagenes)} bytes); omitidas: {paginas_imagen_omitidas}")
+        
+        notas = (NOTA_FORMATO_TABLAS if tablas else "") + (NOTA_PAGINAS_IMAGEN if imagenes else "")
+        
+        # Estados de cuenta largos: resumen y bloques de movimientos en paralelo
+        # (las páginas escaneadas van siempre en una sola petición con sus imágenes)
+        bloques = None
+        if ANALISIS_BLOQUES and not imagenes:
+            bloques = self.dividir_en_bloques(tablas, texto_prompt)
+            if bloques:
+                print(f"DEBUG - Análisis por bloques: resumen + {len(bloques['partes'])} bloques de movimientos")
+        
+        tiempos['preparacion'] = segundos_desde(inicio_preparacion)
+        return {
+            'peticion': self._peticion_ia(texto_prompt, notas, imagenes),
+            'plazo': time.monotonic() + IA_PLAZO_SEGUNDOS,  # Todas las llamadas del análisis
+            'notas': notas,
+            'bloques': bloques,
+            'tiempos': tiempos,
+            'texto_pdf': texto_pdf,
+            'tablas': tablas,
+            'minimizacion': minimizacion,
+            'imagenes': imagenes,
+            'paginas_imagen_omitidas': paginas_imagen_omitidas,
+            'extraer_movimientos_detallados': extraer_movimientos_detallados
+        }
+    
+    def _peticion_ia(self, texto_prompt, notas="", imagenes=(), max_tokens=8000):
+        """
+        Argumentos de messages.create para Claude Haiku 4.5. Solo la parte variable va en
+        el mensaje del usuario; las instrucciones fijas (INSTRUCCIONES_ANALISIS) van en el
+        bloque system cacheable. Por defecto 8000 tokens para el análisis completo con
+        movimientos detallados.
+        """
+        prompt = f"""{notas}
+TEXTO COMPLETO DEL ESTADO DE CUENTA:
+{texto_prompt}"""
+        return {
+            'model': "claude-haiku-4-5",  # Claude Haiku 4.5
+            'max_tokens': max_tokens,
+            'system': self._bloques_sistema(),
+            'messages': [{
+                "role": "user",
+                "content": self._contenido_mensaje(prompt, imagenes)
+            }]
+        }
+    
+    @staticmethod
+    def dividir_en_bloques(tablas, texto_prompt):
+        """
+        Divide el texto de un estado de cuenta largo para el análisis por bloques.
+        
+        Con tablas reconstruidas el resumen es el bloque RESUMEN y los movimientos se
+        parten cada BLOQUES_FILAS filas; con texto libre el resumen es la primera página y
+        los bloques son grupos de BLOQUES_PAGINAS páginas. Cada bloque repite al inicio las
+        últimas BLOQUES_SOLAPAMIENTO filas/líneas del anterior para no cortar un movimiento,
+        marcadas como contexto que no se extrae (MARCA_CONTEXTO_INICIO/MARCA_CONTEXTO_FIN).
+        
+        Returns:
+            dict | None: {'resumen': str, 'partes': [str, ...]}, o None si cabe en una petición
+        """
+        if tablas:
+            filas = tablas['filas']
+            if len(filas) <= BLOQUES_FILAS:
+                return None
+            resumen = "RESUMEN:\n" + "\n".join(tablas['resumen'])
+            encabezado = "MOVIMIENTOS (fecha|descripción|monto):\n"
+            grupos = [filas[i:i + BLOQUES_FILAS] for i in range(0, len(filas), BLOQUES_FILAS)]
+        else:
+            paginas = PDFAnalyzer.paginas_desde_texto(texto_prompt)
+            if len(paginas) <= BLOQUES_PAGINAS:
+                return None
+            numero, texto = paginas[0]
+            resumen = f"--- PÁGINA {numero} ---\n{texto}"
+            encabezado = ""
+            grupos = [
+                "".join(f"\n--- PÁGINA {numero} ---\n{texto}" for numero, texto in paginas[i:i + BLOQUES_PAGINAS]).split("\n")
+                for i in range(0, len(paginas), BLOQUES_PAGINAS)
+            ]
+        
+        partes = []
+        for indice, grupo in enumerate(grupos):
+            solapamiento = []
+            if indice and BLOQUES_SOLAPAMIENTO:
+                solapamiento = [linea for linea in grupos[indice - 1] if linea.strip()][-BLOQUES_SOLAPAMIENTO:]
+                solapamiento = [MARCA_CONTEXTO_INICIO] + solapamiento + [MARCA_CONTEXTO_FIN]
+            partes.append(encabezado + "\n".join(solapamiento + grupo))
+        return {'resumen': resumen, 'partes': partes}
+    
+    @staticmethod
+    def conciliar_movimientos(datos):
+        """
+        Compara la suma de los movimientos con los totales del resumen:
+        cargos (todo lo que no es pago) contra consumos_debitos (o consumos + otros cargos
+        e intereses, o consumos_cargos_totales) y pagos contra pagos_creditos.
+        """
+        def monto(campo):
+            try:
+                return float(datos.get(campo) or 0)
+            except (TypeError, ValueError):
+                return 0.0
+        
+        movimientos = datos.get('movimientos_detallados', [])
+        cargos = round(sum(m['monto'] for m in movimientos if m.get('tipo_transaccion') != 'pago'), 2)
+        pagos = round(sum(m['monto'] for m in movimientos if m.get('tipo_transaccion') == 'pago'), 2)
+        
+        candidatos_cargos = [c for c in (
+            monto('consumos_debitos'),
+            monto('consumos_debitos') + monto('otros_cargos') + monto('intereses'),
+            monto('consumos_debitos') + monto('otros_cargos'),
+            monto('consumos_cargos_totales')
+        ) if c > 0]
+        return {
+            'cargos_movimientos': cargos,
+            'pagos_movimientos': pagos,
+            'consumos_debitos': monto('consumos_debitos'),
+            'pagos_creditos': monto('pagos_creditos'),
+            'cuadra_cargos': any(abs(c - cargos) <= TOLERANCIA_CONCILIACION for c in candidatos_cargos) if candidatos_cargos else None,
+            'cuadra_pagos': abs(monto('pagos_creditos') - pagos) <= TOLERANCIA_CONCILIACION
+        }
+    
+    def _peticiones_bloques(self, contexto):
+        """Peticiones del análisis por bloques: primero la del resumen, luego una por bloque"""
+        bloques = contexto['bloques']
+        total = len(bloques['partes'])
+        peticiones = [self._peticion_ia(bloques['resumen'], contexto['notas'] + NOTA_SOLO_RESUMEN,
+                                        max_tokens=BLOQUES_MAX_TOKENS_RESUMEN)]
+        peticiones += [
+            self._peticion_ia(parte, contexto['notas'] + NOTA_BLOQUE_MOVIMIENTOS.format(indice=indice, total=total))
+            for indice, parte in enumerate(bloques['partes'], start=1)
+        ]
+        return peticiones
+    
+    def _analizar_por_bloques(self, contexto):
+        """
+        Analiza el resumen y los bloques de movimientos en paralelo (hasta BLOQUES_WORKERS
+        peticiones a la vez), une los movimientos y los concilia con el resumen.
+        Retorna None si alguna petición falla (se usa la petición única).
+        """
+        peticiones = self._peticiones_bloques(contexto)
+        inicio = time.perf_counter()
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, min(len(peticiones), BLOQUES_WORKERS))) as pool:
+                resultados = list(pool.map(lambda peticion: self._analizar_con_ia(peticion, contexto), peticiones))
+        except ProveedorIANoDisponible:
+            raise  # La petición única también fallaría
+        except Exception as e:
+            print(f"DEBUG - Análisis por bloques falló ({str(e)}), se usa una sola petición")
+            return None
+        
+        # Llamadas en paralelo: cuenta el tiempo real de todas
+        return self._unir_resultados_bloques(resultados, contexto, segundos_desde(inicio))
+    
+    def _unir_resultados_bloques(self, resultados, contexto, duracion_llamada=None):
+        """
+        Une los resultados del resumen y de los bloques (en el orden de _peticiones_bloques)
+        en un solo resultado. Retorna None si alguno falló o si los movimientos unidos no
+        cuadran con los totales del resumen (ej. filas de contexto extraídas dos veces).
+        """
+        fallidos = [indice for indice, r in enumerate(resultados) if r.get('status') != 'success']
+        if fallidos:
+            print(f"DEBUG - Bloques con error {fallidos} (0 = resumen), se usa una sola petición")
+            return None
+        
+        datos_extraidos = dict(resultados[0]['data'])
+        datos_extraidos['movimientos_detallados'] = [
+            movimiento for r in resultados[1:] for movimiento in r['data']['movimientos_detallados']
+        ]
+        conciliacion = self.conciliar_movimientos(datos_extraidos)
+        print(f"DEBUG - Bloques unidos: {len(datos_extraidos['movimientos_detallados'])} movimientos; "
+              f"conciliación: {conciliacion}")
+        if conciliacion['cuadra_cargos'] is False or not conciliacion['cuadra_pagos']:
+            print("DEBUG - Los bloques no cuadran con el resumen, se usa una sola petición")
+            return None
+        
+        uso_tokens = {}
+        uso_tokens_lote = {}
+        for r in resultados:
+            self._sumar_uso(uso_tokens, r['uso_tokens'])
+            self._sumar_uso(uso_tokens_lote, r.get('uso_tokens_lote') or {})
+        
+        return dict(
+            resultados[0],
+            data=datos_extraidos,
+            raw_response="\n".join(r['raw_response'] for r in resultados),
+            method='bloques',
+            bloques=len(resultados) - 1,
+            continuaciones=sum(r['continuaciones'] for r in resultados),
+            truncado=any(r.get('truncado') for r in resultados),
+            conciliacion=conciliacion,
+            uso_tokens=uso_tokens,
+            uso_tokens_lote=uso_tokens_lote or None,
+            tiempos=dict(
+                contexto['tiempos'],
+                llamada_ia=duracion_llamada,
+                parseo_json=round(sum(r['tiempos']['parseo_json'] for r in resultados), 4)
+            )
+        )
+    
+    @staticmethod
+    def _texto_respuesta(response):
+        """Texto de una respuesta de la IA (bloques de texto concatenados)"""
+        return "".join(getattr(bloque, 'text', '') for bloque in response.content)
+    
+    @staticmethod
+    def _peticion_continuacion(peticion, prefijo):
+        """Petición que continúa una respuesta cortada: el texto ya recibido va como prefill del asistente"""
+        return dict(peticion, messages=peticion['messages'] + [{"role": "assistant", "content": prefijo.rstrip()}])
+    
+    @staticmethod
+    def _cerrar_json_truncado(parser):
+        """JSON parseable con los movimientos completos de una respuesta que sigue cortada"""
+        return parser.texto + ("}" if parser.lista_cerrada else "]}")
+    
+    @staticmethod
+    def _sumar_uso(uso_tokens, otro):
+        """Suma los tokens de otra llamada (continuación) a uso_tokens"""
+        for clave, valor in otro.items():
+            uso_tokens[clave] = uso_tokens.get(clave, 0) + valor
+        return uso_tokens
+    
+    def _llamar_ia(self, peticion, plazo=None, response=None):
+        """
+        Llama a la IA y, si la respuesta se corta por max_tokens, pide la continuación desde
+        el último movimiento completo (hasta MAX_CONTINUACIONES veces) en lugar de repetir el
+        análisis. Si sigue cortada se cierra el JSON con los movimientos completos.
+        Cada llamada pasa por llamar_ia_resiliente con el mismo plazo. Con 'response' (la
+        respuesta de un lote, ver resultado_lote) solo se piden las continuaciones.
+        
+        Returns:
+            tuple: (response_text, uso_tokens, duracion_llamada, continuaciones, truncado)
+        """
+        inicio = time.perf_counter()
+        if response is None:
+            response = llamar_ia_resiliente(self.client, peticion, plazo)
+        response_text = self._texto_respuesta(response)
+        uso_tokens = self._uso_tokens(response)
+        
+        continuaciones = 0
+        truncado = False
+        parser = None
+        while getattr(response, 'stop_reason', None) == 'max_tokens':
+            parser = ParserMovimientosIncremental()
+            parser.agregar(response_text)
+            prefijo = parser.cortar_en_ultimo_movimiento()
+            if prefijo is None:
+                break
+            if continuaciones >= MAX_CONTINUACIONES:
+                truncado = True
+                response_text = self._cerrar_json_truncado(parser)
+                break
+            
+            continuaciones += 1
+            print(f"DEBUG - Respuesta cortada por max_tokens: continuación {continuaciones} "
+                  f"desde el carácter {len(prefijo)}")
+            response = llamar_ia_resiliente(self.client, self._peticion_continuacion(peticion, prefijo), plazo)
+            response_text = prefijo.rstrip() + self._texto_respuesta(response)
+            self._sumar_uso(uso_tokens, self._uso_tokens(response))
+        
+        return response_text.strip(), uso_tokens, segundos_desde(inicio), continuaciones, truncado
+    
+    def _analizar_con_ia(self, peticion, contexto, response=None):
+        """
+        Llamada a la IA (con continuaciones) + _procesar_respuesta. Con la respuesta de un
+        lote, 'uso_tokens_lote' es la parte de 'uso_tokens' cobrada con el descuento del
+        lote (las continuaciones se piden en el momento, a precio normal)
+        """
+        response_text, uso_tokens, duracion_llamada, continuaciones, truncado = self._llamar_ia(
+            peticion, contexto.get('plazo'), response
+        )
+        resultado = self._procesar_respuesta(response_text, uso_tokens, contexto, duracion_llamada)
+        if response is not None:
+            resultado['uso_tokens_lote'] = self._uso_tokens(response)
+        resultado['continuaciones'] = continuaciones
+        if truncado:
+            # Movimientos parciales: la respuesta siguió cortada después de las continuaciones
+            resultado['truncado'] = True
+        return resultado
+    
+    @staticmethod
+    def validar_movimiento(movimiento):
+        """Normaliza un movimiento de la respuesta de la IA (monto siempre positivo, valores por defecto)"""
+        monto_raw = movimiento.get('monto', 0)
+        # Asegurar que el monto sea siempre positivo
+        monto_positivo = abs(float(monto_raw)) if monto_raw else 0
+        
+        return {
+            'fecha': movimiento.get('fecha', ''),
+            'descripcion': movimiento.get('descripcion', ''),
+            'monto': monto_positivo,
+            'categoria': movimiento.get('categoria', 'Otros'),
+            'tipo_transaccion': movimiento.get('tipo_transaccion', 'otro')
+        }
+    
+    def _procesar_respuesta(self, response_text, uso_tokens, contexto, duracion_llamada=None):
+        """
+        Parsea y valida el JSON de la respuesta de la IA; retorna el resultado del análisis
+        con 'uso_tokens' (response.usage) y 'tiempos' (segundos por fase, incluida la
+        llamada a la IA medida por quien la hizo)
+        """
+        inicio = time.perf_counter()
+        tiempos = dict(contexto['tiempos'], llamada_ia=duracion_llamada)
+        texto_pdf = contexto['texto_pdf']
+        tablas = contexto['tablas']
+        imagenes = contexto['imagenes']
+        print(f"DEBUG - Tokens: {uso_tokens['input_tokens']} entrada, {uso_tokens['output_tokens']} salida, "
+              f"caché {uso_tokens['cache_read_input_tokens']} leídos / {uso_tokens['cache_creation_input_tokens']} escritos")
+        
+        # Intentar parsear el JSON
+        try:
+            # Limpiar el texto para extraer solo el JSON
+            json_start = response_text.find('{')
+            json_end = response_text.rfind('}') + 1
+            
+            if json_start != -1 and json_end != -1:
+                json_text = response_text[json_start:json_end]
+                datos_extraidos = json.loads(json_text)
+                
+                # Validar que tenemos los campos requeridos
+                campos_requeridos = [
+                    'fecha_corte', 'fecha_inicio_periodo', 'fecha_pago', 'cupo_autorizado', 
+                    'cupo_disponible', 'cupo_utilizado', 'deuda_anterior',
+                    'consumos_debitos', 'otros_cargos', 'consumos_cargos_totales',
+                    'pagos_creditos', 'intereses', 'minimo_a_pagar', 'deuda_total_pagar',
+                    'nombre_banco', 'tipo_tarjeta', 'ultimos_digitos'
+                ]
+                
+                for campo in campos_requeridos:
+                    if campo not in datos_extraidos:
+                        if campo in ['nombre_banco', 'tipo_tarjeta', 'ultimos_digitos']:
+                            datos_extraidos[campo] = ""
+                        else:
+                            datos_extraidos[campo] = 0.00
+                
+                # Validar movimientos detallados (siempre se extraen)
+                if 'movimientos_detallados' not in datos_extraidos:
+                    datos_extraidos['movimientos_detallados'] = []
+                
+                # Validar cada movimiento (los arreglos de la salida compacta se expanden a dict)
+                columnas = datos_extraidos.pop('movimientos_columnas', None)
+                movimientos_validos = []
+                for movimiento in datos_extraidos['movimientos_detallados']:
+                    movimiento = expandir_movimiento(movimiento, columnas)
+                    if movimiento is not None:
+                        movimientos_validos.append(self.validar_movimiento(movimiento))
+                
+                datos_extraidos['movimientos_detallados'] = movimientos_validos
+                print(f"DEBUG - Movimientos detallados extraídos: {len(movimientos_validos)}")
+                
+                # Validación adicional: mostrar algunos movimientos para verificar
+                if movimientos_validos:
+                    print("DEBUG - Primeros 3 movimientos extraídos:")
+                    for i, mov in enumerate(movimientos_validos[:3]):
+                        print(f"  {i+1}. {mov['descripcion']} - ${mov['monto']} ({mov['categoria']})")
+                
+                # Los nombres se estandarizarán en app.py después de recibir el resultado
+                # Aquí solo limpiamos los espacios
+                if 'nombre_banco' in datos_extraidos and datos_extraidos['nombre_banco']:
+                    datos_extraidos['nombre_banco'] = datos_extraidos['nombre_banco'].strip()
+                
+                if 'tipo_tarjeta' in datos_extraidos and datos_extraidos['tipo_tarjeta']:
+                    datos_extraidos['tipo_tarjeta'] = datos_extraidos['tipo_tarjeta'].strip()
+                
+                return {
+                    'status': 'success',
+                    'data': datos_extraidos,
+                    'raw_response': response_text,
+                    'texto_extraido': texto_pdf,
+                    'minimizacion_prompt': contexto['minimizacion'],
+                    'paginas_imagen': [imagen['pagina'] for imagen in imagenes],
+                    'paginas_imagen_omitidas': contexto['paginas_imagen_omitidas'],
+                    'method': 'tablas' if tablas else 'texto',
+                    'uso_tokens': uso_tokens,
+                    'tiempos': dict(tiempos, parseo_json=segundos_desde(inicio)),
+                    'extraer_movimientos_detallados': contexto['extraer_movimientos_detallados']
+                }
+            else:
                 return {
                     'status': 'error',
-                    'message': f'Error parseando JSON: {str(e)}',
+                    'message': 'No se pudo extraer JSON de la respuesta',
                     'raw_response': response_text,
+                    'uso_tokens': uso_tokens,
+                    'tiempos': dict(tiempos, parseo_json=segundos_desde(inicio)),
                     'method': 'texto'
                 }
                 
+        except json.JSONDecodeError as e:
+            return {
+                'status': 'error',
+                'message': f'Error parseando JSON: {str(e)}',
+                'raw_response': response_text,
+                'uso_tokens': uso_tokens,
+                'tiempos': dict(tiempos, parseo_json=segundos_desde(inicio)),
+                'method': 'texto'
+            }
+    
+    def analizar_estado_cuenta(self, pdf_fuente, extraer_movimientos_detallados=True, texto_pdf=None, paginas_documento=None):
+        """
+        Analiza un PDF de estado de cuenta usando Claude Haiku 4.5 (método texto)
+        Siempre extrae movimientos detallados completos.
+        
+        Args:
+            pdf_fuente (str | bytes | memoryview | stream): Ruta al PDF o su contenido en memoria
+            extraer_movimientos_detallados (bool): Siempre True - extrae todos los movimientos detallados
+            texto_pdf (str): Texto ya extraído con extraer_texto_pdf (evita extraerlo de nuevo)
+            paginas_documento (list): Números originales de las páginas si pdf_fuente es un
+                sub-documento de analizar_estados_cuenta (las marcas de texto los conservan)
+            
+        Returns:
+            dict: Diccionario con los datos extraídos del estado de cuenta
+        """
+        try:
+            contexto = self._preparar_analisis(pdf_fuente, extraer_movimientos_detallados, texto_pdf, paginas_documento)
+            if 'resultado' in contexto:
+                return contexto['resultado']
+            
+            if contexto['bloques']:
+                resultado = self._analizar_por_bloques(contexto)
+                if resultado:
+                    return resultado
+            
+            return self._analizar_con_ia(contexto['peticion'], contexto)
+        
+        except ProveedorIANoDisponible as e:
+            return {
+                'status': 'error',
+                'message': str(e),
+                'method': 'texto',
+                'error_type': type(e).__name__
+            }
         except Exception as e:
             import traceback
             error_traceback = traceback.format_exc()
@@ -384,10 +2104,137 @@ TEXTO COMPLETO DEL ESTADO DE CUENTA:
                 'method': 'texto',
                 'error_type': type(e).__name__
             }
+    
+    def analizar_estado_cuenta_stream(self, pdf_fuente, extraer_movimientos_detallados=True, texto_pdf=None):
+        """
+        Igual que analizar_estado_cuenta pero con la respuesta de la IA en streaming.
+        
+        Genera tuplas (evento, datos):
+            ('resumen', dict): campos del estado de cuenta, antes que los movimientos
+            ('movimiento', dict): cada movimiento validado, a medida que llega
+            ('resultado', dict): el resultado final, igual al de analizar_estado_cuenta
+        Un estado resuelto por un parser local o por bloques solo genera el resultado.
+        """
+        try:
+            contexto = self._preparar_analisis(pdf_fuente, extraer_movimientos_detallados, texto_pdf)
+            if 'resultado' in contexto:
+                yield ('resultado', contexto['resultado'])
+                return
+            
+            # Los bloques se analizan en paralelo sin streaming: solo se genera el resultado
+            if contexto['bloques']:
+                resultado = self._analizar_por_bloques(contexto)
+                if resultado:
+                    yield ('resultado', resultado)
+                    return
+            
+            parser = ParserMovimientosIncremental()
+            peticion = contexto['peticion']
+            plazo = contexto.get('plazo') or time.monotonic() + IA_PLAZO_SEGUNDOS
+            uso_tokens = {}
+            continuaciones = 0
+            truncado = False
+            inicio = time.perf_counter()
+            while True:
+                # Mismo plazo y circuit breaker que llamar_ia_resiliente; los reintentos al
+                # abrir el stream los hace el SDK (no se puede reintentar a mitad del stream)
+                restante = plazo - time.monotonic()
+                if restante <= 0:
+                    raise ProveedorIANoDisponible()
+                _circuito_ia.permitir()
+                cliente = self.client
+                if hasattr(cliente, 'with_options'):
+                    cliente = cliente.with_options(timeout=httpx.Timeout(
+                        min(restante, IA_TIMEOUT_SEGUNDOS), connect=min(restante, IA_TIMEOUT_CONEXION_SEGUNDOS)
+                    ))
+                try:
+                    with cliente.messages.stream(**peticion) as stream:
+                        for fragmento in stream.text_stream:
+                            if time.monotonic() > plazo:
+                                raise ProveedorIANoDisponible()
+                            for evento, datos in parser.agregar(fragmento):
+                                if evento == 'movimiento':
+                                    datos = self.validar_movimiento(datos)
+                                yield (evento, datos)
+                        response = stream.get_final_message()
+                except Exception as e:
+                    # Vencer el plazo a mitad del stream cuenta como fallo del proveedor
+                    if es_error_reintentable(e) or isinstance(e, ProveedorIANoDisponible):
+                        _circuito_ia.registrar_fallo()
+                    else:
+                        _circuito_ia.registrar_exito()
+                    raise
+                except BaseException:
+                    # GeneratorExit (el cliente SSE se desconectó) no es Exception: sin esto la
+                    # prueba del circuito semiabierto quedaría tomada y rechazaría toda llamada
+                    _circuito_ia.liberar_prueba()
+                    raise
+                _circuito_ia.registrar_exito()
+                self._sumar_uso(uso_tokens, self._uso_tokens(response))
+                if response.stop_reason != 'max_tokens':
+                    break
+                
+                # Cortada por max_tokens: seguir desde el último movimiento completo
+                # (los movimientos ya enviados no se repiten)
+                prefijo = parser.cortar_en_ultimo_movimiento()
+                if prefijo is None:
+                    break
+                if continuaciones >= MAX_CONTINUACIONES:
+                    truncado = True
+                    parser.texto = self._cerrar_json_truncado(parser)
+                    break
+                continuaciones += 1
+                print(f"DEBUG - Respuesta cortada por max_tokens: continuación {continuaciones} (streaming)")
+                peticion = self._peticion_continuacion(contexto['peticion'], prefijo)
+                parser.texto = prefijo.rstrip()
+                parser.posicion = len(parser.texto)
+            duracion_llamada = segundos_desde(inicio)
+            
+            resultado = self._procesar_respuesta(parser.texto.strip(), uso_tokens, contexto, duracion_llamada)
+            resultado['continuaciones'] = continuaciones
+            if truncado:
+                resultado['truncado'] = True
+            yield ('resultado', resultado)
+        
+        except ProveedorIANoDisponible as e:
+            yield ('resultado', {
+                'status': 'error',
+                'message': str(e),
+                'method': 'texto',
+                'error_type': type(e).__name__
+            })
+        except Exception as e:
+            import traceback
+            print(f"ERROR en analizar_estado_cuenta_stream: {str(e)}")
+            print(f"Traceback completo: {traceback.format_exc()}")
+            yield ('resultado', {
+                'status': 'error',
+                'message': f'Error analizando PDF: {str(e)}',
+                'method': 'texto',
+                'error_type': type(e).__name__
+            })
+    
+    def analizar_estados_cuenta_stream(self, pdf_fuente, extraer_movimientos_detallados=True, texto_pdf=None):
+        """
+        Versión en streaming de analizar_estados_cuenta (ver analizar_estado_cuenta_stream).
+        Si el PDF trae varios estados de cuenta se analizan en paralelo sin streaming y
+        solo se genera el resultado combinado.
+        """
+        if not texto_pdf:
+            texto_pdf = self.extraer_texto_pdf(pdf_fuente)
+        
+        if len(self.dividir_estados_en_paginas(self.paginas_desde_texto(texto_pdf))) > 1:
+            resultados = self.analizar_estados_cuenta(pdf_fuente, extraer_movimientos_detallados, texto_pdf=texto_pdf)
+            yield ('resultado', self.combinar_resultados(resultados, texto_pdf))
+            return
+        
+        yield from self.analizar_estado_cuenta_stream(pdf_fuente, extraer_movimientos_detallados, texto_pdf=texto_pdf)
 
-    def formatear_resultados(self, resultado):
+    @staticmethod
+    def formatear_resultados(resultado):
         """
         Formatea los resultados para mostrarlos en la interfaz
+        (no usa el cliente de IA, se puede llamar sin instanciar el analizador)
         """
         try:
             if not isinstance(resultado, dict):
@@ -396,6 +2243,21 @@ TEXTO COMPLETO DEL ESTADO DE CUENTA:
             if resultado.get('status') == 'error':
                 return resultado
             
+            # Varios estados de cuenta en el mismo PDF: 'data' es una lista
+            if 'estados' in resultado:
+                formateados = [PDFAnalyzer.formatear_resultados(r) for r in resultado['estados']]
+                exitosos = [f['data'] for f in formateados if f.get('status') == 'success']
+                if not exitosos:
+                    return formateados[0]
+                # Los que fallaron no se muestran ni se guardan: se informan en el aviso de éxito
+                errores = [f.get('message') or 'Error desconocido' for f in formateados if f.get('status') != 'success']
+                return {
+                    'status': 'success',
+                    'data': exitosos,
+                    'estados_con_error': len(errores),
+                    'errores_estados': errores
+                }
+            
             datos = resultado.get('data', {})
             
             if not datos:
@@ -439,7 +2301,7 @@ def test_analyzer():
     try:
         analyzer = PDFAnalyzer()
         print("PDFAnalyzer inicializado correctamente")
-        print(f"API Key configurado: {'SI' if analyzer.api_key else 'NO'}")
+        print(f"Cliente compartido: {'SI' if analyzer.client is obtener_cliente_anthropic() else 'NO'}")
         
     except Exception as e:
         print(f"Error en la prueba del analizador: {str(e)}")
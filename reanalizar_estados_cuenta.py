@@ -0,0 +1,374 @@
+"""
+Script para volver a analizar muchos estados de cuenta de una vez (por ejemplo después de
+un cambio en el prompt) y guardarlos sobrescribiendo los existentes.
+
+Las peticiones de todos los PDFs se envían en un solo lote (Message Batches, mitad de
+precio). Si el endpoint de lotes no está disponible, o con --sin-lote, se analizan
+directamente con varias peticiones a la vez (--workers).
+
+El progreso se guarda en un archivo de checkpoint (--checkpoint): si el script se
+interrumpe, al ejecutarlo de nuevo con el mismo checkpoint retoma el lote ya enviado y
+salta los PDFs ya guardados.
+
+Uso:
+    python reanalizar_estados_cuenta.py --usuario correo@ejemplo.com estados/*.pdf
+    python reanalizar_estados_cuenta.py --usuario 3 carpeta_pdfs/ --checkpoint reanalisis.json
+    python reanalizar_estados_cuenta.py --usuario 3 carpeta_pdfs/ --sin-lote --workers 8
+    python reanalizar_estados_cuenta.py --desde-cache   (solo actualiza la caché de análisis)
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from app import app, db
+from app import (
+    CacheAnalisisPDF, EstadoCuentaDuplicadoException, Usuario, calcular_costo_ia, calcular_hash_pdf,
+    guardar_cache_analisis, guardar_estado_cuenta, registrar_metrica_ia
+)
+from pdf_analyzer import PDFAnalyzer, obtener_analizador
+
+MODELO_IA = 'claude-haiku-4-5'
+TIPO_OPERACION = 'reanalisis_lote'
+
+# Estados de un documento en el checkpoint
+PENDIENTE = 'pendiente'
+EN_LOTE = 'en_lote'
+GUARDADO = 'guardado'
+ERROR = 'error'
+
+
+def cargar_checkpoint(ruta):
+    if ruta and os.path.exists(ruta):
+        with open(ruta, encoding='utf-8') as archivo:
+            checkpoint = json.load(archivo)
+        print(f"📂 Retomando desde {ruta}: "
+              f"{sum(1 for d in checkpoint['documentos'].values() if d['estado'] == GUARDADO)} ya guardados")
+        return checkpoint
+    return {'lote_id': None, 'documentos': {}}
+
+
+def guardar_checkpoint(ruta, checkpoint):
+    """Escritura atómica: un corte a mitad de escritura no deja el checkpoint corrupto"""
+    if not ruta:
+        return
+    temporal = ruta + '.tmp'
+    with open(temporal, 'w', encoding='utf-8') as archivo:
+        json.dump(checkpoint, archivo, ensure_ascii=False, indent=2)
+    os.replace(temporal, ruta)
+
+
+def rutas_pdf(entradas):
+    """Archivos .pdf de la lista (las carpetas se recorren, sin subcarpetas), ordenados"""
+    rutas = []
+    for entrada in entradas:
+        if os.path.isdir(entrada):
+            rutas += [os.path.join(entrada, nombre) for nombre in os.listdir(entrada) if nombre.lower().endswith('.pdf')]
+        else:
+            rutas.append(entrada)
+    return sorted(set(rutas))
+
+
+def buscar_usuario(identificador):
+    if identificador.isdigit():
+        return Usuario.query.get(int(identificador))
+    return Usuario.query.filter_by(email=identificador).first()
+
+
+def custom_id(hash_pdf, indice_estado, indice_peticion):
+    """custom_id del lote (máx. 64 caracteres [a-zA-Z0-9_-]): documento, estado y petición"""
+    return f"{hash_pdf[:40]}-{indice_estado}-{indice_peticion}"
+
+
+def leer_fuente(documento):
+    """(pdf_bytes, texto_pdf) del documento: el PDF del disco o el texto de la caché"""
+    if documento.get('ruta'):
+        with open(documento['ruta'], 'rb') as archivo:
+            return archivo.read(), None
+    entrada = CacheAnalisisPDF.query.filter_by(hash_sha256=documento['hash']).first()
+    if not entrada or not entrada.texto_extraido:
+        raise ValueError("La entrada de caché ya no existe o no tiene texto")
+    return None, entrada.texto_extraido
+
+
+def analizar_documento(analizador, documento, fuente, respuestas):
+    """
+    Resultados del documento (uno por estado de cuenta) con las respuestas del lote; las
+    que faltan se piden en el momento. No usa la base de datos (corre en el pool de hilos).
+    """
+    pdf_bytes, texto_pdf = fuente
+    contextos = analizador.preparar_lote(pdf_bytes, texto_pdf=texto_pdf)
+    resultados = []
+    for indice, contexto in enumerate(contextos):
+        peticiones = contexto.get('peticiones', [])
+        respuestas_estado = [respuestas.get(custom_id(documento['hash'], indice, i)) for i in range(len(peticiones))]
+        resultados.append(analizador.resultado_lote(contexto, respuestas_estado))
+    return resultados
+
+
+def guardar_con_sobrescritura(usuario_id, datos, archivo_original):
+    """
+    guardar_estado_cuenta; si el estado ya existe se sobrescribe con las categorías del
+    nuevo análisis (el re-análisis se hace para aplicar el prompt actual)
+    """
+    try:
+        return guardar_estado_cuenta(usuario_id, datos, archivo_original)
+    except EstadoCuentaDuplicadoException as e:
+        return guardar_estado_cuenta(
+            usuario_id, datos, archivo_original,
+            sobrescribir=True,
+            estado_cuenta_id_sobrescribir=e.estado_cuenta_existente.id,
+            conservar_categorias=False
+        )
+
+
+def guardar_documento(documento, resultados, usuario_id, duracion):
+    """
+    Actualiza la caché de análisis y guarda los estados de cuenta sobrescribiendo (solo
+    con usuario). Actualiza documento['estado'] y retorna el costo estimado: solo las
+    respuestas del lote llevan el descuento; las peticiones faltantes y las continuaciones
+    se pidieron en el momento.
+    """
+    errores = [r.get('message', 'Error desconocido') for r in resultados if r.get('status') != 'success']
+    if errores:
+        documento['estado'] = ERROR
+        documento['error'] = errores[0]
+        return 0.0
+
+    resultado = PDFAnalyzer.combinar_resultados(resultados, resultados[0].get('texto_extraido'))
+    guardar_cache_analisis(documento['hash'], resultado.get('texto_extraido'), resultado)
+
+    uso_tokens = resultado.get('uso_tokens') or {}
+    uso_tokens_lote = resultado.get('uso_tokens_lote') or {}
+    uso_tokens_en_vivo = {clave: valor - uso_tokens_lote.get(clave, 0) for clave, valor in uso_tokens.items()}
+    costo = calcular_costo_ia(MODELO_IA, uso_tokens_en_vivo) + calcular_costo_ia(MODELO_IA, uso_tokens_lote, lote=True)
+
+    if usuario_id:
+        formateado = PDFAnalyzer.formatear_resultados(resultado)
+        lista_datos = formateado['data'] if isinstance(formateado['data'], list) else [formateado['data']]
+        nombre = os.path.basename(documento['ruta']) if documento.get('ruta') else None
+        documento['estados_cuenta'] = [guardar_con_sobrescritura(usuario_id, datos, nombre).id for datos in lista_datos]
+
+        if uso_tokens:
+            registrar_metrica_ia(
+                usuario_id=usuario_id,
+                modelo_ia=MODELO_IA,
+                tipo_operacion=TIPO_OPERACION,
+                tokens_consumidos=sum(uso_tokens.values()),
+                costo_estimado=costo,
+                duracion_segundos=duracion,
+                tokens_cache_lectura=uso_tokens.get('cache_read_input_tokens', 0),
+                tokens_cache_escritura=uso_tokens.get('cache_creation_input_tokens', 0),
+                tokens_entrada=uso_tokens.get('input_tokens', 0),
+                tokens_salida=uso_tokens.get('output_tokens', 0),
+                tiempos=resultado.get('tiempos')
+            )
+
+    documento['estado'] = GUARDADO
+    documento.pop('error', None)
+    return costo
+
+
+def procesar_documentos(analizador, checkpoint, ruta_checkpoint, documentos, respuestas, usuario_id, workers):
+    """
+    Analiza los documentos en un pool de 'workers' hilos (con respuestas del lote solo se
+    piden las faltantes y las continuaciones) y los guarda en este hilo, que tiene el
+    contexto de la aplicación. Guarda el checkpoint después de cada documento.
+    """
+    fuentes = {}
+    for documento in documentos:
+        try:
+            fuentes[documento['hash']] = leer_fuente(documento)
+        except Exception as e:
+            documento['estado'] = ERROR
+            documento['error'] = str(e)
+    documentos = [d for d in documentos if d['hash'] in fuentes]
+
+    def analizar(documento):
+        inicio = time.perf_counter()
+        resultados = analizar_documento(analizador, documento, fuentes.pop(documento['hash']), respuestas)
+        return resultados, round(time.perf_counter() - inicio, 4)
+
+    costo = 0.0
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futuros = [(documento, pool.submit(analizar, documento)) for documento in documentos]
+        for indice, (documento, futuro) in enumerate(futuros, 1):
+            try:
+                resultados, duracion = futuro.result()
+                costo += guardar_documento(documento, resultados, usuario_id, duracion)
+            except Exception as e:
+                try:
+                    db.session.rollback()
+                except:
+                    pass
+                documento['estado'] = ERROR
+                documento['error'] = str(e)
+            simbolo = '✅' if documento['estado'] == GUARDADO else '❌'
+            if documento['estado'] == ERROR:
+                detalle = documento['error']
+            elif usuario_id:
+                detalle = f"estados de cuenta {documento.get('estados_cuenta', [])}"
+            else:
+                detalle = "caché actualizada"
+            print(f"[{indice}/{len(futuros)}] {simbolo} {documento['origen']} - {detalle}")
+            guardar_checkpoint(ruta_checkpoint, checkpoint)
+    return costo
+
+
+def enviar_a_lote(analizador, checkpoint, ruta_checkpoint, documentos, workers):
+    """
+    Prepara las peticiones de los documentos y las envía en un lote. Retorna False si el
+    endpoint de lotes no está disponible. Los documentos resueltos sin IA (parsers
+    locales) no van al lote: se procesan igual al leer las respuestas.
+    """
+    def peticiones_documento(documento, fuente):
+        pdf_bytes, texto_pdf = fuente
+        contextos = analizador.preparar_lote(pdf_bytes, texto_pdf=texto_pdf)
+        return {
+            custom_id(documento['hash'], indice, i): peticion
+            for indice, contexto in enumerate(contextos)
+            for i, peticion in enumerate(contexto.get('peticiones', []))
+        }
+
+    fuentes = []
+    for documento in documentos:
+        try:
+            fuentes.append((documento, leer_fuente(documento)))
+        except Exception as e:
+            documento['estado'] = ERROR
+            documento['error'] = str(e)
+
+    # Un PDF ilegible o sin texto se marca ERROR (como en procesar_documentos) y no va al lote
+    peticiones = {}
+    preparados = []
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futuros = [(documento, pool.submit(peticiones_documento, documento, fuente)) for documento, fuente in fuentes]
+        for documento, futuro in futuros:
+            try:
+                peticiones.update(futuro.result())
+                preparados.append(documento)
+            except Exception as e:
+                documento['estado'] = ERROR
+                documento['error'] = str(e)
+                print(f"❌ {documento['origen']} - {documento['error']}")
+
+    try:
+        lote_id = analizador.enviar_lote(peticiones) if peticiones else None
+    except Exception as e:
+        print(f"⚠️  Lotes no disponibles ({type(e).__name__}: {str(e)[:200]}), se analiza directamente")
+        return False
+
+    checkpoint['lote_id'] = lote_id
+    for documento in preparados:
+        documento['estado'] = EN_LOTE
+    guardar_checkpoint(ruta_checkpoint, checkpoint)
+    print(f"📤 {len(peticiones)} peticiones de {len(preparados)} documentos enviadas en el lote {lote_id}")
+    return True
+
+
+def reanalizar(args):
+    analizador = obtener_analizador()
+    checkpoint = cargar_checkpoint(args.checkpoint)
+
+    usuario_id = None
+    if args.usuario:
+        usuario = buscar_usuario(args.usuario)
+        if not usuario:
+            print(f"❌ No existe el usuario {args.usuario}")
+            return 1
+        usuario_id = usuario.id
+    checkpoint.setdefault('usuario_id', usuario_id)
+    if checkpoint['usuario_id'] != usuario_id:
+        print(f"❌ El checkpoint es del usuario {checkpoint['usuario_id']}")
+        return 1
+
+    # Documentos nuevos (los del checkpoint se conservan con su estado)
+    if args.desde_cache:
+        nuevos = [{'hash': hash_pdf, 'origen': f"caché {hash_pdf[:12]}"}
+                  for (hash_pdf,) in db.session.query(CacheAnalisisPDF.hash_sha256).all()]
+    else:
+        nuevos = []
+        for ruta in rutas_pdf(args.pdfs):
+            with open(ruta, 'rb') as archivo:
+                nuevos.append({'hash': calcular_hash_pdf(archivo.read()), 'origen': ruta, 'ruta': ruta})
+    for documento in nuevos:
+        checkpoint['documentos'].setdefault(documento['hash'], dict(documento, estado=PENDIENTE))
+    guardar_checkpoint(args.checkpoint, checkpoint)
+
+    inicio = time.perf_counter()
+    costo = 0.0
+
+    def por_estado(*estados):
+        return [d for d in checkpoint['documentos'].values() if d['estado'] in estados]
+
+    # 1. Lote enviado en una ejecución anterior: esperarlo y guardar sus documentos
+    if checkpoint.get('lote_id'):
+        print(f"📦 Retomando el lote {checkpoint['lote_id']}")
+        costo += procesar_lote(analizador, checkpoint, args, usuario_id)
+
+    # 2. Pendientes (y los que fallaron antes, con --reintentar-errores)
+    pendientes = por_estado(PENDIENTE, ERROR) if args.reintentar_errores else por_estado(PENDIENTE)
+    if pendientes:
+        print(f"📄 {len(pendientes)} documentos por analizar")
+        if not args.sin_lote and enviar_a_lote(analizador, checkpoint, args.checkpoint, pendientes, args.workers):
+            costo += procesar_lote(analizador, checkpoint, args, usuario_id)
+        else:
+            costo += procesar_documentos(analizador, checkpoint, args.checkpoint, pendientes, {},
+                                         usuario_id, args.workers)
+
+    print("\n" + "=" * 60)
+    print(f"✅ Guardados: {len(por_estado(GUARDADO))}, ❌ con error: {len(por_estado(ERROR))}, "
+          f"⏳ pendientes: {len(por_estado(PENDIENTE, EN_LOTE))}")
+    print(f"⏱️  {time.perf_counter() - inicio:.1f}s, costo estimado ${costo:.4f}")
+    return 0 if not por_estado(ERROR, PENDIENTE, EN_LOTE) else 2
+
+
+def procesar_lote(analizador, checkpoint, args, usuario_id):
+    """Espera el lote del checkpoint, lee sus respuestas y guarda sus documentos"""
+    lote_id = checkpoint['lote_id']
+
+    def progreso(lote):
+        conteo = lote.request_counts
+        print(f"⏳ Lote {lote_id}: {lote.processing_status} - {conteo.succeeded} exitosas, "
+              f"{conteo.errored} con error, {conteo.processing} en proceso")
+
+    respuestas = {}
+    if lote_id:
+        analizador.esperar_lote(lote_id, args.intervalo, progreso)
+        respuestas = analizador.respuestas_lote(lote_id)
+
+    documentos = [d for d in checkpoint['documentos'].values() if d['estado'] == EN_LOTE]
+    costo = procesar_documentos(analizador, checkpoint, args.checkpoint, documentos, respuestas,
+                                usuario_id, args.workers)
+    checkpoint['lote_id'] = None
+    guardar_checkpoint(args.checkpoint, checkpoint)
+    return costo
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Vuelve a analizar estados de cuenta en lote y los sobrescribe')
+    parser.add_argument('pdfs', nargs='*', help='PDFs o carpetas con PDFs')
+    parser.add_argument('--usuario', help='ID o email del usuario dueño de los estados de cuenta')
+    parser.add_argument('--desde-cache', action='store_true',
+                        help='Reanalizar los textos de la caché de análisis (solo actualiza la caché)')
+    parser.add_argument('--checkpoint', default='reanalisis_checkpoint.json', help='Archivo de progreso')
+    parser.add_argument('--sin-lote', action='store_true', help='No usar Message Batches')
+    parser.add_argument('--workers', type=int, default=4, help='Peticiones / documentos simultáneos')
+    parser.add_argument('--intervalo', type=float, default=30, help='Segundos entre consultas del lote')
+    parser.add_argument('--reintentar-errores', action='store_true', help='Volver a procesar los que fallaron')
+    args = parser.parse_args()
+
+    if args.desde_cache == bool(args.pdfs):
+        parser.error('indica PDFs o --desde-cache (uno de los dos)')
+    if args.pdfs and not args.usuario:
+        parser.error('--usuario es obligatorio para guardar los estados de cuenta de los PDFs')
+
+    with app.app_context():
+        return reanalizar(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+"""
+Servidor HTTP local que imita el endpoint POST /v1/messages de la API de Anthropic.
+Lo usan los benchmarks (benchmark_pdf.py) para medir el cliente sin llamar a la API real.
+
+- HTTP/1.1 con keep-alive: se puede ver cuántas conexiones abre el cliente
+- TLS opcional con un certificado autofirmado (generado con openssl)
+- Latencia simulada configurable
+- Respuestas en streaming (SSE) cuando la petición trae "stream": true
+- Errores (respuesta_error) y latencia por petición inyectables desde 'responder'
+- Message Batches (/v1/messages/batches): el lote se procesa en un hilo con 'responder'
+  y termina después de 'duracion_lote' segundos; lotes=False responde 404 (sin lotes)
+
+Uso:
+    with ServidorIALocal(latencia=0.05, tls=True) as servidor:
+        cliente = crear_cliente_anthropic('clave-local', base_url=servidor.url,
+                                          http_client=DefaultHttpxClient(verify=servidor.certificado))
+"""
+
+import json
+import os
+import shutil
+import socket
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def generar_certificado_autofirmado(directorio):
+    """Genera cert.pem/key.pem para localhost con openssl; retorna (cert, key)"""
+    cert = os.path.join(directorio, 'cert.pem')
+    key = os.path.join(directorio, 'key.pem')
+    subprocess.run(
+        ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-keyout', key, '-out', cert,
+         '-days', '1', '-subj', '/CN=localhost', '-addext', 'subjectAltName=DNS:localhost,IP:127.0.0.1'],
+        check=True, capture_output=True
+    )
+    return cert, key
+
+
+def respuesta_mensaje(texto, modelo='claude-haiku-4-5', input_tokens=0, output_tokens=0, stop_reason='end_turn'):
+    """Cuerpo JSON de una respuesta de /v1/messages"""
+    return {
+        'id': 'msg_local',
+        'type': 'message',
+        'role': 'assistant',
+        'model': modelo,
+        'content': [{'type': 'text', 'text': texto}],
+        'stop_reason': stop_reason,
+        'stop_sequence': None,
+        'usage': {'input_tokens': input_tokens, 'output_tokens': output_tokens}
+    }
+
+
+def respuesta_error(estado=529, tipo='overloaded_error', mensaje='Overloaded', retry_after=None, latencia=0.0):
+    """
+    Respuesta de error de la API con su estado HTTP (529 sobrecarga, 429 límite de tasa,
+    500...). Las claves '_estado_http', '_retry_after' y '_latencia' no se envían: las
+    usa el servidor (también sirven en respuestas exitosas, p. ej. para simular latencia)
+    """
+    return {'type': 'error', 'error': {'type': tipo, 'message': mensaje},
+            '_estado_http': estado, '_retry_after': retry_after, '_latencia': latencia}
+
+
+def eventos_stream(respuesta, caracteres_por_evento=40):
+    """Eventos SSE (nombre, datos) equivalentes a una respuesta de /v1/messages en streaming"""
+    texto = respuesta['content'][0]['text']
+    mensaje = dict(respuesta, content=[], stop_reason=None,
+                   usage=dict(respuesta['usage'], output_tokens=0))
+    yield 'message_start', {'type': 'message_start', 'message': mensaje}
+    yield 'content_block_start', {'type': 'content_block_start', 'index': 0,
+                                  'content_block': {'type': 'text', 'text': ''}}
+    for inicio in range(0, len(texto), caracteres_por_evento):
+        yield 'content_block_delta', {'type': 'content_block_delta', 'index': 0,
+                                      'delta': {'type': 'text_delta', 'text': texto[inicio:inicio + caracteres_por_evento]}}
+    yield 'content_block_stop', {'type': 'content_block_stop', 'index': 0}
+    yield 'message_delta', {'type': 'message_delta',
+                            'delta': {'stop_reason': respuesta['stop_reason'], 'stop_sequence': None},
+                            'usage': {'output_tokens': respuesta['usage']['output_tokens']}}
+    yield 'message_stop', {'type': 'message_stop'}
+
+
+def _ahora_iso():
+    return datetime.now(timezone.utc).isoformat()
+
+
+def objeto_lote(lote, url_base):
+    """Cuerpo JSON de un MessageBatch"""
+    terminado = lote['estado'] == 'ended'
+    return {
+        'id': lote['id'],
+        'type': 'message_batch',
+        'processing_status': lote['estado'],
+        'request_counts': {
+            'processing': 0 if terminado else len(lote['peticiones']),
+            'succeeded': sum(1 for r in lote['resultados'] if r['result']['type'] == 'succeeded'),
+            'errored': sum(1 for r in lote['resultados'] if r['result']['type'] == 'errored'),
+            'canceled': 0,
+            'expired': 0
+        },
+        'created_at': lote['creado'],
+        'expires_at': lote['creado'],
+        'ended_at': lote['terminado'],
+        'archived_at': None,
+        'cancel_initiated_at': None,
+        'results_url': f"{url_base}/v1/messages/batches/{lote['id']}/results" if terminado else None
+    }
+
+
+class _ManejadorMensajes(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive
+
+    def setup(self):
+        super().setup()
+        # Sin Nagle: encabezados y cuerpo van en escrituras separadas
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with self.server.lock:
+            self.server.conexiones += 1
+
+    def log_message(self, formato, *args):
+        pass  # Sin logs por petición
+
+    def _enviar_json(self, datos, estado=200, tipo='application/json'):
+        if not isinstance(datos, bytes):
+            datos = json.dumps(datos).encode('utf-8')
+        self.send_response(estado)
+        self.send_header('Content-Type', tipo)
+        self.send_header('Content-Length', str(len(datos)))
+        self.end_headers()
+        self.wfile.write(datos)
+
+    def do_GET(self):
+        # /v1/messages/batches/{id} y /v1/messages/batches/{id}/results
+        partes = self.path.split('?')[0].strip('/').split('/')
+        lote = self.server.lotes.get(partes[3]) if len(partes) >= 4 and partes[:3] == ['v1', 'messages', 'batches'] else None
+        if lote is None or not self.server.lotes_habilitados:
+            self._enviar_json({'type': 'error', 'error': {'type': 'not_found_error', 'message': 'Not found'}}, 404)
+            return
+        if len(partes) == 5 and partes[4] == 'results':
+            lineas = ''.join(json.dumps(resultado) + '\n' for resultado in lote['resultados'])
+            self._enviar_json(lineas.encode('utf-8'), tipo='application/binary')
+            return
+        self._enviar_json(objeto_lote(lote, self.server.url_base))
+
+    def _crear_lote(self, cuerpo):
+        if not self.server.lotes_habilitados:
+            self._enviar_json({'type': 'error', 'error': {'type': 'not_found_error', 'message': 'Not found'}}, 404)
+            return
+        with self.server.lock:
+            lote = {'id': f"msgbatch_local_{len(self.server.lotes) + 1}", 'estado': 'in_progress',
+                    'peticiones': cuerpo.get('requests', []), 'resultados': [],
+                    'creado': _ahora_iso(), 'terminado': None}
+            self.server.lotes[lote['id']] = lote
+
+        def procesar():
+            inicio = time.monotonic()
+            resultados = []
+            for peticion in lote['peticiones']:
+                respuesta = dict(self.server.responder(peticion['params']))
+                estado = respuesta.pop('_estado_http', 200)
+                respuesta.pop('_retry_after', None)
+                respuesta.pop('_latencia', None)
+                if estado == 200:
+                    resultado = {'type': 'succeeded', 'message': respuesta}
+                else:
+                    resultado = {'type': 'errored', 'error': respuesta}
+                resultados.append({'custom_id': peticion['custom_id'], 'result': resultado})
+            time.sleep(max(0.0, self.server.duracion_lote - (time.monotonic() - inicio)))
+            lote['resultados'] = resultados
+            lote['terminado'] = _ahora_iso()
+            lote['estado'] = 'ended'
+
+        threading.Thread(target=procesar, daemon=True).start()
+        self._enviar_json(objeto_lote(lote, self.server.url_base))
+
+    def do_POST(self):
+        longitud = int(self.headers.get('Content-Length') or 0)
+        cuerpo = json.loads(self.rfile.read(longitud) or b'{}')
+        with self.server.lock:
+            self.server.peticiones.append({'ruta': self.path, 'cuerpo': cuerpo})
+
+        if self.path.split('?')[0].rstrip('/') == '/v1/messages/batches':
+            self._crear_lote(cuerpo)
+            return
+
+        if self.server.latencia:
+            time.sleep(self.server.latencia)
+
+        respuesta = dict(self.server.responder(cuerpo))
+        estado = respuesta.pop('_estado_http', 200)
+        retry_after = respuesta.pop('_retry_after', None)
+        latencia = respuesta.pop('_latencia', 0.0)
+        if latencia:
+            time.sleep(latencia)
+        if cuerpo.get('stream') and estado == 200:
+            self._enviar_stream(respuesta)
+            return
+
+        datos = json.dumps(respuesta).encode('utf-8')
+        try:
+            self.send_response(estado)
+            self.send_header('Content-Type', 'application/json')
+            if retry_after is not None:
+                self.send_header('retry-after', str(retry_after))
+            self.send_header('Content-Length', str(len(datos)))
+            self.end_headers()
+            self.wfile.write(datos)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True  # El cliente se fue (timeout o petición de cobertura descartada)
+
+    def _enviar_stream(self, respuesta):
+        """Respuesta SSE con transferencia chunked (mantiene el keep-alive)"""
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for nombre, datos in eventos_stream(respuesta):
+            evento = f"event: {nombre}\ndata: {json.dumps(datos)}\n\n".encode('utf-8')
+            self.wfile.write(f"{len(evento):x}\r\n".encode('ascii') + evento + b"\r\n")
+            self.wfile.flush()
+            if self.server.latencia_evento:
+                time.sleep(self.server.latencia_evento)
+        self.wfile.write(b"0\r\n\r\n")
+
+
+class ServidorIALocal:
+    """
+    Servidor local en un hilo. 'responder' recibe el cuerpo de la petición y retorna
+    el JSON de respuesta (por defecto un mensaje con 'texto_respuesta') o un error de
+    respuesta_error. En streaming, 'latencia_evento' es la pausa entre eventos SSE.
+    Los lotes usan el mismo 'responder' y terminan después de 'duracion_lote' segundos.
+    """
+
+    def __init__(self, texto_respuesta='{}', latencia=0.0, tls=False, responder=None, latencia_evento=0.0,
+                 lotes=True, duracion_lote=0.0):
+        self.texto_respuesta = texto_respuesta
+        self.latencia = latencia
+        self.latencia_evento = latencia_evento
+        self.lotes = lotes
+        self.duracion_lote = duracion_lote
+        self.tls = tls
+        self.responder = responder or (lambda cuerpo: respuesta_mensaje(self.texto_respuesta))
+        self.certificado = None
+        self._directorio = None
+        self._servidor = None
+        self._hilo = None
+
+    @property
+    def url(self):
+        esquema = 'https' if self.tls else 'http'
+        return f"{esquema}://localhost:{self._servidor.server_address[1]}"
+
+    @property
+    def conexiones(self):
+        return self._servidor.conexiones
+
+    @property
+    def peticiones(self):
+        return self._servidor.peticiones
+
+    @property
+    def peticiones_mensajes(self):
+        """Peticiones a /v1/messages (sin las de los lotes)"""
+        return [p for p in self._servidor.peticiones if p['ruta'].split('?')[0] == '/v1/messages']
+
+    def iniciar(self):
+        self._servidor = ThreadingHTTPServer(('127.0.0.1', 0), _ManejadorMensajes)
+        self._servidor.daemon_threads = True
+        self._servidor.lock = threading.Lock()
+        self._servidor.conexiones = 0
+        self._servidor.peticiones = []
+        self._servidor.latencia = self.latencia
+        self._servidor.latencia_evento = self.latencia_evento
+        self._servidor.responder = self.responder
+        self._servidor.lotes = {}
+        self._servidor.lotes_habilitados = self.lotes
+        self._servidor.duracion_lote = self.duracion_lote
+
+        if self.tls:
+            self._directorio = tempfile.mkdtemp(prefix='servidor_ia_local_')
+            self.certificado, clave = generar_certificado_autofirmado(self._directorio)
+            contexto = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            contexto.load_cert_chain(self.certificado, clave)
+            self._servidor.socket = contexto.wrap_socket(self._servidor.socket, server_side=True)
+        self._servidor.url_base = self.url
+
+        self._hilo = threading.Thread(target=self._servidor.serve_forever, daemon=True)
+        self._hilo.start()
+        return self
+
+    def detener(self):
+        if self._servidor:
+            self._servidor.shutdown()
+            self._servidor.server_close()
+        if self._directorio:
+            shutil.rmtree(self._directorio, ignore_errors=True)
+
+    def __enter__(self):
+        return self.iniciar()
+
+    def __exit__(self, *exc):
+        self.detener()